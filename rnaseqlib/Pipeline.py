@@ -2,6 +2,7 @@ import os
 import sys
 import time
 import glob
+import json
 import settings
 
 import pysam
@@ -11,10 +12,16 @@ from collections import defaultdict
 
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.subsample_utils as subsample_utils
+import rnaseqlib.rrna_utils as rrna_utils
 import rnaseqlib.rpkm.rpkm_utils as rpkm_utils
 import rnaseqlib.mapping.mapper_wrappers as mapper_wrappers
 import rnaseqlib.mapping.bedtools_utils as bedtools_utils
 import rnaseqlib.ribo.ribo_utils as ribo_utils
+import rnaseqlib.ribo.footprint_utils as footprint_utils
+import rnaseqlib.genes.TranscriptStore as TranscriptStore
+import rnaseqlib.clip.clip_utils as clip_utils
 import rnaseqlib.QualityControl as qc
 import rnaseqlib.RNABase as rna_base
 
@@ -51,8 +58,18 @@ class Sample:
         self.unique_bam_filename = None
         # rRNA subtracted BAM filename
         self.ribosub_bam_filename = None
+        # UMI deduplicated BAM filename
+        self.dedup_bam_filename = None
+        # Stats of rRNA reads removed before mapping
+        self.rrna_stats_filename = None
+        # Stats of polyA trimming (single-end riboseq samples)
+        # and of paired-end preprocessing
+        self.trimming_stats_filename = None
+        self.paired_stats_filename = None
         # Sample's RPKM directory
         self.rpkm_dir = None
+        # Footprint outputs of riboseq samples
+        self.footprint_filenames = None
         # RPKM tables for the sample
         self.rpkm_tables = defaultdict(lambda: None)
         # Record if a sample is grouped
@@ -109,12 +126,24 @@ class Pipeline:
     def __init__(self,
                  settings_filename,
                  log_output_dir,
-                 curr_sample=None):
+                 curr_sample=None,
+                 preview=None):
         """
         Initialize pipeline.
+
+        - preview: if given, run in preview mode on a subsample
+          of each sample's reads: a fraction of the reads if
+          less than 1, or else a number of reads (greater than 1;
+          1 is rejected as ambiguous.) Preview outputs go in a
+          'preview/<subsample label>' subdirectory of the output
+          directory (see subsample_utils.get_subsample_label), so
+          that previews of different sizes are kept apart.
         """
         # If invoked to run on particular sample
         self.curr_sample = curr_sample
+        self.preview = preview
+        # Seed of the read hashes used to subsample for previews
+        self.preview_seed = 0
         self.genome = None
         # Output directory for logging pipeline activity
         self.log_output_dir = log_output_dir
@@ -138,12 +167,26 @@ class Pipeline:
         self.my_cluster = None
         # Check settings are correct
         self.load_pipeline_settings()
+        if self.preview is not None:
+            fraction, num_reads = self.get_preview_args()
+            self.output_dir = \
+                os.path.join(self.output_dir, "preview",
+                             subsample_utils.get_subsample_label(fraction,
+                                                                 num_reads,
+                                                                 self.preview_seed))
         # Pipeline output subdirectories
         self.pipeline_outdirs = {}
         # RPKM directory for teh pipeline
         self.rpkm_dir = None
+        # Footprints directory for the pipeline
+        self.footprints_dir = None
+        # Coding transcripts that footprints are counted on
+        self.transcript_coords = None
         # QC objects for each sample in pipeline
         self.qc_objects = {}
+        # Record of the samples that went into the last
+        # compile of the pipeline outputs
+        self.compile_manifest_filename = None
         # Top-level output dirs
         self.toplevel_dirs = ["rawdata",
                               "mapping",
@@ -193,25 +236,35 @@ class Pipeline:
         self.load_qc()
         
 
-    def load_qc(self):
+    def load_qc(self, samples=None):
         """
         Load QC information from samples.
+
+        - samples: samples to load QC for. If None, load QC
+          for all samples in pipeline.
         """
-        for sample in self.samples:
+        if samples is None:
+            samples = self.samples
+        for sample in samples:
             self.qc_objects[sample.label] = qc.QualityControl(sample,
                                                               self)
             sample.qc = self.qc_objects[sample.label]
         # Retrieve QC header: get the header from first sample
-        self.qc_header = self.qc_objects[self.samples[0].label].qc_header
+        self.qc_header = self.qc_objects[samples[0].label].qc_header
 
 
-    def load_rpkms(self):
+    def load_rpkms(self, samples=None):
         """
         Load RPKM information from samples.
+
+        - samples: samples to load RPKMs for. If None, load RPKMs
+          for all samples in pipeline.
         """
-        for sample_num, sample in enumerate(self.samples):
+        if samples is None:
+            samples = self.samples
+        for sample in samples:
             # Get mapping from table names to loaded RPKM tables
-            self.samples[sample_num].rpkm_tables = \
+            sample.rpkm_tables = \
                 rpkm_utils.load_sample_rpkms(sample,
                                              self.rna_base)
         # Load RPKMs into combined RPKM tables for all samples
@@ -219,19 +272,19 @@ class Pipeline:
         # that includes all samples
         self.rpkm_tables = defaultdict(lambda: None)
         for table_name in self.rna_base.rpkm_table_names:
-            curr_sample = self.samples[0]
+            curr_sample = samples[0]
             # If the RPKM table is not available, skip it
             if curr_sample.rpkm_tables[table_name] is None: continue
             # If we have only one sample, make add it to the set of
             # RPKM tables by itself and continue to next table
-            if len(self.samples) == 1:
+            if len(samples) == 1:
                 self.rpkm_tables[table_name] \
                     = curr_sample.rpkm_tables[table_name]
                 continue
             # For multiple samples: collect each sample's RPKM table
             # for the current table (e.g. ensGene)
             combined_rpkm_table = curr_sample.rpkm_tables[table_name]
-            for next_sample in self.samples[1:]:
+            for next_sample in samples[1:]:
                 # Merge with next sample's RPKM table
                 next_sample_rpkm = next_sample.rpkm_tables[table_name]
                 combined_rpkm_table = \
@@ -261,7 +314,7 @@ class Pipeline:
         utils.make_dir(self.output_dir)
         # Subdirectories of toplevel subdirs
         self.toplevel_subdirs = defaultdict(list)
-        self.toplevel_subdirs["analysis"] = ["rpkm", "insert_lens"]
+        self.toplevel_subdirs["analysis"] = ["rpkm", "insert_lens", "footprints"]
         for dirname in self.toplevel_dirs:
             dirpath = os.path.join(self.output_dir, dirname)
             print " - Creating: %s" %(dirpath)
@@ -273,6 +326,10 @@ class Pipeline:
         # Variables storing commonly accessed directories
         self.rpkm_dir = os.path.join(self.pipeline_outdirs["analysis"],
                                      "rpkm")
+        self.footprints_dir = os.path.join(self.pipeline_outdirs["analysis"],
+                                           "footprints")
+        self.compile_manifest_filename = \
+            os.path.join(self.output_dir, "compiled_samples.json")
 
             
     def load_pipeline_settings(self):
@@ -429,14 +486,61 @@ class Pipeline:
         Pre-process reads.
         """
         print "Preprocessing: %s" %(sample)
-        if sample.sample_type == "riboseq":
+        num_processors = self.settings_info["mapping"]["num_processors"]
+        if sample.paired and (sample.sample_type == "riboseq"):
+            # Preprocess paired riboseq samples by trimming trailing
+            # As from both mates in one pass, keeping the mates
+            # in sync
+            mate_filenames = [r.seq_filename for r in sample.rawdata]
+            trimmed_filenames = \
+                fastq_utils.preprocess_paired_fastq(mate_filenames,
+                                                    self.pipeline_outdirs["rawdata"],
+                                                    trim_letter="A",
+                                                    num_processors=num_processors)
+            for mate_rawdata, trimmed_filename in zip(sample.rawdata,
+                                                      trimmed_filenames):
+                mate_rawdata.reads_filename = trimmed_filename
+            sample.paired_stats_filename = \
+                fastq_utils.get_paired_stats_filename(mate_filenames,
+                                                      self.pipeline_outdirs["rawdata"])
+        elif sample.sample_type == "riboseq":
             # Preprocess riboseq samples by trimming trailing
             # As
             trimmed_filename = ribo_utils.trim_polyA_ends(sample.rawdata.seq_filename,
-                                                          self.pipeline_outdirs["rawdata"])
+                                                          self.pipeline_outdirs["rawdata"],
+                                                          num_processors=num_processors)
             # Adjust the trimmed file to be the "reads" sequence file for this
             # sample
             sample.rawdata.reads_filename = trimmed_filename
+            sample.trimming_stats_filename = \
+                ribo_utils.get_trimming_stats_filename(sample.rawdata.seq_filename,
+                                                       self.pipeline_outdirs["rawdata"])
+            if self.settings_info["mapping"]["collapse_reads"]:
+                # Collapse identical trimmed reads so that each
+                # unique sequence is mapped once. Counts are
+                # expanded back from the collapsed read names.
+                collapsed_filename = \
+                    clip_utils.collapse_reads(trimmed_filename,
+                                              self.pipeline_outdirs["rawdata"])
+                sample.rawdata.reads_filename = collapsed_filename
+        elif sample.sample_type == "clip":
+            if self.has_umis(sample):
+                # Move the UMIs of CLIP reads into their names
+                mapping_settings = self.settings_info["mapping"]
+                umi_filename = \
+                    clip_utils.extract_umis(sample.rawdata.seq_filename,
+                                            self.pipeline_outdirs["rawdata"],
+                                            umi_len=mapping_settings.get("umi_len"),
+                                            umi_in_header=mapping_settings["umi_in_header"])
+                sample.rawdata.reads_filename = umi_filename
+            elif self.settings_info["mapping"]["collapse_reads"]:
+                # Collapse identical CLIP reads so that each unique
+                # sequence is mapped once. Reads with UMIs are not
+                # collapsed, since that would merge their UMIs.
+                collapsed_filename = \
+                    clip_utils.collapse_reads(sample.rawdata.reads_filename,
+                                              self.pipeline_outdirs["rawdata"])
+                sample.rawdata.reads_filename = collapsed_filename
         else:
             print "WARNING: Do not know how to pre-process type %s samples." \
                 %(sample.sample_type)
@@ -445,6 +549,85 @@ class Pipeline:
         return sample
 
 
+    def get_preview_args(self):
+        """
+        Return the fraction of reads or the number of reads
+        (one of them None) to subsample for preview mode.
+        """
+        if (self.preview <= 0) or (self.preview == 1):
+            raise Exception, "Preview must be a fraction of the reads " \
+                             "(between 0 and 1) or a number of reads " \
+                             "(greater than 1), not %s." %(str(self.preview))
+        if self.preview < 1:
+            return self.preview, None
+        if self.preview != int(self.preview):
+            raise Exception, "Preview number of reads must be an " \
+                             "integer, not %s." %(str(self.preview))
+        return None, int(self.preview)
+
+
+    def subsample_reads(self, sample):
+        """
+        Subsample the reads of a sample for preview mode. The
+        subsampled reads replace the sample's raw sequence files.
+        Mates are subsampled together so that they stay paired.
+        """
+        fraction, num_reads = self.get_preview_args()
+        print "Subsampling reads for preview: %s" %(sample)
+        self.logger.info("Subsampling reads of %s (preview: %s)" \
+                         %(sample.label, str(self.preview)))
+        if sample.paired:
+            samples_rawdata = sample.rawdata
+        else:
+            samples_rawdata = [sample.rawdata]
+        subsampled_filenames = \
+            subsample_utils.subsample_fastq([r.seq_filename \
+                                             for r in samples_rawdata],
+                                            self.pipeline_outdirs["rawdata"],
+                                            fraction=fraction,
+                                            num_reads=num_reads,
+                                            seed=self.preview_seed)
+        for sample_rawdata, subsampled_filename in zip(samples_rawdata,
+                                                       subsampled_filenames):
+            sample_rawdata.seq_filename = subsampled_filename
+            sample_rawdata.reads_filename = subsampled_filename
+        return sample
+
+
+    def prefilter_rrna_reads(self, sample):
+        """
+        Remove the reads that share k-mers with rRNA before
+        mapping. For paired-end samples, pairs are removed if
+        either mate is rRNA.
+        """
+        print "Removing rRNA reads: %s" %(sample)
+        rrna_fasta_filename = self.rna_base.get_rrna_fasta_filename()
+        if not os.path.isfile(rrna_fasta_filename):
+            print "WARNING: Cannot find rRNA sequence %s, not removing " \
+                  "rRNA reads before mapping." %(rrna_fasta_filename)
+            self.logger.warning("Cannot find %s" %(rrna_fasta_filename))
+            return sample
+        if sample.paired:
+            samples_rawdata = sample.rawdata
+        else:
+            samples_rawdata = [sample.rawdata]
+        reads_filenames = [r.reads_filename for r in samples_rawdata]
+        rrna_kmers = rrna_utils.get_rrna_kmers(rrna_fasta_filename)
+        num_processors = self.settings_info["mapping"]["num_processors"]
+        filtered_filenames = \
+            rrna_utils.filter_rrna_reads(reads_filenames,
+                                         self.pipeline_outdirs["rawdata"],
+                                         rrna_kmers,
+                                         num_processors=num_processors)
+        for sample_rawdata, filtered_filename in zip(samples_rawdata,
+                                                     filtered_filenames):
+            sample_rawdata.reads_filename = filtered_filename
+        sample.rrna_stats_filename = \
+            rrna_utils.get_rrna_stats_filename(reads_filenames[0],
+                                               self.pipeline_outdirs["rawdata"])
+        return sample
+
+
     def get_sample_by_label(self, label):
         """
         Return a sample by its label.
@@ -455,10 +638,18 @@ class Pipeline:
         return None
             
             
-    def run_on_samples(self):
+    def run_on_samples(self, samples=None):
+        """
+        Launch a pipeline job for each sample.
+
+        - samples: samples to run on. If None, run on all
+          samples in pipeline.
+        """
+        if samples is None:
+            samples = self.samples
         samples_job_ids = []
         self.logger.info("Running on samples..")
-        for sample in self.samples:
+        for sample in samples:
             print "Processing sample %s" %(sample)
             job_name = "pipeline_run_%s" %(sample.label)
             sample_cmd = "python %s --run-on-sample %s --settings %s --output-dir %s" \
@@ -466,6 +657,8 @@ class Pipeline:
                   sample.label,
                   self.settings_filename,
                   self.output_dir)
+            if self.preview is not None:
+                sample_cmd += " --preview %s" %(str(self.preview))
             self.logger.info("Executing: %s" %(sample_cmd))
             job_id = self.my_cluster.launch_job(sample_cmd, job_name)
             self.logger.info("Job launched with ID %s" %(job_id))
@@ -473,9 +666,15 @@ class Pipeline:
         return samples_job_ids
             
         
-    def run(self, label=None):
+    def run(self, label=None, incremental=False):
         """
         Run pipeline. 
+
+        - incremental: if True, run only on samples that are new
+          or changed since the last compile of the pipeline
+          outputs, and add only these samples to the compiled
+          QC and expression outputs. Samples no longer in the
+          settings are removed from the compiled outputs.
         """
         self.logger.info("Running pipeline.")
         print "Running pipeline..."
@@ -483,20 +682,208 @@ class Pipeline:
         if num_samples == 0:
             print "Error: No samples to run on."
             sys.exit(1)
+        if incremental and (not self.can_compile_incrementally()):
+            print "WARNING: Cannot find outputs of a previous compile. " \
+                  "Compiling all samples."
+            self.logger.warning("No previous compile found, running "
+                                "on all samples.")
+            incremental = False
+        samples_to_run = self.samples
+        if incremental:
+            samples_to_run = self.get_changed_samples()
+            print "Running incrementally on %d new or changed samples " \
+                  "(out of %d)" %(len(samples_to_run), num_samples)
+            self.logger.info("New or changed samples: %s" \
+                             %(", ".join([s.label for s in samples_to_run])))
         else:
             print "Running on %d samples" %(num_samples)
         # Job IDs for each sample
-        job_ids = self.run_on_samples()
+        job_ids = self.run_on_samples(samples=samples_to_run)
         # Wait until all jobs completed 
         self.my_cluster.wait_on_jobs(job_ids)
-        # Compile all the QC results
-        self.compile_qc_output()
-        # Compile all the analysis results
-        self.compile_analysis_output()
+        if incremental:
+            # Drop the samples that are no longer in the settings
+            removed_labels = self.get_removed_samples()
+            if len(removed_labels) > 0:
+                self.remove_compiled_samples(removed_labels)
+            # Re-check the samples now that their outputs have
+            # been made
+            samples_to_compile = self.get_changed_samples()
+            if len(samples_to_compile) == 0:
+                print "No new or changed samples to compile."
+            else:
+                self.compile_qc_output(samples=samples_to_compile)
+                self.compile_analysis_output(samples=samples_to_compile)
+        else:
+            # Compile all the QC results
+            self.compile_qc_output()
+            # Compile all the analysis results
+            self.compile_analysis_output()
+        # Record the samples that went into the compiled outputs
+        self.output_compile_manifest()
         # Signal completion
         self.logger.info("Run completed!")
 
 
+    def get_sample_files(self, sample):
+        """
+        Return the files that a sample's compiled outputs
+        depend on: its sequence files, its QC file and its
+        RPKM tables.
+        """
+        if sample.paired:
+            sample_files = [r.seq_filename for r in sample.rawdata]
+        else:
+            sample_files = [sample.rawdata.seq_filename]
+        sample_files.append(os.path.join(self.pipeline_outdirs["qc"],
+                                         sample.label,
+                                         "%s.qc.txt" %(sample.label)))
+        for table_name in self.rna_base.rpkm_table_names:
+            sample_files.append(os.path.join(sample.rpkm_dir,
+                                             "%s.rpkm" %(table_name)))
+        return sample_files
+
+
+    def get_sample_fingerprint(self, sample):
+        """
+        Return a fingerprint of the sample's files: a list of
+        [filename, size, modification time] entries. Files that
+        do not exist have a size and time of None.
+        """
+        fingerprint = []
+        for filename in self.get_sample_files(sample):
+            if os.path.isfile(filename):
+                file_stat = os.stat(filename)
+                fingerprint.append([filename,
+                                    file_stat.st_size,
+                                    int(file_stat.st_mtime)])
+            else:
+                fingerprint.append([filename, None, None])
+        return fingerprint
+
+
+    def load_compile_manifest(self):
+        """
+        Load the record of the last compile of the pipeline
+        outputs. Return None if there is no record.
+        """
+        if not os.path.isfile(self.compile_manifest_filename):
+            return None
+        manifest_file = open(self.compile_manifest_filename, "r")
+        manifest = json.load(manifest_file)
+        manifest_file.close()
+        return manifest
+
+
+    def output_compile_manifest(self):
+        """
+        Record the fingerprint of every sample that went into
+        the compiled outputs, and the RPKM tables that were
+        compiled.
+        """
+        manifest = {"samples": {},
+                    "rpkm_tables": []}
+        for sample in self.samples:
+            manifest["samples"][sample.label] = \
+                self.get_sample_fingerprint(sample)
+        for table_name in self.rna_base.rpkm_table_names:
+            rpkm_table_filename = os.path.join(self.rpkm_dir,
+                                               "%s.rpkm.txt" %(table_name))
+            if os.path.isfile(rpkm_table_filename):
+                manifest["rpkm_tables"].append(table_name)
+        self.logger.info("Outputting compile manifest: %s" \
+                         %(self.compile_manifest_filename))
+        with utils.atomic_write(self.compile_manifest_filename) as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+
+
+    def can_compile_incrementally(self):
+        """
+        Return True if the outputs of a previous compile are
+        all in place, so that new samples can be added to them.
+        """
+        manifest = self.load_compile_manifest()
+        if manifest is None:
+            return False
+        qc_output_filename = os.path.join(self.pipeline_outdirs["qc"],
+                                          "qc_stats.txt")
+        if not os.path.isfile(qc_output_filename):
+            return False
+        for table_name in manifest["rpkm_tables"]:
+            rpkm_table_filename = os.path.join(self.rpkm_dir,
+                                               "%s.rpkm.txt" %(table_name))
+            if not os.path.isfile(rpkm_table_filename):
+                return False
+        return True
+
+
+    def get_changed_samples(self):
+        """
+        Return the samples that are new or whose files changed
+        since the last compile of the pipeline outputs.
+        """
+        manifest = self.load_compile_manifest()
+        if manifest is None:
+            return self.samples
+        changed_samples = []
+        for sample in self.samples:
+            prev_fingerprint = manifest["samples"].get(sample.label)
+            if prev_fingerprint != self.get_sample_fingerprint(sample):
+                changed_samples.append(sample)
+        return changed_samples
+
+
+    def get_removed_samples(self):
+        """
+        Return the labels of the samples that went into the
+        last compile of the pipeline outputs but are no longer
+        among the pipeline's samples.
+        """
+        manifest = self.load_compile_manifest()
+        if manifest is None:
+            return []
+        sample_labels = dict([(sample.label, True) \
+                              for sample in self.samples])
+        return sorted([label for label in manifest["samples"] \
+                       if label not in sample_labels])
+
+
+    def remove_compiled_samples(self, sample_labels):
+        """
+        Remove the entries of the given samples from the compiled
+        QC, read length and RPKM outputs.
+        """
+        print "Removing %d samples from compiled outputs: %s" \
+            %(len(sample_labels), ", ".join(sample_labels))
+        self.logger.info("Removing samples from compiled outputs: %s" \
+                         %(", ".join(sample_labels)))
+        for qc_filename in ["qc_stats.txt", "read_lens.txt"]:
+            qc_output_filename = os.path.join(self.pipeline_outdirs["qc"],
+                                              qc_filename)
+            if os.path.isfile(qc_output_filename):
+                qc.remove_samples_from_csv(qc_output_filename,
+                                           sample_labels)
+        removed_cols = ["rpkm_%s" %(label) for label in sample_labels]
+        removed_cols.extend(["counts_%s" %(label) for label in sample_labels])
+        for table_name in self.rna_base.rpkm_table_names:
+            rpkm_table_filename = os.path.join(self.rpkm_dir,
+                                               "%s.rpkm.txt" %(table_name))
+            if not os.path.isfile(rpkm_table_filename):
+                continue
+            # Read the table as text so that the entries of the
+            # remaining samples are written back as they were
+            rpkm_table = pandas.read_table(rpkm_table_filename,
+                                           sep="\t",
+                                           dtype=str,
+                                           na_filter=False)
+            kept_cols = [col for col in rpkm_table.columns \
+                         if col not in removed_cols]
+            with utils.atomic_write(rpkm_table_filename) as rpkm_file:
+                rpkm_table[kept_cols].to_csv(rpkm_file,
+                                             sep="\t",
+                                             index=False)
+
+
     def run_on_sample(self, label):
         try:
             self.logger.info("Running on sample: %s" %(label))
@@ -508,9 +895,17 @@ class Pipeline:
                                  %(label))
                 print "Error: Cannot find sample %s" %(label)
                 sys.exit(1)
+            if self.preview is not None:
+                # Run on a subsample of the reads
+                self.logger.info("Subsampling reads")
+                sample = self.subsample_reads(sample)
             # Pre-process the data if needed
             self.logger.info("Preprocessing reads")
             sample = self.preprocess_reads(sample)
+            if self.settings_info["mapping"]["prefilter_rrna"]:
+                # Remove rRNA reads before mapping
+                self.logger.info("Removing rRNA reads")
+                sample = self.prefilter_rrna_reads(sample)
             # Map the data
             self.logger.info("Mapping reads")
             sample = self.map_reads(sample)
@@ -598,9 +993,39 @@ class Pipeline:
         sample.unique_bam_filename = self.sort_and_index_bam(sample.unique_bam_filename)
         # Sort and index the ribosubtracted BAM reads
         sample.ribosub_bam_filename = self.sort_and_index_bam(sample.ribosub_bam_filename)
+        if self.has_umis(sample):
+            # Remove PCR duplicates from the unique reads
+            sample.dedup_bam_filename = self.get_dedup_bam_reads(sample)
         return sample
 
 
+    def has_umis(self, sample):
+        """
+        Return True if the sample's reads have UMIs.
+        """
+        if (sample.sample_type != "clip") or sample.paired:
+            return False
+        return (self.settings_info["mapping"].get("umi_len") is not None) or \
+               self.settings_info["mapping"]["umi_in_header"]
+
+
+    def get_dedup_bam_reads(self, sample):
+        """
+        Remove PCR duplicates from the sorted unique reads BAM
+        file by position and UMI, and create a new BAM file.
+        """
+        self.logger.info("Getting UMI deduplicated BAM file for %s" \
+                         %(sample.label))
+        bam_basename = os.path.basename(sample.unique_bam_filename)
+        dedup_bam_filename = os.path.join(sample.processed_bam_dir,
+                                          "%s.dedup.bam" %(bam_basename[0:-4]))
+        print "Getting UMI deduplicated reads for %s" %(sample.label)
+        print "  - Output file: %s" %(dedup_bam_filename)
+        clip_utils.dedup_bam(sample.unique_bam_filename, dedup_bam_filename)
+        self.index_bam(dedup_bam_filename)
+        return dedup_bam_filename
+
+
     def index_bam(self, bam_filename):
         """
         Index a BAM filename if it's not already indexed.
@@ -742,63 +1167,140 @@ class Pipeline:
         return sample
         
 
-    def compile_qc_output(self):
+    def compile_qc_output(self, samples=None):
         """
         Compile QC output for all samples.
+
+        - samples: if given, add only these samples to the
+          compiled QC output, leaving the entries of all
+          other samples as they are.
         """
-        self.logger.info("Compiling QC output for all samples...")
-        print "Compiling QC output for all samples..."
+        qc_output_filename = os.path.join(self.pipeline_outdirs["qc"],
+                                          "qc_stats.txt")
+        if samples is None:
+            self.logger.info("Compiling QC output for all samples...")
+            print "Compiling QC output for all samples..."
+        else:
+            self.logger.info("Adding QC output for %d samples..." \
+                             %(len(samples)))
+            print "Adding QC output for %d samples..." %(len(samples))
         # Load QC information from existing files
-        self.load_qc()
+        self.load_qc(samples=samples)
         # Get a compiled object representing the QC
         # for all samples in the pipeline
-        qc_stats = qc.QCStats(self.samples,
+        qc_stats = qc.QCStats(samples or self.samples,
                               self.qc_header,
                               self.qc_objects)
         qc_stats.compile_qc()
-        qc_output_filename = os.path.join(self.pipeline_outdirs["qc"],
-                                          "qc_stats.txt")
         print "  - Outputting QC to: %s" %(qc_output_filename)
         self.logger.info("Outputting QC to: %s" %(qc_output_filename))
-        qc_stats.to_csv(qc_output_filename)
+        if samples is None:
+            qc_stats.to_csv(qc_output_filename)
+        else:
+            qc_stats.update_csv(qc_output_filename)
+        # Read length histograms of all samples
+        read_lens_output_filename = os.path.join(self.pipeline_outdirs["qc"],
+                                                 "read_lens.txt")
+        print "  - Outputting read lengths to: %s" %(read_lens_output_filename)
+        qc_stats.read_lens_to_csv(read_lens_output_filename,
+                                  update=(samples is not None))
 
 
-    def compile_analysis_output(self):
+    def compile_analysis_output(self, samples=None):
         """
         Compile analysis output for all samples.
+
+        - samples: if given, add only these samples to the
+          compiled analysis output.
         """
         self.logger.info("Compiling analysis output for all samples...")
         print "Compiling analysis output for all samples..."
         # Compile RPKM results
-        self.compile_rpkms_output()
+        self.compile_rpkms_output(samples=samples)
 
 
-    def compile_rpkms_output(self):
+    def get_rpkm_fieldnames(self, sample_labels):
         """
-        Compile and output RPKMs for all samples.
+        Return the order in which RPKM table columns should be
+        serialized: Gene ID first, followed by gene symbol, the
+        RPKMs and counts for each sample, followed by the gene
+        description and the exons used in the calculation.
         """
-        # Load RPKMs for all samples
-        self.load_rpkms()
-        # Output RPKM tables
-        # Order in which table columns should be serialized:
-        # Gene ID first, followed by gene symbol, the counts for each sample,
-        # followed by the exons used in the calculation and the
-        # gene description
         fieldnames = ["gene_id", "gene_symbol"]
-        fieldnames.extend(["rpkm_%s" %(sample.label) \
-                           for sample in self.samples])
-        fieldnames.extend(["counts_%s" %(sample.label) \
-                           for sample in self.samples])
+        fieldnames.extend(["rpkm_%s" %(label) for label in sample_labels])
+        fieldnames.extend(["counts_%s" %(label) for label in sample_labels])
         fieldnames.extend(["gene_desc", "exons"])
+        return fieldnames
+
+
+    def update_rpkm_table(self, rpkm_table_filename, rpkm_table,
+                          sample_labels):
+        """
+        Add the RPKMs of the given samples to a compiled RPKM
+        table file.
+
+        The columns of all other samples are kept exactly as they
+        appear in the file; columns of the given samples that are
+        already in the file are replaced.
+
+        Return the updated table and its fieldnames.
+        """
+        prev_table = pandas.read_table(rpkm_table_filename,
+                                       sep="\t",
+                                       dtype=str,
+                                       na_filter=False)
+        prev_labels = [col[len("rpkm_"):] for col in prev_table.columns \
+                       if col.startswith("rpkm_")]
+        kept_labels = [label for label in prev_labels \
+                       if label not in sample_labels]
+        kept_cols = ["gene_id", "gene_symbol", "gene_desc", "exons"]
+        kept_cols.extend(["rpkm_%s" %(label) for label in kept_labels])
+        kept_cols.extend(["counts_%s" %(label) for label in kept_labels])
+        new_cols = ["gene_id"]
+        new_cols.extend(["rpkm_%s" %(label) for label in sample_labels])
+        new_cols.extend(["counts_%s" %(label) for label in sample_labels])
+        # Gene information comes from the existing table; only the
+        # new samples' values are brought in
+        updated_table = pandas.merge(prev_table[kept_cols],
+                                     rpkm_table[new_cols],
+                                     on="gene_id",
+                                     how="left")
+        fieldnames = self.get_rpkm_fieldnames(kept_labels + sample_labels)
+        return updated_table, fieldnames
+
+
+    def compile_rpkms_output(self, samples=None):
+        """
+        Compile and output RPKMs for all samples.
+
+        - samples: if given, load RPKMs only for these samples
+          and add them to the existing compiled RPKM tables.
+        """
+        # Load RPKMs for the samples
+        self.load_rpkms(samples=samples)
+        sample_labels = [sample.label for sample in (samples or self.samples)]
+        # Output RPKM tables
+        fieldnames = self.get_rpkm_fieldnames(sample_labels)
         for table_name, rpkm_table in self.rpkm_tables.iteritems():
             if rpkm_table is None: continue
             rpkm_table_filename = os.path.join(self.rpkm_dir,
                                                "%s.rpkm.txt" %(table_name))
-            rpkm_table.to_csv(rpkm_table_filename,
-                              cols=fieldnames,
-                              na_rep=self.na_val,
-                              sep="\t",
-                              index=False)
+            table_fieldnames = fieldnames
+            if (samples is not None) and os.path.isfile(rpkm_table_filename):
+                print "  - Adding %d samples to: %s" %(len(sample_labels),
+                                                      rpkm_table_filename)
+                rpkm_table, table_fieldnames = \
+                    self.update_rpkm_table(rpkm_table_filename,
+                                           rpkm_table,
+                                           sample_labels)
+            # Write atomically so that an interrupted update does
+            # not lose the columns of the other samples
+            with utils.atomic_write(rpkm_table_filename) as rpkm_file:
+                rpkm_table.to_csv(rpkm_file,
+                                  cols=table_fieldnames,
+                                  na_rep=self.na_val,
+                                  sep="\t",
+                                  index=False)
 
 
     def output_rpkms(self, sample):
@@ -815,6 +1317,36 @@ class Pipeline:
         return sample
 
     
+    def get_transcript_coords(self):
+        """
+        Return the coding transcripts (of the ensGene table)
+        that footprints are counted on.
+        """
+        if self.transcript_coords is None:
+            store = self.rna_base.gene_tables["ensGene"].get_transcript_store()
+            self.transcript_coords = \
+                TranscriptStore.get_coding_transcript_coords(store)
+        return self.transcript_coords
+
+
+    def output_footprints(self, sample):
+        """
+        Output the P-site offsets and per-codon footprint
+        density of a riboseq sample.
+        """
+        print "Outputting footprints for sample: %s" %(sample.label)
+        sample_footprints_outdir = os.path.join(self.footprints_dir,
+                                                sample.label)
+        num_processors = self.settings_info["mapping"]["num_processors"]
+        sample.footprint_filenames = \
+            footprint_utils.output_footprints(sample.unique_bam_filename,
+                                              self.get_transcript_coords(),
+                                              sample_footprints_outdir,
+                                              sample.label,
+                                              num_processors=num_processors)
+        return sample
+
+
     def run_analysis(self, sample):
         """
         Run analysis on a sample.
@@ -822,5 +1354,10 @@ class Pipeline:
         # Compute RPKMs
         self.logger.info("Computing RPKMs for sample: %s" %(sample.label))
         self.output_rpkms(sample)
+        if sample.sample_type == "riboseq":
+            # Footprints at codon resolution
+            self.logger.info("Computing footprints for sample: %s" \
+                             %(sample.label))
+            self.output_footprints(sample)
         return sample
         
@@ -9,13 +9,26 @@ import csv
 import rnaseqlib
 import rnaseqlib.fastq_utils as fastq_utils
 import rnaseqlib.mapping.bedtools_utils as bedtools_utils
+import rnaseqlib.mapping.bam_utils as bam_utils
 import rnaseqlib.utils as utils
+import rnaseqlib.clip.clip_utils as clip_utils
+import rnaseqlib.rrna_utils as rrna_utils
+import rnaseqlib.ribo.ribo_utils as ribo_utils
+import rnaseqlib.ribo.footprint_utils as footprint_utils
 
+import numpy
 import pandas
 import pysam
 
 from collections import defaultdict
 
+# Read length histograms of a sample: of all reads, and of mapped,
+# uniquely mapped and rRNA reads
+READ_LEN_FIELDS = ["num_reads",
+                   "num_mapped",
+                   "num_unique_mapped",
+                   "num_ribo"]
+
 
 class QualityControl:
     """ 
@@ -45,6 +58,20 @@ class QualityControl:
         self.qc_header = ["num_reads", 
                           "num_mapped",
                           "num_unique_mapped"] + self.qc_stats_header + self.regions_header
+        if self.pipeline.has_umis(self.sample):
+            # Duplication rate of reads with UMIs
+            self.qc_header += ["num_dedup", "percent_duplicates"]
+        if self.settings_info["mapping"]["prefilter_rrna"]:
+            # Fraction of reads removed as rRNA before mapping
+            self.qc_header += ["percent_rrna_prefiltered"]
+        if self.sample.sample_type == "riboseq":
+            # Reads kept and removed by preprocessing
+            if self.sample.paired:
+                self.qc_header += fastq_utils.PAIRED_STATS_HEADER
+            else:
+                self.qc_header += ribo_utils.TRIMMING_QC_HEADER
+            # Frame distribution and 3-nt periodicity of footprints
+            self.qc_header += footprint_utils.PERIODICITY_STATS_HEADER
         # QC results
         self.na_val = "NA"
         self.qc_results = defaultdict(lambda: self.na_val)
@@ -59,7 +86,15 @@ class QualityControl:
         utils.make_dir(self.regions_outdir)
         self.qc_filename = os.path.join(self.sample_outdir,
                                         "%s.qc.txt" %(self.sample.label))
+        # Read length histograms, by READ_LEN_FIELDS
+        self.read_len_hists = {}
+        self.read_lens_filename = \
+            os.path.join(self.sample_outdir,
+                         "%s.read_lens.txt" %(self.sample.label))
         self.qc_loaded = False
+        # Number of processors to use for counting BAM reads
+        self.num_processors = \
+            self.settings_info["mapping"]["num_processors"]
         # use ensGene gene table for QC computations
         self.gene_table = self.pipeline.rna_base.gene_tables["ensGene"]
         # Load QC information if file corresponding to sample already exists
@@ -92,29 +127,37 @@ class QualityControl:
         pair of numbers: 'num_left_mate,num_right_mate'
         """
         self.logger.info("Getting number of reads.")
+        # The read length histogram is computed in the same pass
         if self.sample.paired:
             self.logger.info("Getting number of paired-end reads.")
-            # Paired-end
+            # Paired-end: the histogram counts the reads of both mates
             mate_reads = []
             for mate_rawdata in self.sample.rawdata:
-                num_reads = 0
-                fastq_entries = \
-                    fastq_utils.get_fastq_entries(mate_rawdata.reads_filename)
-                for entry in fastq_entries:
-                    num_reads += 1
+                num_reads, read_len_hist = \
+                    ribo_utils.compute_read_len_dist(mate_rawdata.reads_filename)
                 mate_reads.append(num_reads)
+                self.add_read_len_hist("num_reads", read_len_hist)
             pair_num_reads = ",".join(map(str, mate_reads))
             return pair_num_reads
         else:
             self.logger.info("Getting number of single-end reads.")
-            num_reads = 0
             # Single-end
-            fastq_entries = \
-                fastq_utils.get_fastq_entries(self.sample.rawdata.reads_filename)
-            for entry in fastq_entries:
-                num_reads += 1
+            num_reads, read_len_hist = \
+                ribo_utils.compute_read_len_dist(self.sample.rawdata.reads_filename)
+            self.add_read_len_hist("num_reads", read_len_hist)
             return num_reads
 
+
+    def add_read_len_hist(self, field, read_len_hist):
+        """
+        Add to the read length histogram of a field (see
+        READ_LEN_FIELDS.)
+        """
+        if field in self.read_len_hists:
+            self.read_len_hists[field] = self.read_len_hists[field] + read_len_hist
+        else:
+            self.read_len_hists[field] = read_len_hist
+
             
     def get_num_mapped(self):
         """
@@ -122,14 +165,19 @@ class QualityControl:
         reads that have alignments in the BAM file.
         """
         self.logger.info("Getting number of mapped reads.")        
-        num_mapped = count_nondup_reads(self.sample.bam_filename)
+        num_mapped, read_len_hist = \
+            count_nondup_read_lens(self.sample.bam_filename,
+                                   num_processors=self.num_processors)
+        self.add_read_len_hist("num_mapped", read_len_hist)
         return num_mapped
 
 
     def get_num_unique_mapped(self):
         self.logger.info("Getting number of unique reads.")
-        num_unique_mapped = \
-            count_nondup_reads(self.sample.unique_bam_filename)
+        num_unique_mapped, read_len_hist = \
+            count_nondup_read_lens(self.sample.unique_bam_filename,
+                                   num_processors=self.num_processors)
+        self.add_read_len_hist("num_unique_mapped", read_len_hist)
         return num_unique_mapped
     
 
@@ -158,7 +206,8 @@ class QualityControl:
                                    end=None)
         # Count reads (fetch returns an iterator)
         # Do not count duplicates
-        num_ribo = count_nondup_reads(ribo_reads)
+        num_ribo, read_len_hist = count_nondup_read_lens(ribo_reads)
+        self.add_read_len_hist("num_ribo", read_len_hist)
         return num_ribo
 
 
@@ -351,6 +400,66 @@ class QualityControl:
             self.qc_results[stat_name] = stat_func()
         
 
+    def compute_dedup_qc(self):
+        """
+        Load the duplication rate of reads with UMIs.
+        """
+        self.logger.info("Getting UMI deduplication stats.")
+        dedup_stats = \
+            clip_utils.load_dedup_stats(\
+                clip_utils.get_dedup_stats_filename(self.sample.dedup_bam_filename))
+        self.qc_results["num_dedup"] = dedup_stats["num_dedup"]
+        self.qc_results["percent_duplicates"] = dedup_stats["percent_duplicates"]
+
+
+    def compute_rrna_prefilter_qc(self):
+        """
+        Load the fraction of reads removed as rRNA before mapping.
+        """
+        self.logger.info("Getting rRNA prefilter stats.")
+        rrna_stats = rrna_utils.load_rrna_stats(self.sample.rrna_stats_filename)
+        self.qc_results["percent_rrna_prefiltered"] = rrna_stats["percent_rrna"]
+
+
+    def compute_preprocessing_qc(self):
+        """
+        Load the statistics of trimming (or, for paired-end
+        samples, of preprocessing) the reads before mapping.
+        """
+        self.logger.info("Getting read preprocessing stats.")
+        if self.sample.paired_stats_filename is not None:
+            stats_filename = self.sample.paired_stats_filename
+            stats_fields = fastq_utils.PAIRED_STATS_HEADER
+            load_stats = fastq_utils.load_paired_stats
+        else:
+            stats_filename = self.sample.trimming_stats_filename
+            stats_fields = ribo_utils.TRIMMING_QC_HEADER
+            load_stats = ribo_utils.load_trimming_stats
+        if not os.path.isfile(stats_filename):
+            print "WARNING: Cannot find preprocessing stats %s" \
+                %(stats_filename)
+            return
+        preprocessing_stats = load_stats(stats_filename)
+        for stat in stats_fields:
+            self.qc_results[stat] = preprocessing_stats[stat]
+
+
+    def compute_ribo_qc(self):
+        """
+        Compute the metagene profiles and frame distribution of
+        the footprints of a riboseq sample.
+        """
+        self.logger.info("Computing Ribo-Seq periodicity.")
+        # Footprints are counted once, for both QC and analysis
+        self.pipeline.output_footprints(self.sample)
+        periodicity_stats = \
+            footprint_utils.output_ribo_qc(self.sample.footprint_filenames,
+                                           self.sample_outdir,
+                                           self.sample.label)
+        for stat in footprint_utils.PERIODICITY_STATS_HEADER:
+            self.qc_results[stat] = periodicity_stats[stat]
+
+
     def compute_qc(self):
         """
         Compute all QC metrics for sample.
@@ -368,6 +477,15 @@ class QualityControl:
             self.compute_regions()
             # Compute statistics from these results
             self.compute_qc_stats()
+            if self.sample.dedup_bam_filename is not None:
+                self.compute_dedup_qc()
+            if self.sample.rrna_stats_filename is not None:
+                self.compute_rrna_prefilter_qc()
+            if (self.sample.trimming_stats_filename is not None) or \
+               (self.sample.paired_stats_filename is not None):
+                self.compute_preprocessing_qc()
+            if self.sample.sample_type == "riboseq":
+                self.compute_ribo_qc()
         # Set that QC results were loaded
         self.qc_loaded = True
         return self.qc_results
@@ -377,6 +495,10 @@ class QualityControl:
         """
         Output QC metrics for sample.
         """
+        if (len(self.read_len_hists) > 0) and \
+           (not os.path.isfile(self.read_lens_filename)):
+            output_read_len_hists(self.read_len_hists,
+                                  self.read_lens_filename)
         if os.path.isfile(self.qc_filename):
             print "SKIPPING %s, since %s already exists..." %(self.sample.label,
                                                               self.qc_filename)
@@ -450,6 +572,60 @@ class QCStats:
         self.to_csv(output_filename)
 
 
+    def compile_read_lens(self):
+        """
+        Combine the read length histograms of the samples into
+        one table, with a row per sample and read length.
+        Samples with no histograms are left out.
+        """
+        read_lens_tables = []
+        for sample in self.samples:
+            read_lens_filename = \
+                self.qc_objects[sample.label].read_lens_filename
+            if not os.path.isfile(read_lens_filename):
+                print "WARNING: Could not find read lengths of %s" \
+                    %(sample.label)
+                continue
+            read_lens_table = load_read_len_hists(read_lens_filename)
+            read_lens_table.insert(0, self.sample_header, sample.label)
+            read_lens_tables.append(read_lens_table)
+        if len(read_lens_tables) == 0:
+            return None
+        return pandas.concat(read_lens_tables, ignore_index=True)
+
+
+    def read_lens_to_csv(self, output_filename, update=False):
+        """
+        Output the compiled read length histograms.
+
+        - update: if True, add the histograms of this object's
+          samples to an existing file, replacing the entries of
+          samples that are already in it.
+        """
+        read_lens_table = self.compile_read_lens()
+        if read_lens_table is None:
+            return None
+        if update and os.path.isfile(output_filename):
+            prev_table = pandas.read_table(output_filename,
+                                           sep="\t",
+                                           dtype={self.sample_header: str})
+            new_labels = [sample.label for sample in self.samples]
+            prev_table = \
+                prev_table[~prev_table[self.sample_header].isin(new_labels)]
+            read_lens_table = pandas.concat([prev_table, read_lens_table],
+                                            ignore_index=True)
+        output_header = [self.sample_header, "read_len"] + \
+                        [field for field in READ_LEN_FIELDS \
+                         if field in read_lens_table.columns]
+        with utils.atomic_write(output_filename) as read_lens_file:
+            read_lens_table[output_header].to_csv(read_lens_file,
+                                                  sep="\t",
+                                                  index=False,
+                                                  na_rep="0",
+                                                  float_format="%d")
+        return output_filename
+
+
     def compile_qc(self):
         """
         Combined the QC output of a given set of samples
@@ -485,26 +661,158 @@ class QCStats:
                              index=False,
                              cols=output_header)
 
+
+    def update_csv(self, output_filename):
+        """
+        Add the QC of this object's samples to an existing
+        QC file. Entries of other samples in the file are left
+        as they are; entries of samples that are already in the
+        file are replaced.
+
+        The new entries follow the header of the existing file.
+        """
+        if not os.path.isfile(output_filename):
+            return self.to_csv(output_filename)
+        qc_file = open(output_filename, "r")
+        qc_lines = qc_file.readlines()
+        qc_file.close()
+        if len(qc_lines) == 0:
+            return self.to_csv(output_filename)
+        output_header = qc_lines[0].rstrip("\n").split("\t")
+        new_labels = dict([(label, True) for label in \
+                           self.qc_stats[self.sample_header]])
+        # Existing entries of the samples we're adding
+        replaced_lines = [line for line in qc_lines[1:] \
+                          if line.split("\t", 1)[0] in new_labels]
+        for col in output_header:
+            if col not in self.qc_stats.columns:
+                print "WARNING: Could not find column %s in QC stats " \
+                      "of added samples." %(col)
+        # Rewrite the file atomically, keeping the entries of all
+        # other samples, so that an interrupted update does not
+        # lose them
+        with utils.atomic_write(output_filename) as qc_out:
+            qc_out.writelines([line for line in qc_lines \
+                               if line not in replaced_lines])
+            self.qc_stats.to_csv(qc_out,
+                                 sep="\t",
+                                 index=False,
+                                 header=False,
+                                 cols=output_header)
+
 ##
 ## Misc. QC functions
 ##
-def count_nondup_reads(bam_in):
+def remove_samples_from_csv(output_filename, sample_labels):
+    """
+    Remove the entries of the given samples from a compiled QC
+    file (whose first column is the sample label.) Entries of
+    other samples are left as they are.
+    """
+    qc_file = open(output_filename, "r")
+    qc_lines = qc_file.readlines()
+    qc_file.close()
+    if len(qc_lines) == 0:
+        return output_filename
+    removed_labels = dict([(label, True) for label in sample_labels])
+    with utils.atomic_write(output_filename) as qc_out:
+        qc_out.write(qc_lines[0])
+        qc_out.writelines([line for line in qc_lines[1:] \
+                           if line.split("\t", 1)[0] not in removed_labels])
+    return output_filename
+
+
+def output_read_len_hists(read_len_hists, output_filename):
+    """
+    Output the read length histograms of a sample (see
+    READ_LEN_FIELDS) as a table with a row per read length, up
+    to the longest read.
+    """
+    fields = [field for field in READ_LEN_FIELDS \
+              if field in read_len_hists]
+    hists = numpy.array([read_len_hists[field] for field in fields])
+    nonzero_lens = numpy.flatnonzero(hists.sum(axis=0))
+    num_lens = 1
+    if len(nonzero_lens) > 0:
+        num_lens = nonzero_lens[-1] + 1
+    read_lens_table = pandas.DataFrame(hists[:, 0:num_lens].T,
+                                       columns=fields)
+    read_lens_table.insert(0, "read_len", numpy.arange(num_lens))
+    with utils.atomic_write(output_filename) as read_lens_file:
+        read_lens_table.to_csv(read_lens_file,
+                               sep="\t",
+                               index=False)
+    return output_filename
+
+
+def load_read_len_hists(read_lens_filename):
+    """
+    Load the read length histograms of a sample as a table.
+    """
+    return pandas.read_table(read_lens_filename, sep="\t")
+
+
+def add_read_lens(qname_lens, bam_reads):
+    """
+    Record the lengths of the mapped reads of a stream by their
+    read ID. Unmapped reads are skipped, as they are when
+    counting the references of an indexed BAM in parallel
+    (see bam_utils.qname_lens_kernel.)
+    """
+    for read in bam_reads:
+        if read.is_unmapped:
+            continue
+        qname_lens[read.qname] = read.rlen
+
+
+def count_nondup_read_lens(bam_in, num_processors=1):
     """
     Return number of BAM reads that appear in the file, excluding
-    duplicates (i.e. only count unique read ids/QNAMEs.)
+    duplicates (i.e. only count unique read ids/QNAMEs), and the
+    histogram of the lengths of the reads (see
+    fastq_utils.get_read_len_hist.)
 
-    Takes a filename or a stream.
+    Takes a filename or a stream. Collapsed reads are counted
+    as the number of reads they stand for.
+
+    If given an indexed BAM filename and more than one processor,
+    count the references of the BAM in parallel.
     """
-    bam_reads = bam_in
+    qname_lens = {}
     if isinstance(bam_in, basestring):
         # We're passed a filename
         if not os.path.isfile(bam_in):
             print "WARNING: Could not find BAM file %s" %(bam_in)
-            return 0
+            return 0, fastq_utils.get_read_len_hist([])
+        elif (num_processors > 1) and bam_utils.is_bam_indexed(bam_in):
+            qname_lens = \
+                bam_utils.map_reduce_bam(bam_in,
+                                         bam_utils.qname_lens_kernel,
+                                         num_processors=num_processors,
+                                         reducer=bam_utils.merge_qname_lens)
+            if qname_lens is None:
+                qname_lens = {}
         else:
-            bam_reads = pysam.Samfile(bam_in, "rb")
-    bam_reads_ids = {}
-    for read in bam_reads:
-        bam_reads_ids[read.qname] = True
-    num_reads = len(bam_reads_ids.keys())
-    return num_reads
+            bam_file = pysam.Samfile(bam_in, "rb")
+            add_read_lens(qname_lens, bam_file)
+            bam_file.close()
+    else:
+        add_read_lens(qname_lens, bam_in)
+    weights = numpy.array([clip_utils.get_collapsed_count(qname) \
+                           for qname in qname_lens],
+                          dtype=numpy.int64)
+    read_lens = numpy.fromiter(qname_lens.itervalues(),
+                               dtype=numpy.int64,
+                               count=len(qname_lens))
+    return int(weights.sum()), \
+           fastq_utils.get_read_len_hist(read_lens, weights=weights)
+
+
+def count_nondup_reads(bam_in, num_processors=1):
+    """
+    Return number of BAM reads that appear in the file, excluding
+    duplicates (i.e. only count unique read ids/QNAMEs.)
+
+    See count_nondup_read_lens.
+    """
+    return count_nondup_read_lens(bam_in, num_processors=num_processors)[0]
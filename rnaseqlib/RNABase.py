@@ -11,6 +11,7 @@ import csv
 import rnaseqlib
 import rnaseqlib.init as init
 import rnaseqlib.utils as utils
+import rnaseqlib.fasta_utils as fasta_utils
 import rnaseqlib.tables as tables
 from rnaseqlib.init import download_seqs
 
@@ -30,7 +31,10 @@ class RNABase:
         ## Gene table names for various tasks
         ##
         self.ucsc_tables_dir = None
-        # Tables to use for RPKM computation
+        # Tables to use for RPKM computation. Any gene table
+        # supported by tables.GeneTable can be listed
+        # ("ensGene", "knownGene", "refSeq"), along with its
+        # CDS-only version (e.g. "refSeq.cds_only")
         self.gene_table_names = ["ensGene"]#, "refSeq"]
         self.rpkm_table_names = ["ensGene",
                                  "ensGene.cds_only"]
@@ -120,16 +124,25 @@ class RNABase:
                                          self.output_dir)
         
 
-    def download_tables(self):
+    def download_tables(self, num_processors=1,
+                        output_combined=False):
         """
         Download all necessary tables.
+
+        - num_processors: number of processes to download
+          and process tables with
+        - output_combined: if True, also output the combined
+          ensGene tables
         """
         print "Fetching tables.."
         # Download and process UCSC tables
         tables.download_ucsc_tables(self.genome,
-                                    self.output_dir)
+                                    self.output_dir,
+                                    num_processors=num_processors)
         tables.process_ucsc_tables(self.genome,
-                                   self.output_dir)
+                                   self.output_dir,
+                                   num_processors=num_processors,
+                                   output_combined=output_combined)
 
 
     def build_indices(self):
@@ -196,14 +209,39 @@ class RNABase:
         return fasta_files
 
 
-    def initialize(self):
+    def get_rrna_fasta_filename(self):
+        """
+        Return the FASTA filename of the rRNA sequence.
+        """
+        return os.path.join(self.output_dir, "misc", "chrRibo.fa")
+
+
+    def get_genome_fasta(self, use_2bit=False):
+        """
+        Return an IndexedFasta of the genome and misc.
+        sequences, for fetching regions of them.
+
+        - use_2bit: fetch from a 2-bit packed cache of
+          the sequences
+        """
+        return fasta_utils.IndexedFasta(self.get_bowtie_index_fasta_files(),
+                                        use_2bit=use_2bit)
+
+
+    def initialize(self, num_processors=1,
+                   output_combined=False):
         """
         Main driver function. Initialize the pipeline
         for a given genome.
+
+        - num_processors: number of processes to use
+        - output_combined: if True, also output the combined
+          ensGene tables
         """
         print "Initializing RNA base..."
         self.download_seqs()
-        self.download_tables()
+        self.download_tables(num_processors=num_processors,
+                             output_combined=output_combined)
         self.build_indices()
         
         
@@ -0,0 +1,320 @@
+##
+## Utilities for BGZF compressed files and tabix indices
+##
+## BGZF is gzip made of independent blocks of at most 64 KB, so
+## that a position in the file can be given as a 'virtual offset':
+##
+##   (offset of the block in the compressed file << 16) |
+##   (offset within the uncompressed block)
+##
+## A tabix index (.tbi) maps genomic regions to virtual offsets,
+## so that tools such as tabix and IGV can fetch the records of
+## a region without reading the whole file.
+##
+import os
+import sys
+import time
+import struct
+import zlib
+
+import numpy
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+
+# Uncompressed size of a full BGZF block (as in bgzip)
+BGZF_BLOCK_SIZE = 0xff00
+
+# Empty block that marks the end of a BGZF file
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43" \
+           "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+# Tabix column settings for supported formats:
+# (format, sequence column, start column, end column, meta character)
+# Format flag 0x10000 means starts are 0-based (as in BED)
+TABIX_PRESETS = {"gff": (0, 1, 4, 5, "#"),
+                 "bed": (0x10000, 1, 2, 3, "#")}
+
+# Size of tabix linear index windows (in bits)
+TABIX_LINEAR_SHIFT = 14
+
+
+def make_bgzf_block(data, level=6):
+    """
+    Compress 'data' (at most BGZF_BLOCK_SIZE bytes) into
+    a BGZF block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    # Block size minus one, counting the 25 bytes of
+    # header and footer
+    block_size = len(compressed) + 25
+    header = struct.pack("<4BI2BH2BHH",
+                         31, 139, 8, 4, 0, 0, 255,
+                         6, 66, 67, 2, block_size)
+    footer = struct.pack("<2I",
+                         zlib.crc32(data) & 0xffffffff,
+                         len(data))
+    return header + compressed + footer
+
+
+class BgzfWriter:
+    """
+    Write a BGZF compressed file.
+
+    Every block except the last holds exactly BGZF_BLOCK_SIZE
+    uncompressed bytes, so the virtual offset of any uncompressed
+    position can be computed from the block offsets after the
+    file is written (see get_virtual_offsets.)
+    """
+    def __init__(self, filename, level=6):
+        self.filename = filename
+        self.level = level
+        self.out_file = open(filename, "wb")
+        self.buffer = []
+        self.buffer_size = 0
+        # Offsets of the blocks in the compressed file
+        # (including the end of file block once closed)
+        self.block_offsets = []
+        self.compressed_size = 0
+
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= BGZF_BLOCK_SIZE:
+            self.flush_blocks()
+
+
+    def flush_blocks(self, flush_all=False):
+        """
+        Compress and write out the full blocks in the buffer
+        (and the partial last block if 'flush_all' is True.)
+        """
+        data = "".join(self.buffer)
+        num_full = len(data) / BGZF_BLOCK_SIZE
+        for block_num in xrange(num_full):
+            self.write_block(data[block_num * BGZF_BLOCK_SIZE:\
+                                  (block_num + 1) * BGZF_BLOCK_SIZE])
+        data = data[num_full * BGZF_BLOCK_SIZE:]
+        if flush_all and (len(data) > 0):
+            self.write_block(data)
+            data = ""
+        self.buffer = [data]
+        self.buffer_size = len(data)
+
+
+    def write_block(self, data):
+        block = make_bgzf_block(data, level=self.level)
+        self.block_offsets.append(self.compressed_size)
+        self.out_file.write(block)
+        self.compressed_size += len(block)
+
+
+    def tell(self):
+        """
+        Return the virtual offset of the current position.
+        """
+        return (self.compressed_size << 16) | self.buffer_size
+
+
+    def close(self):
+        self.flush_blocks(flush_all=True)
+        self.block_offsets.append(self.compressed_size)
+        self.out_file.write(BGZF_EOF)
+        self.out_file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_virtual_offsets(block_offsets, positions):
+    """
+    Return the virtual offsets of uncompressed positions in a
+    file written (and closed) by BgzfWriter, given its block
+    offsets.
+
+    A position at the end of a full block is given as the start
+    of the next block.
+    """
+    positions = numpy.asarray(positions, dtype=numpy.int64)
+    block_offsets = numpy.asarray(block_offsets, dtype=numpy.uint64)
+    block_nums = positions / BGZF_BLOCK_SIZE
+    within_offsets = positions % BGZF_BLOCK_SIZE
+    return (block_offsets[block_nums] << numpy.uint64(16)) | \
+           within_offsets.astype(numpy.uint64)
+
+
+##
+## Tabix index
+##
+def reg2bin(starts, ends):
+    """
+    Return the UCSC/tabix bins of 0-based, end-exclusive
+    intervals (vectorized reg2bin of the SAM specification.)
+    """
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    last = numpy.asarray(ends, dtype=numpy.int64) - 1
+    bins = numpy.zeros(len(starts), dtype=numpy.int64)
+    assigned = numpy.zeros(len(starts), dtype=bool)
+    for shift, bin_offset in [(14, 4681), (17, 585), (20, 73),
+                              (23, 9), (26, 1)]:
+        in_level = (~assigned) & ((starts >> shift) == (last >> shift))
+        bins[in_level] = bin_offset + (starts[in_level] >> shift)
+        assigned |= in_level
+    return bins
+
+
+def get_tabix_refs(chroms):
+    """
+    Return the references of a sorted file in order of
+    appearance, and the reference number of every record.
+    Records of a reference must be contiguous.
+    """
+    chroms = numpy.asarray(chroms)
+    ref_firsts = numpy.ones(len(chroms), dtype=bool)
+    ref_firsts[1:] = (chroms[1:] != chroms[:-1])
+    ref_names = chroms[ref_firsts]
+    if len(set(ref_names)) != len(ref_names):
+        raise Exception, "Cannot index: records are not sorted " \
+                         "by chromosome."
+    ref_nums = numpy.cumsum(ref_firsts) - 1
+    return ref_names, ref_nums
+
+
+def write_tabix_index(index_filename, chroms, starts, ends,
+                      record_offsets, record_end_offsets,
+                      preset="bed"):
+    """
+    Write a tabix index for the records of a sorted BGZF file.
+
+    - chroms, starts, ends: coordinates of the records,
+      as 0-based, end-exclusive intervals
+    - record_offsets, record_end_offsets: virtual offsets of
+      the start and end of every record
+    - preset: format of the records (see TABIX_PRESETS)
+    """
+    if preset not in TABIX_PRESETS:
+        raise Exception, "Unknown tabix preset %s" %(preset)
+    file_format, col_seq, col_beg, col_end, meta_char = \
+        TABIX_PRESETS[preset]
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.maximum(numpy.asarray(ends, dtype=numpy.int64),
+                         starts + 1)
+    record_offsets = numpy.asarray(record_offsets, dtype=numpy.uint64)
+    record_end_offsets = numpy.asarray(record_end_offsets,
+                                       dtype=numpy.uint64)
+    ref_names, ref_nums = get_tabix_refs(chroms)
+    bins = reg2bin(starts, ends)
+    names_data = "".join(["%s\0" %(name) for name in ref_names])
+    index_data = [struct.pack("<4s6i", "TBI\1", len(ref_names),
+                              file_format, col_seq, col_beg, col_end,
+                              ord(meta_char)),
+                  struct.pack("<2i", 0, len(names_data)),
+                  names_data]
+    ref_bounds = numpy.searchsorted(ref_nums,
+                                    numpy.arange(len(ref_names) + 1))
+    for ref_num in xrange(len(ref_names)):
+        first, last = ref_bounds[ref_num], ref_bounds[ref_num + 1]
+        ref_bins = bins[first:last]
+        # Consecutive records in the same bin form one chunk
+        run_firsts = numpy.ones(len(ref_bins), dtype=bool)
+        run_firsts[1:] = (ref_bins[1:] != ref_bins[:-1])
+        run_starts = numpy.flatnonzero(run_firsts)
+        run_ends = numpy.append(run_starts[1:], len(ref_bins)) - 1
+        chunks_by_bin = {}
+        for run_start, run_end in zip(run_starts, run_ends):
+            chunks_by_bin.setdefault(ref_bins[run_start], []).append(\
+                (record_offsets[first + run_start],
+                 record_end_offsets[first + run_end]))
+        index_data.append(struct.pack("<i", len(chunks_by_bin)))
+        for bin_num in sorted(chunks_by_bin):
+            chunks = chunks_by_bin[bin_num]
+            index_data.append(struct.pack("<Ii", bin_num, len(chunks)))
+            index_data.append(numpy.array(chunks,
+                                          dtype="<u8").tostring())
+        # Linear index: smallest offset of the records that
+        # overlap each 16 KB window
+        first_windows = starts[first:last] >> TABIX_LINEAR_SHIFT
+        last_windows = (ends[first:last] - 1) >> TABIX_LINEAR_SHIFT
+        num_windows = int(last_windows.max()) + 1
+        window_counts = last_windows - first_windows + 1
+        windows = numpy.repeat(first_windows, window_counts) + \
+                  (numpy.arange(window_counts.sum()) - \
+                   numpy.repeat(numpy.cumsum(window_counts) - window_counts,
+                                window_counts))
+        no_offset = numpy.iinfo(numpy.uint64).max
+        linear_index = numpy.repeat(numpy.uint64(no_offset), num_windows)
+        numpy.minimum.at(linear_index, windows,
+                         numpy.repeat(record_offsets[first:last],
+                                      window_counts))
+        # Empty windows take the offset of the window before
+        # them (windows before the first record are left at 0)
+        filled = numpy.where(linear_index == no_offset,
+                             0, numpy.arange(num_windows))
+        linear_index = linear_index[numpy.maximum.accumulate(filled)]
+        linear_index[linear_index == no_offset] = 0
+        index_data.append(struct.pack("<i", num_windows))
+        index_data.append(linear_index.astype("<u8").tostring())
+    index_writer = BgzfWriter(index_filename)
+    index_writer.write("".join(index_data))
+    index_writer.close()
+    return index_filename
+
+
+def output_indexed_lines(output_filename, lines,
+                         chroms, starts, ends,
+                         preset="bed",
+                         header=""):
+    """
+    Output text lines as a BGZF file with a tabix index
+    ('output_filename'.tbi.)
+
+    - lines: lines of the records (ending in newlines)
+    - chroms, starts, ends: coordinates of the records as
+      0-based, end-exclusive intervals. Records are sorted
+      by chromosome and start before being written.
+    - preset: format of the records (see TABIX_PRESETS)
+    - header: text to write before the records
+    """
+    t1 = time.time()
+    chroms = numpy.asarray(chroms)
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    order = numpy.lexsort([ends, starts, chroms])
+    sorted_lines = [lines[ind] for ind in order]
+    line_ends = len(header) + \
+                numpy.cumsum([len(line) for line in sorted_lines],
+                             dtype=numpy.int64)
+    line_starts = line_ends - numpy.array([len(line) for line \
+                                           in sorted_lines],
+                                          dtype=numpy.int64)
+    tmp_filename = utils.get_tmp_filename(output_filename)
+    bgzf_writer = BgzfWriter(tmp_filename)
+    bgzf_writer.write(header)
+    # Write in chunks of full blocks
+    chunk_size = 10000
+    for chunk_start in xrange(0, len(sorted_lines), chunk_size):
+        bgzf_writer.write("".join(sorted_lines[chunk_start:\
+                                               chunk_start + chunk_size]))
+    bgzf_writer.close()
+    index_filename = "%s.tbi" %(output_filename)
+    write_tabix_index(utils.get_tmp_filename(index_filename),
+                      chroms[order],
+                      starts[order],
+                      ends[order],
+                      get_virtual_offsets(bgzf_writer.block_offsets,
+                                          line_starts),
+                      get_virtual_offsets(bgzf_writer.block_offsets,
+                                          line_ends),
+                      preset=preset)
+    os.rename(tmp_filename, output_filename)
+    os.rename(utils.get_tmp_filename(index_filename), index_filename)
+    t2 = time.time()
+    print "Wrote indexed %s in %.2f secs" %(output_filename, t2 - t1)
+    return output_filename
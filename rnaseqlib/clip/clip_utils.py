@@ -1,8 +1,442 @@
 ##
 ## CLIP utilities
 ##
+## Collapsing of identical reads: CLIP and Ribo-Seq libraries are
+## dominated by identical short reads, so they are collapsed into
+## unique sequences before mapping. A collapsed read is named
+##
+##   collapsed<number>_x<count>
+##
+## where count is the number of reads with its sequence, so
+## that counts can be expanded back after mapping from the read
+## names (see get_read_weight.)
+##
+## PCR duplicates are removed using unique molecular identifiers
+## (UMIs). The UMI of a read is moved from its sequence or header
+## to the end of its name during preprocessing:
+##
+##   <name>_<UMI>
+##
+## and mapped reads are deduplicated by chromosome, strand, 5'
+## position and UMI.
+##
+import os
+import sys
+import time
+import re
+import heapq
+
+from collections import deque
+from itertools import groupby, izip
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.fastq_utils as fastq_utils
+
+COLLAPSED_NAME_RE = re.compile(r"^collapsed\d+_x(\d+)$")
+
+# Tag holding the UMI of deduplicated reads
+UMI_TAG = "RX"
+
+# Summary statistics of UMI deduplication
+DEDUP_STATS_HEADER = ["num_umi_reads",
+                      "num_dedup",
+                      "percent_duplicates"]
+
+
 def trim_clip_adaptors():
     """
     Trim CLIP adaptors.
     """
     pass
+
+
+def get_collapsed_name(seq_num, count):
+    """
+    Return the name of a collapsed read.
+    """
+    return "collapsed%d_x%d" %(seq_num, count)
+
+
+def get_collapsed_count(read_name):
+    """
+    Return the number of reads a read stands for: its count
+    if it is a collapsed read, or else 1.
+    """
+    if read_name.startswith("@") or read_name.startswith(">"):
+        read_name = read_name[1:]
+    name_match = COLLAPSED_NAME_RE.match(read_name.split(None, 1)[0])
+    if name_match is None:
+        return 1
+    return int(name_match.group(1))
+
+
+def get_read_weight(read):
+    """
+    Return the number of reads a BAM read stands for, for
+    weight-aware counting of collapsed reads.
+    """
+    return get_collapsed_count(read.qname)
+
+
+def output_collapsed_run(seq_counts, run_filename):
+    """
+    Write a run of collapsed sequences, sorted by sequence,
+    as 'seq<TAB>count<TAB>qual' lines.
+    """
+    run_file = open(run_filename, "w")
+    for seq in sorted(seq_counts):
+        count, qual = seq_counts[seq]
+        run_file.write("%s\t%d\t%s\n" %(seq, count, qual))
+    run_file.close()
+
+
+def parse_collapsed_line(line):
+    seq, count, qual = line.rstrip("\n").split("\t")
+    return seq, int(count), qual
+
+
+def merge_collapsed_runs(run_files):
+    """
+    Merge sorted runs of collapsed sequences, yielding
+    (seq, count, qual) for each unique sequence in sorted
+    order. The quality of a sequence is taken from its
+    first run.
+    """
+    # Runs are sorted by sequence, so the entries of a
+    # sequence are adjacent in the merged runs
+    merged_lines = heapq.merge(*[(parse_collapsed_line(line) \
+                                  for line in run_file) \
+                                 for run_file in run_files])
+    for seq, seq_entries in groupby(merged_lines, key=lambda entry: entry[0]):
+        seq_entries = list(seq_entries)
+        yield seq, sum([entry[1] for entry in seq_entries]), seq_entries[0][2]
+
+
+def collapse_reads(fastq_filename, output_dir,
+                   output_format="fastq",
+                   max_unique_seqs=2000000,
+                   batch_size=100000):
+    """
+    Collapse the identical sequences of a FASTQ file into
+    unique sequences with counts.
+
+    - fastq_filename: FASTQ file (possibly gzipped)
+    - output_dir: output directory
+    - output_format: 'fastq' (keeping the qualities of the
+      first read of each sequence) or 'fasta'
+    - max_unique_seqs: maximum number of unique sequences
+      to count in memory. Past that, counts are spilled to
+      sorted runs on disk and merged at the end.
+
+    Unique sequences are written in sorted order, named by
+    get_collapsed_name, to '<basename>.collapsed.<format>'.
+    Also writes the number of reads and of unique sequences
+    to '<basename>.collapsed.stats.txt'.
+    """
+    if output_format not in ("fastq", "fasta"):
+        raise Exception, "Unknown collapsed output format %s" %(output_format)
+    basename = fastq_utils.get_fastq_basename(fastq_filename)
+    output_filename = os.path.join(output_dir,
+                                   "%s.collapsed.%s" %(basename,
+                                                       output_format))
+    stats_filename = os.path.join(output_dir,
+                                  "%s.collapsed.stats.txt" %(basename))
+    if os.path.isfile(output_filename):
+        print "SKIPPING: %s already exists!" %(output_filename)
+        return output_filename
+    print "Collapsing reads from: %s" %(fastq_filename)
+    t1 = time.time()
+    # Mapping from sequence to [count, qual]
+    seq_counts = {}
+    run_filenames = []
+    num_reads = 0
+    fastq_file = fastq_utils.read_open_fastq(fastq_filename)
+    for headers, seqs, headers2, quals in \
+        fastq_utils.read_fastq_batches(fastq_file, batch_size=batch_size):
+        for seq, qual in zip(seqs, quals):
+            if seq in seq_counts:
+                seq_counts[seq][0] += 1
+            else:
+                seq_counts[seq] = [1, qual]
+        num_reads += len(seqs)
+        if len(seq_counts) > max_unique_seqs:
+            run_filename = \
+                utils.get_tmp_filename(os.path.join(output_dir,
+                                                    "%s.collapse_run%d" \
+                                                    %(basename,
+                                                      len(run_filenames))))
+            output_collapsed_run(seq_counts, run_filename)
+            run_filenames.append(run_filename)
+            seq_counts = {}
+    fastq_file.close()
+    if len(run_filenames) == 0:
+        unique_seqs = ((seq, seq_counts[seq][0], seq_counts[seq][1]) \
+                       for seq in sorted(seq_counts))
+        run_files = []
+    else:
+        print "  - Merging %d runs of counts" %(len(run_filenames) + 1)
+        run_filename = \
+            utils.get_tmp_filename(os.path.join(output_dir,
+                                                "%s.collapse_run%d" \
+                                                %(basename,
+                                                  len(run_filenames))))
+        output_collapsed_run(seq_counts, run_filename)
+        run_filenames.append(run_filename)
+        seq_counts = {}
+        run_files = [open(run_filename, "r") for run_filename in run_filenames]
+        unique_seqs = merge_collapsed_runs(run_files)
+    tmp_filename = utils.get_tmp_filename(output_filename)
+    out_file = open(tmp_filename, "w")
+    num_unique = 0
+    for seq, count, qual in unique_seqs:
+        num_unique += 1
+        read_name = get_collapsed_name(num_unique, count)
+        if output_format == "fastq":
+            out_file.write("@%s\n%s\n+\n%s\n" %(read_name, seq, qual))
+        else:
+            out_file.write(">%s\n%s\n" %(read_name, seq))
+    out_file.close()
+    for run_file in run_files:
+        run_file.close()
+    for run_filename in run_filenames:
+        os.remove(run_filename)
+    os.rename(tmp_filename, output_filename)
+    with utils.atomic_write(stats_filename) as stats_file:
+        stats_file.write("num_reads\tnum_unique\n")
+        stats_file.write("%d\t%d\n" %(num_reads, num_unique))
+    t2 = time.time()
+    print "Collapsed %d reads into %d unique sequences in %.2f secs" \
+        %(num_reads, num_unique, (t2 - t1))
+    return output_filename
+
+
+def get_header_umi(header):
+    """
+    Return the UMI of a FASTQ header that carries it as the
+    last ':' field of the read name (e.g. as written by
+    bcl2fastq.)
+    """
+    return header.split(None, 1)[0].rsplit(":", 1)[-1]
+
+
+def add_name_umi(header, umi):
+    """
+    Return a FASTQ header with the UMI added to the end
+    of the read name.
+    """
+    name_fields = header.split(None, 1)
+    name_fields[0] = "%s_%s" %(name_fields[0], umi)
+    return " ".join(name_fields)
+
+
+def get_read_umi(read_name):
+    """
+    Return the UMI at the end of a read name.
+    """
+    return read_name.rsplit("_", 1)[-1]
+
+
+def extract_umis(fastq_filename, output_dir,
+                 umi_len=None,
+                 umi_in_header=False,
+                 batch_size=100000,
+                 compress_level=6):
+    """
+    Move the UMIs of reads to the end of their names.
+
+    - umi_len: length of the UMI at the 5' end of the reads.
+      The UMI is clipped from the sequence. Reads no longer
+      than the UMI are dropped.
+    - umi_in_header: if True, the UMI is the last ':' field of
+      the read name instead.
+
+    Writes '<basename>.umi.fastq.gz' to 'output_dir' and returns
+    its filename.
+    """
+    if (umi_len is None) == (not umi_in_header):
+        raise Exception, "Need either a UMI length or UMIs in the header."
+    basename = fastq_utils.get_fastq_basename(fastq_filename)
+    output_filename = os.path.join(output_dir,
+                                   "%s.umi.fastq.gz" %(basename))
+    if os.path.isfile(output_filename):
+        print "SKIPPING: %s already exists!" %(output_filename)
+        return output_filename
+    print "Extracting UMIs from: %s" %(fastq_filename)
+    t1 = time.time()
+    num_reads = 0
+    num_kept = 0
+    fastq_file = fastq_utils.read_open_fastq(fastq_filename)
+    tmp_filename = utils.get_tmp_filename(output_filename)
+    out_file = open(tmp_filename, "wb")
+    for headers, seqs, headers2, quals in \
+        fastq_utils.read_fastq_batches(fastq_file, batch_size=batch_size):
+        num_reads += len(headers)
+        if umi_in_header:
+            headers = [add_name_umi(header, get_header_umi(header)) \
+                       for header in headers]
+        else:
+            kept = [n for n, seq in enumerate(seqs) if len(seq) > umi_len]
+            headers = [add_name_umi(headers[n], seqs[n][0:umi_len]) \
+                       for n in kept]
+            seqs = [seqs[n][umi_len:] for n in kept]
+            headers2 = [headers2[n] for n in kept]
+            quals = [quals[n][umi_len:] for n in kept]
+        num_kept += len(headers)
+        out_file.write(\
+            fastq_utils.compress_gzip_member(\
+                fastq_utils.format_fastq_batch(headers, seqs, headers2, quals),
+                compress_level=compress_level))
+    fastq_file.close()
+    out_file.close()
+    os.rename(tmp_filename, output_filename)
+    t2 = time.time()
+    print "Extracted UMIs of %d of %d reads in %.2f secs" %(num_kept,
+                                                           num_reads,
+                                                           (t2 - t1))
+    return output_filename
+
+
+def get_five_prime_pos(read):
+    """
+    Return the 5' position of an aligned read.
+    """
+    if read.is_reverse:
+        return read.aend - 1
+    return read.pos
+
+
+def dedup_bam(bam_filename, output_filename):
+    """
+    Remove PCR duplicates from a coordinate-sorted BAM file of
+    single-end reads with UMIs at the end of their names.
+
+    Reads with the same chromosome, strand, 5' position and UMI
+    are duplicates, of which the read with the highest mapping
+    quality (or else the first) is kept, with its UMI in an
+    RX tag. Unmapped reads are dropped.
+
+    The BAM is streamed: a group of duplicates is resolved once
+    the reads pass its 5' position, so only the reads around the
+    current position are held in memory. The output stays sorted.
+
+    Writes the deduplication stats to
+    '<output basename>.dedup_stats.txt' and returns them.
+    """
+    stats_filename = get_dedup_stats_filename(output_filename)
+    if os.path.isfile(output_filename) and os.path.isfile(stats_filename):
+        print "SKIPPING: %s already exists!" %(output_filename)
+        return load_dedup_stats(stats_filename)
+    print "Deduplicating reads by UMI: %s" %(bam_filename)
+    t1 = time.time()
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    tmp_filename = utils.get_tmp_filename(output_filename)
+    out_bam = pysam.Samfile(tmp_filename, "wb", template=bam_file)
+    # Best read of each unresolved group of duplicates, keyed
+    # by (strand, 5' position, UMI)
+    groups = {}
+    # Heap of the 5' positions of unresolved groups
+    group_positions = []
+    # Reads in input order, as [read, group key, kept] entries
+    pending = deque()
+    num_umi_reads = 0
+    num_dedup = 0
+    curr_tid = None
+    for read in bam_file.fetch(until_eof=True):
+        if read.is_unmapped:
+            continue
+        num_umi_reads += 1
+        if read.tid != curr_tid:
+            # New chromosome: resolve all groups
+            resolve_groups(groups, group_positions, None)
+            curr_tid = read.tid
+        else:
+            resolve_groups(groups, group_positions, read.pos)
+        num_dedup += write_resolved_reads(out_bam, pending, groups)
+        five_prime_pos = get_five_prime_pos(read)
+        group_key = (read.is_reverse, five_prime_pos, get_read_umi(read.qname))
+        entry = [read, group_key, False]
+        best_entry = groups.get(group_key)
+        if best_entry is None:
+            groups[group_key] = entry
+            heapq.heappush(group_positions, (five_prime_pos, group_key))
+        elif read.mapq > best_entry[0].mapq:
+            groups[group_key] = entry
+        pending.append(entry)
+    resolve_groups(groups, group_positions, None)
+    num_dedup += write_resolved_reads(out_bam, pending, groups)
+    out_bam.close()
+    bam_file.close()
+    os.rename(tmp_filename, output_filename)
+    percent_duplicates = 0
+    if num_umi_reads > 0:
+        percent_duplicates = 1 - (num_dedup / float(num_umi_reads))
+    dedup_stats = {"num_umi_reads": num_umi_reads,
+                   "num_dedup": num_dedup,
+                   "percent_duplicates": percent_duplicates}
+    with utils.atomic_write(stats_filename) as stats_file:
+        stats_file.write("%s\n" %("\t".join(DEDUP_STATS_HEADER)))
+        stats_file.write("%s\n" %("\t".join([str(dedup_stats[field]) \
+                                              for field in DEDUP_STATS_HEADER])))
+    t2 = time.time()
+    print "Kept %d of %d reads (%.2f%% duplicates) in %.2f secs" \
+        %(num_dedup, num_umi_reads, 100 * percent_duplicates, (t2 - t1))
+    return dedup_stats
+
+
+def resolve_groups(groups, group_positions, pos):
+    """
+    Resolve the groups of duplicates whose 5' position is
+    before 'pos' (or all groups if 'pos' is None), marking
+    their best read as kept.
+
+    No later read of a sorted BAM can join these groups,
+    since reads end after they start.
+    """
+    while (len(group_positions) > 0) and \
+          ((pos is None) or (group_positions[0][0] < pos)):
+        five_prime_pos, group_key = heapq.heappop(group_positions)
+        groups.pop(group_key)[2] = True
+
+
+def write_resolved_reads(out_bam, pending, groups):
+    """
+    Write the kept reads at the front of the pending reads
+    whose groups are resolved. Returns the number of reads
+    written.
+    """
+    num_written = 0
+    while (len(pending) > 0) and (pending[0][1] not in groups):
+        read, group_key, kept = pending.popleft()
+        if kept:
+            read.tags = read.tags + [(UMI_TAG, group_key[2])]
+            out_bam.write(read)
+            num_written += 1
+    return num_written
+
+
+def get_dedup_stats_filename(dedup_bam_filename):
+    """
+    Return the stats filename of a deduplicated BAM.
+    """
+    if dedup_bam_filename.endswith(".bam"):
+        dedup_bam_filename = dedup_bam_filename[0:-4]
+    return "%s.dedup_stats.txt" %(dedup_bam_filename)
+
+
+def load_dedup_stats(stats_filename):
+    """
+    Load the stats of a UMI deduplication.
+    """
+    stats_file = open(stats_filename, "r")
+    fields = stats_file.readline().strip().split("\t")
+    values = stats_file.readline().strip().split("\t")
+    stats_file.close()
+    dedup_stats = dict(izip(fields, values))
+    dedup_stats["num_umi_reads"] = int(dedup_stats["num_umi_reads"])
+    dedup_stats["num_dedup"] = int(dedup_stats["num_dedup"])
+    dedup_stats["percent_duplicates"] = \
+        float(dedup_stats["percent_duplicates"])
+    return dedup_stats
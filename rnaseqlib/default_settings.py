@@ -38,6 +38,11 @@ def set_default_riboseq_settings(settings_info):
     """
     Default settings that are Ribo-Seq specific.
     """
+    # By default, do not collapse identical reads before mapping
+    settings_info = set_settings_value(settings_info,
+                                       "mapping",
+                                       "collapse_reads",
+                                       False)
     return settings_info
 
 
@@ -45,6 +50,11 @@ def set_default_clip_settings(settings_info):
     """
     Default settings that are CLIP-Seq specific.
     """
+    # By default, reads have no UMIs
+    settings_info = set_settings_value(settings_info,
+                                       "mapping",
+                                       "umi_in_header",
+                                       False)
     return settings_info
 
 
@@ -99,13 +109,23 @@ def set_default_settings(settings_info):
     elif data_type == "riboseq":
         settings_info = set_default_riboseq_settings(settings_info)
     elif data_type == "clip":
-        raise Exception, "Not implemented."
+        settings_info = set_default_clip_settings(settings_info)
     elif data_type == "selex":
         raise Exception, "Not implemented."
     else:
         print "Unknown data type %s. Are you on crack?" \
             %(data_type)
     # Set general default settings
+    # By default, count reads on a single processor
+    settings_info = set_settings_value(settings_info,
+                                       "mapping",
+                                       "num_processors",
+                                       1)
+    # By default, rRNA reads are only removed after mapping
+    settings_info = set_settings_value(settings_info,
+                                       "mapping",
+                                       "prefilter_rrna",
+                                       False)
     if "prefilter_miso" not in settings_info["settings"]:
         # By default, set it so that MISO events are not
         # prefiltered
@@ -6,6 +6,12 @@
 #import misopy.gff_utils as gff_utils
 #import misopy.Gene as gene_utils
 
+import numpy
+import pandas
+
+import rnaseqlib.genes.TranscriptStore as TranscriptStore
+import rnaseqlib.mapping.bedtools_utils as bedtools_utils
+
 ##
 ## Human:
 ## Refseq: 
@@ -39,57 +45,39 @@ def define_events(event_type):
     pass
 
 
-# Build a transcript graph using refGene and ensGene. 
-# Columns for refGene and ensGene are: bin, name, chrom, strand, 
-# txStart, txEnd, cdsStart, cdsEnd, exonCount, exonStarts, exonEnds, 
+# Build a transcript graph using refGene and ensGene.
+# The table can be in any genePred layout (see TranscriptStore):
+# refGene and ensGene columns are: bin, name, chrom, strand,
+# txStart, txEnd, cdsStart, cdsEnd, exonCount, exonStarts, exonEnds,
 # score, name2, cdsStartStat, cdsEndStat, exonFrames
 # 
 def defineAltFromTable(table_f):
 
-    # First, iterate through table and associate exons with transcripts
-    # and transcripts with genes.
-    geneToTx = {}
-    txToExons = {}
-    geneToExons = {}
-    for line in open(table_f):
-        vals = line.strip().split("\t")
-        bin_, name_, chrom_, strand_, txStart_, txEnd_, cdsStart_,\
-            cdsEnd_, exonCount_, exonStarts_, exonEnds_, score_,\
-            name2_, cdsStartStat_, cdsEndStat_, exonFrames = vals
-
-        # May need to check if name2 is not defined
-        try:
-            geneToTx[name2_].append(name_)
-        except:
-            geneToTx[name2_] = [name_]
-        exonStarts = map(int, exonStarts_.split(",")[:-1])
-        exonStarts = map(str, [s + 1 for s in exonStarts])
-        exonEnds = exonEnds_.split(",")[:-1]
-        for i in range(len(exonStarts)):
-            exon = ":".join([chrom_, exonStarts[i], exonEnds[i], strand_])
-            try:
-                txToExons[name_].append(exon)
-            except:
-                txToExons[name_] = [exon]
-            if name2_ not in geneToExons:
-                geneToExons[name2_] = {}
-            try:
-                geneToExons[name2_][exon] += 1
-            except:
-                geneToExons[name2_][exon] = 1
-
-    print len(geneToTx), 'genes'
-    print len(txToExons), 'transcripts'
-
-    # Now iterate through each gene and identify exons that are not in all
-    # transcripts for the gene.
-    nAltExons = 0
-    for gene in geneToTx:
-        txs = geneToTx[gene] 
-        exons = geneToExons[gene]
-        altexons = [exon for exon in geneToExons[gene] \
-            if geneToExons[gene][exon] < len(txs)]
-        nAltExons += len(altexons) 
+    # First, parse the table into exons of transcripts
+    # and transcripts of genes.
+    store = TranscriptStore.read_genePred_store(table_f)
+    exon_trans = store.get_exon_transcripts()
+    exon_genes = store.get_transcript_genes()[exon_trans]
+    exon_keys = [exon_genes,
+                 store.chroms[exon_trans],
+                 store.strands[exon_trans],
+                 store.exon_starts,
+                 store.exon_ends]
+    # Count the transcripts of each distinct exon of a gene
+    order = numpy.lexsort(exon_keys[::-1])
+    sorted_keys = [key[order] for key in exon_keys]
+    exon_firsts = \
+        numpy.flatnonzero(bedtools_utils.get_key_changes(sorted_keys))
+    exon_counts = numpy.diff(numpy.append(exon_firsts, len(order)))
+    
+    print store.get_num_genes(), 'genes'
+    print len(numpy.unique(store.trans_ids)), 'transcripts'
+
+    # Now identify exons that are not in all transcripts
+    # for the gene.
+    gene_num_txs = numpy.diff(store.gene_offsets)
+    altexons = exon_counts < gene_num_txs[sorted_keys[0][exon_firsts]]
+    nAltExons = altexons.sum()
    
     print nAltExons 
     # Get flanking exons for each event and define event type.
@@ -101,38 +89,32 @@ def defineAltFromTable(table_f):
 # altevents exons, and then get constitutive exons.
 def defineConstitutiveForAltEvents(altevents_f, kg_f):
 
-    exonToTx = {}
-    txToExons = {}
-    for line in open(kg_f):
-        vals = line.strip().split("\t")
-        name_, chrom_, strand_, txStart_, txEnd_, cdsStart_, cdsEnd_,\
-            exonCount_, exonStarts_, exonEnds_, proteinID_, alignID_ = vals
-        exonStarts = map(int, exonStarts_.split(",")[:-1])
-        exonStarts = map(str, [s + 1 for s in exonStarts])
-        exonEnds = exonEnds_.split(",")[:-1]
-        exons = []
-        for i in range(len(exonStarts)):
-            exon = ":".join([chrom_, exonStarts[i], exonEnds[i], strand_])
-            try:
-                exonToTx[exon].append(name_)
-            except:
-                exonToTx[exon] = [name_]
-            exons.append(exon)
-        txToExons[name_] = exons
-
-    nAltEvents = 0
+    store = TranscriptStore.read_genePred_store(kg_f)
+    exon_trans = store.get_exon_transcripts()
+    # Exons of the table, keyed as the events
+    # (0-based starts, as in both tables)
+    exonToTx = pandas.Series(store.trans_ids[exon_trans],
+                             index=[store.chrom_names[store.chroms[exon_trans]],
+                                    store.exon_starts,
+                                    store.exon_ends,
+                                    store.strands[exon_trans]])
+
+    altevents = pandas.read_table(altevents_f,
+                                  names=["bin", "chrom", "start", "end",
+                                         "type", "score", "strand"],
+                                  dtype={"chrom": str,
+                                         "strand": str})
+    event_keys = pandas.MultiIndex.from_arrays([altevents["chrom"].values,
+                                                altevents["start"].values,
+                                                altevents["end"].values,
+                                                altevents["strand"].values])
+    found = event_keys.isin(exonToTx.index)
+    nAltEvents = found.sum()
     missing = 0
-    for line in open(altevents_f):
-        vals = line.strip().split("\t")
-        bin_, chrom_, start_, end_, type_, score_, strand_ = vals
-        start = str(int(start_) + 1)
-        exon = ":".join([chrom_, start, end_, strand_])
-        if exon in exonToTx:
-            txs = exonToTx[exon]
-            nAltEvents += 1
-        else:
-            print "Missing transcripts for", exon        
-            missing += 1
+    for chrom_, start_, end_, strand_ in event_keys[~found]:
+        exon = ":".join([chrom_, str(start_ + 1), str(end_), strand_])
+        print "Missing transcripts for", exon        
+        missing += 1
        
     print nAltEvents, 'alternative events found'
     print missing, 'missing'
@@ -1,7 +1,22 @@
 import os
 import time
+import mmap
+import string
 from itertools import ifilter, islice
 
+import numpy
+
+import rnaseqlib.utils as utils
+
+# Version of the 2-bit packed sequence cache format
+PACKED_FASTA_VERSION = 1
+
+# 2-bit codes of the bases in the packed cache
+PACKED_BASES = numpy.array(list("ACGT"), dtype="S1")
+PACKED_SHIFTS = numpy.array([6, 4, 2, 0], dtype=numpy.uint8)
+
+REV_COMP_TABLE = string.maketrans("ACGTNacgtn", "TGCANtgcan")
+
 def read_fasta(fp):
     name, seq = None, []
     for line in fp:
@@ -66,3 +81,399 @@ def write_fasta(fasta_out, fasta_recs):
         header, seq = rec
         fasta_out.write("%s\n" %(header))
         fasta_out.write("%s\n" %(seq))
+
+
+def reverse_complement(seq):
+    return seq.translate(REV_COMP_TABLE)[::-1]
+
+
+##
+## Indexed access to FASTA files
+##
+## FASTA files are indexed as by 'samtools faidx': a '.fai' file
+## with a line per sequence giving its name, length, the offset
+## of its first base, and the number of bases and bytes per line.
+## This requires all the lines of a sequence but its last to
+## have the same length. The files are memory-mapped, so that
+## any region is fetched directly at its offset.
+##
+## Optionally, the sequences can also be cached with 2 bits per
+## base ('<fasta>.2bit.npy', memory-mapped, and '<fasta>.2bit.npz'
+## for the positions of Ns). Sequences fetched from the cache are
+## upper case, with non-ACGT bases as N.
+##
+def build_fasta_index(fasta_filename):
+    """
+    Index a FASTA file. Returns a list of
+    [name, length, offset, line_bases, line_width] entries.
+    """
+    print "Indexing FASTA file: %s" %(fasta_filename)
+    entries = []
+    fasta_file = open(fasta_filename, "rb")
+    offset = 0
+    curr_entry = None
+    # Whether the current sequence had a line shorter
+    # than the others, which must be its last
+    seen_last_line = False
+    for line in fasta_file:
+        if line.startswith(">"):
+            curr_entry = [line[1:].split(None, 1)[0], 0,
+                          offset + len(line), 0, 0]
+            entries.append(curr_entry)
+            seen_last_line = False
+        elif curr_entry is not None:
+            num_bases = len(line.rstrip("\r\n"))
+            if curr_entry[3] == 0:
+                curr_entry[3] = num_bases
+                curr_entry[4] = len(line)
+            elif seen_last_line and (num_bases > 0):
+                fasta_file.close()
+                raise Exception, "Cannot index %s: lines of %s have " \
+                                 "different lengths." %(fasta_filename,
+                                                        curr_entry[0])
+            if num_bases < curr_entry[3]:
+                seen_last_line = True
+            curr_entry[1] += num_bases
+        offset += len(line)
+    fasta_file.close()
+    return entries
+
+
+def load_fasta_index(fai_filename):
+    """
+    Load the entries of a FASTA index.
+    """
+    entries = []
+    fai_file = open(fai_filename, "r")
+    for line in fai_file:
+        fields = line.rstrip("\n").split("\t")
+        entries.append([fields[0]] + map(int, fields[1:5]))
+    fai_file.close()
+    return entries
+
+
+def get_fasta_index(fasta_filename):
+    """
+    Return the index entries of a FASTA file, from its '.fai'
+    file if it is up to date, or else indexing the file (and
+    writing its '.fai' file.)
+    """
+    fai_filename = "%s.fai" %(fasta_filename)
+    if os.path.isfile(fai_filename) and \
+       (os.path.getmtime(fai_filename) >= os.path.getmtime(fasta_filename)):
+        return load_fasta_index(fai_filename)
+    entries = build_fasta_index(fasta_filename)
+    try:
+        with utils.atomic_write(fai_filename) as fai_file:
+            for entry in entries:
+                fai_file.write("%s\n" %("\t".join(map(str, entry))))
+    except (IOError, OSError):
+        print "WARNING: Cannot write FASTA index %s" %(fai_filename)
+    return entries
+
+
+class IndexedFasta:
+    """
+    Random access to the sequences of one or more indexed
+    FASTA files (e.g. one file per chromosome.)
+
+    Coordinates are 0-based, end exclusive.
+    """
+    def __init__(self, fasta_filenames, use_2bit=False):
+        """
+        - fasta_filenames: a FASTA file or a list of them
+        - use_2bit: if True, fetch sequences from a 2-bit packed
+          cache of the files, made if needed
+        """
+        if isinstance(fasta_filenames, basestring):
+            fasta_filenames = [fasta_filenames]
+        self.fasta_filenames = list(fasta_filenames)
+        # Mapping from sequence name to
+        # (file number, length, offset, line_bases, line_width)
+        self.seq_index = {}
+        self.seq_names = []
+        self.fasta_maps = []
+        for file_num, fasta_filename in enumerate(self.fasta_filenames):
+            for name, length, offset, line_bases, line_width in \
+                get_fasta_index(fasta_filename):
+                if name in self.seq_index:
+                    raise Exception, "Sequence %s is in more than one " \
+                                     "FASTA file." %(name)
+                self.seq_index[name] = (file_num, length, offset,
+                                        line_bases, line_width)
+                self.seq_names.append(name)
+            fasta_file = open(fasta_filename, "rb")
+            if os.path.getsize(fasta_filename) == 0:
+                self.fasta_maps.append("")
+            else:
+                self.fasta_maps.append(mmap.mmap(fasta_file.fileno(), 0,
+                                                 access=mmap.ACCESS_READ))
+            fasta_file.close()
+        # 2-bit packed caches of each file
+        self.packed_caches = None
+        if use_2bit:
+            self.packed_caches = [get_packed_fasta(fasta_filename) \
+                                  for fasta_filename in self.fasta_filenames]
+
+
+    def __repr__(self):
+        return "IndexedFasta(%d sequences, %d files)" %(len(self.seq_names),
+                                                       len(self.fasta_filenames))
+
+
+    def __contains__(self, name):
+        return name in self.seq_index
+
+
+    def get_seq_len(self, name):
+        """
+        Return the length of a sequence.
+        """
+        return self.seq_index[name][1]
+
+
+    def fetch(self, chrom, start, end, strand="+"):
+        """
+        Return the sequence of a region. Regions past the ends
+        of the sequence are clipped. Minus strand regions are
+        reverse complemented.
+        """
+        if chrom not in self.seq_index:
+            raise Exception, "No sequence %s in FASTA files." %(chrom)
+        file_num, length, offset, line_bases, line_width = \
+            self.seq_index[chrom]
+        start = max(start, 0)
+        end = min(end, length)
+        if end <= start:
+            return ""
+        if self.packed_caches is not None:
+            seq = self.packed_caches[file_num].fetch(chrom, start, end)
+        else:
+            start_byte = offset + (start / line_bases) * line_width + \
+                         (start % line_bases)
+            end_byte = offset + (end / line_bases) * line_width + \
+                       (end % line_bases)
+            seq = self.fasta_maps[file_num][start_byte:end_byte].translate(None,
+                                                                           "\r\n")
+        if strand == "-":
+            seq = reverse_complement(seq)
+        return seq
+
+
+    def fetch_many(self, regions):
+        """
+        Return the sequences of many regions, given as
+        (chrom, start, end) or (chrom, start, end, strand)
+        tuples, in order.
+
+        Regions are fetched in file order, so that each part
+        of the files is paged in once.
+        """
+        for region in regions:
+            if region[0] not in self.seq_index:
+                raise Exception, "No sequence %s in FASTA files." %(region[0])
+        # Sort by file, offset of sequence in file and start
+        order = sorted(xrange(len(regions)),
+                       key=lambda n: (self.seq_index[regions[n][0]][0],
+                                      self.seq_index[regions[n][0]][2],
+                                      regions[n][1]))
+        seqs = [None] * len(regions)
+        for n in order:
+            seqs[n] = self.fetch(*regions[n])
+        return seqs
+
+
+    def fetch_spliced(self, chrom, intervals, strand="+"):
+        """
+        Return the sequence of a spliced region, such as the
+        exons of a CDS or the two sides of a junction, given as
+        a list of (start, end) intervals. The sequence is
+        reverse complemented for minus strand regions.
+        """
+        seq = "".join([self.fetch(chrom, start, end) \
+                       for start, end in sorted(intervals)])
+        if strand == "-":
+            seq = reverse_complement(seq)
+        return seq
+
+
+    def get_gc_content(self, chrom, start, end):
+        """
+        Return the fraction of G/C bases among the non-N
+        bases of a region (NaN if there are none.)
+        """
+        seq = self.fetch(chrom, start, end).upper()
+        num_bases = len(seq) - seq.count("N")
+        if num_bases == 0:
+            return numpy.nan
+        return (seq.count("G") + seq.count("C")) / float(num_bases)
+
+
+    def close(self):
+        for fasta_map in self.fasta_maps:
+            if fasta_map != "":
+                fasta_map.close()
+        self.fasta_maps = []
+
+
+class PackedFasta:
+    """
+    2-bit packed cache of the sequences of a FASTA file.
+    """
+    def __init__(self, names, lengths, packed_offsets,
+                 n_starts, n_ends, n_offsets, packed_seqs):
+        self.seq_nums = dict([(name, seq_num) \
+                              for seq_num, name in enumerate(names)])
+        self.lengths = numpy.asarray(lengths, dtype=numpy.int64)
+        # Offset of each sequence in the packed bytes
+        self.packed_offsets = numpy.asarray(packed_offsets, dtype=numpy.int64)
+        # Sorted runs of Ns of all sequences, and the first
+        # run of each sequence
+        self.n_starts = numpy.asarray(n_starts, dtype=numpy.int64)
+        self.n_ends = numpy.asarray(n_ends, dtype=numpy.int64)
+        self.n_offsets = numpy.asarray(n_offsets, dtype=numpy.int64)
+        self.packed_seqs = packed_seqs
+
+
+    def fetch(self, chrom, start, end):
+        """
+        Return the sequence of a region within a sequence.
+        """
+        seq_num = self.seq_nums[chrom]
+        first_byte = self.packed_offsets[seq_num] + (start / 4)
+        last_byte = self.packed_offsets[seq_num] + ((end + 3) / 4)
+        packed = self.packed_seqs[first_byte:last_byte]
+        codes = ((packed[:, numpy.newaxis] >> PACKED_SHIFTS) & 3).ravel()
+        seq = PACKED_BASES[codes[(start % 4):(start % 4) + (end - start)]]
+        # Mask the runs of Ns that overlap the region
+        first_n = self.n_offsets[seq_num]
+        last_n = self.n_offsets[seq_num + 1]
+        n_num = first_n + numpy.searchsorted(self.n_ends[first_n:last_n],
+                                             start, side="right")
+        while (n_num < last_n) and (self.n_starts[n_num] < end):
+            seq[max(self.n_starts[n_num], start) - start:
+                min(self.n_ends[n_num], end) - start] = "N"
+            n_num += 1
+        return seq.tostring()
+
+
+def pack_seq(seq_bytes):
+    """
+    Return the 2-bit packed codes of a sequence (given as a
+    numpy array of bytes) and the (starts, ends) of its runs
+    of non-ACGT bases.
+    """
+    codes = numpy.zeros(256, dtype=numpy.uint8)
+    is_base = numpy.zeros(256, dtype=bool)
+    for code, bases in enumerate(["Aa", "Cc", "Gg", "Tt"]):
+        for base in bases:
+            codes[ord(base)] = code
+            is_base[ord(base)] = True
+    seq_codes = codes[seq_bytes]
+    # Runs of non-ACGT bases
+    is_n = numpy.concatenate([[False], ~is_base[seq_bytes], [False]])
+    run_edges = numpy.flatnonzero(is_n[1:] != is_n[0:-1])
+    n_starts = run_edges[0::2]
+    n_ends = run_edges[1::2]
+    # Pad to a multiple of 4 bases and pack 4 bases per byte
+    padded = numpy.zeros(4 * ((len(seq_codes) + 3) / 4), dtype=numpy.uint8)
+    padded[0:len(seq_codes)] = seq_codes
+    padded = padded.reshape(-1, 4)
+    packed = (padded[:, 0] << 6) | (padded[:, 1] << 4) | \
+             (padded[:, 2] << 2) | padded[:, 3]
+    return packed, n_starts, n_ends
+
+
+def build_packed_fasta(fasta_filename, packed_filename, meta_filename):
+    """
+    Build the 2-bit packed cache of a FASTA file, one sequence
+    at a time.
+    """
+    print "Packing FASTA file: %s" %(fasta_filename)
+    t1 = time.time()
+    entries = get_fasta_index(fasta_filename)
+    lengths = [entry[1] for entry in entries]
+    packed_lens = [(length + 3) / 4 for length in lengths]
+    packed_offsets = numpy.concatenate([[0], numpy.cumsum(packed_lens)])
+    tmp_packed_filename = utils.get_tmp_filename(packed_filename)
+    packed_seqs = \
+        numpy.lib.format.open_memmap(tmp_packed_filename, mode="w+",
+                                     dtype=numpy.uint8,
+                                     shape=(max(int(packed_offsets[-1]), 1),))
+    fasta_file = open(fasta_filename, "rb")
+    all_n_starts = []
+    all_n_ends = []
+    n_offsets = [0]
+    for seq_num, entry in enumerate(entries):
+        name, length, offset, line_bases, line_width = entry
+        num_lines = (length + line_bases - 1) / max(line_bases, 1)
+        fasta_file.seek(offset)
+        seq_bytes = numpy.frombuffer(fasta_file.read(num_lines * line_width),
+                                     dtype=numpy.uint8)
+        seq_bytes = seq_bytes[(seq_bytes != ord("\n")) & \
+                              (seq_bytes != ord("\r"))][0:length]
+        packed, n_starts, n_ends = pack_seq(seq_bytes)
+        packed_seqs[packed_offsets[seq_num]:packed_offsets[seq_num + 1]] = packed
+        all_n_starts.append(n_starts)
+        all_n_ends.append(n_ends)
+        n_offsets.append(n_offsets[-1] + len(n_starts))
+    fasta_file.close()
+    packed_seqs.flush()
+    del packed_seqs
+    os.rename(tmp_packed_filename, packed_filename)
+    tmp_meta_filename = utils.get_tmp_filename(meta_filename)
+    # Keep the .npz extension so numpy does not add it
+    tmp_meta_filename = "%s.npz" %(tmp_meta_filename)
+    numpy.savez(tmp_meta_filename,
+                packed_version=numpy.array([PACKED_FASTA_VERSION]),
+                file_stat=numpy.array(utils.get_file_stat(fasta_filename)),
+                names=numpy.array([entry[0] for entry in entries]),
+                lengths=numpy.array(lengths, dtype=numpy.int64),
+                packed_offsets=packed_offsets[0:-1],
+                n_starts=numpy.concatenate([[0]] + all_n_starts)[1:],
+                n_ends=numpy.concatenate([[0]] + all_n_ends)[1:],
+                n_offsets=numpy.array(n_offsets, dtype=numpy.int64))
+    os.rename(tmp_meta_filename, meta_filename)
+    t2 = time.time()
+    print "Packed %d sequences in %.2f secs" %(len(entries), (t2 - t1))
+
+
+def load_packed_fasta(fasta_filename, packed_filename, meta_filename):
+    """
+    Load the 2-bit packed cache of a FASTA file. Return None
+    if it was not made from the current version of the file.
+    """
+    meta_data = numpy.load(meta_filename)
+    try:
+        if int(meta_data["packed_version"][0]) != PACKED_FASTA_VERSION:
+            return None
+        if list(meta_data["file_stat"]) != utils.get_file_stat(fasta_filename):
+            return None
+        packed_seqs = numpy.load(packed_filename, mmap_mode="r")
+        packed_fasta = PackedFasta(list(meta_data["names"]),
+                                   meta_data["lengths"],
+                                   meta_data["packed_offsets"],
+                                   meta_data["n_starts"],
+                                   meta_data["n_ends"],
+                                   meta_data["n_offsets"],
+                                   packed_seqs)
+    finally:
+        meta_data.close()
+    return packed_fasta
+
+
+def get_packed_fasta(fasta_filename):
+    """
+    Return the 2-bit packed cache of a FASTA file, building
+    it only if there is no up-to-date cache.
+    """
+    packed_filename = "%s.2bit.npy" %(fasta_filename)
+    meta_filename = "%s.2bit.npz" %(fasta_filename)
+    if os.path.isfile(packed_filename) and os.path.isfile(meta_filename):
+        packed_fasta = load_packed_fasta(fasta_filename, packed_filename,
+                                         meta_filename)
+        if packed_fasta is not None:
+            return packed_fasta
+        print "Packed FASTA %s is out of date." %(packed_filename)
+    build_packed_fasta(fasta_filename, packed_filename, meta_filename)
+    return load_packed_fasta(fasta_filename, packed_filename, meta_filename)
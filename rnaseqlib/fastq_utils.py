@@ -4,10 +4,35 @@
 
 import os
 import time
-from itertools import ifilter, islice
+import re
+import json
+import ConfigParser
+import zlib
+import multiprocessing
+from itertools import ifilter, islice, izip
 
 import gzip
 
+import numpy
+
+import rnaseqlib.utils as utils
+import rnaseqlib.gzip_utils as gzip_utils
+import rnaseqlib.cluster_utils.cluster as cluster
+
+# Version of serialized FASTQ indices
+FASTQ_INDEX_VERSION = 2
+
+# Summary statistics of paired-end preprocessing
+PAIRED_STATS_HEADER = ["num_pairs",
+                       "num_pairs_kept",
+                       "num_orphans_1",
+                       "num_orphans_2",
+                       "num_pairs_dropped"]
+
+# Size of read length histograms: reads of READ_LEN_HIST_SIZE - 1
+# bases or longer are counted in the last bin
+READ_LEN_HIST_SIZE = 512
+
 def read_open_fastq(fastq_filename):
     fastq_file = None
     if fastq_filename.endswith(".gz"):
@@ -61,6 +86,851 @@ def write_fastq(fastq_file, fastq_rec):
     fastq_file.write("%s\n" %(header2))
     fastq_file.write("%s\n" %(quality))
     
+
+def read_fastq_batches(fastq_file, batch_size=100000):
+    """
+    Parse a FASTQ file in batches of 'batch_size' records, yielding
+    (headers, seqs, headers2, quals) tuples of lists.
+
+    Unlike read_fastq, headers are kept with their leading '@'.
+    """
+    fastq_lines = ifilter(lambda l: l, (l.rstrip("\n") for l in fastq_file))
+    num_recs = 0
+    while True:
+        lines = list(islice(fastq_lines, 4 * batch_size))
+        if len(lines) == 0:
+            break
+        if (len(lines) % 4) != 0:
+            raise EOFError("Failed to parse four lines from fastq file!")
+        headers = lines[0::4]
+        headers2 = lines[2::4]
+        for rec_num in xrange(len(headers)):
+            if not (headers[rec_num].startswith("@") and \
+                    headers2[rec_num].startswith("+")):
+                raise ValueError("Invalid header lines: %s and %s (record %d)" \
+                                 %(headers[rec_num], headers2[rec_num],
+                                   num_recs + rec_num))
+        num_recs += len(headers)
+        yield headers, lines[1::4], headers2, lines[3::4]
+
+
+def read_paired_fastq_batches(fastq_files, batch_size=100000):
+    """
+    Parse the two mate files of a paired-end library in lockstep
+    batches of 'batch_size' records, yielding a batch of
+    each mate (see read_fastq_batches.)
+    """
+    mate_batches = [read_fastq_batches(fastq_file, batch_size=batch_size) \
+                    for fastq_file in fastq_files]
+    while True:
+        batch_1 = next(mate_batches[0], None)
+        batch_2 = next(mate_batches[1], None)
+        if (batch_1 is None) and (batch_2 is None):
+            break
+        # Every batch but the last is full, so mate files with
+        # different numbers of records differ in some batch
+        if (batch_1 is None) or (batch_2 is None) or \
+           (len(batch_1[0]) != len(batch_2[0])):
+            raise EOFError("Mate files have different numbers of records!")
+        yield batch_1, batch_2
+
+
+def get_read_len_hist(read_lens, weights=None):
+    """
+    Return the histogram of read lengths as a fixed-size
+    integer array (see READ_LEN_HIST_SIZE.)
+
+    - weights: number of reads each read stands for
+    """
+    read_lens = numpy.minimum(numpy.asarray(read_lens, dtype=numpy.int64),
+                              READ_LEN_HIST_SIZE - 1)
+    hist = numpy.bincount(read_lens,
+                          weights=weights,
+                          minlength=READ_LEN_HIST_SIZE)
+    return numpy.rint(hist).astype(numpy.int64)
+
+
+def format_fastq_batch(headers, seqs, headers2, quals):
+    """
+    Return a batch of FASTQ records as text. Headers must
+    have their leading '@'.
+    """
+    if len(headers) == 0:
+        return ""
+    lines = [None] * (4 * len(headers))
+    lines[0::4] = headers
+    lines[1::4] = seqs
+    lines[2::4] = headers2
+    lines[3::4] = quals
+    return "%s\n" %("\n".join(lines))
+
+
+def get_trailing_stretch_lens(seqs, letter):
+    """
+    Return the length of the trailing stretch of 'letter'
+    in each of the sequences.
+
+    The sequences are reversed into a padded byte matrix, so
+    the stretch length is the position of the first byte of
+    each row that is not 'letter'.
+    """
+    if len(seqs) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    rev_seqs = numpy.array([seq[::-1] for seq in seqs], dtype=str)
+    seq_bytes = rev_seqs.view(numpy.uint8).reshape(len(seqs), -1)
+    not_letter = (seq_bytes != ord(letter))
+    stretch_lens = not_letter.argmax(axis=1)
+    # Sequences made up entirely of the letter, and as long as
+    # the longest sequence, have no padding to stop at
+    stretch_lens[~not_letter.any(axis=1)] = seq_bytes.shape[1]
+    return stretch_lens
+
+
+def get_adapter_starts(seqs, adapter,
+                       min_overlap=3):
+    """
+    Return the start of a 3' adapter in each sequence: the
+    first occurrence of the adapter, or of a prefix of it
+    (of at least 'min_overlap' bases) that runs to the end of
+    the sequence. Sequences without the adapter get their
+    length.
+    """
+    # Alternatives are tried in order at each position, so
+    # the leftmost (longest) clip wins
+    adapter_pat = \
+        re.compile("|".join([re.escape(adapter)] + \
+                            ["%s$" %(re.escape(adapter[0:prefix_len])) \
+                             for prefix_len in xrange(len(adapter) - 1,
+                                                      min_overlap - 1, -1)]))
+    adapter_starts = numpy.empty(len(seqs), dtype=numpy.int64)
+    for seq_num, seq in enumerate(seqs):
+        match = adapter_pat.search(seq)
+        if match is None:
+            adapter_starts[seq_num] = len(seq)
+        else:
+            adapter_starts[seq_num] = match.start()
+    return adapter_starts
+
+
+def get_mean_quals(quals, quals_lens, qual_offset=33):
+    """
+    Return the mean quality score of each read, counting only
+    the first 'quals_lens' bases of each read.
+    """
+    if len(quals) == 0:
+        return numpy.zeros(0)
+    qual_bytes = numpy.array(quals, dtype=str).view(numpy.uint8)
+    qual_bytes = qual_bytes.reshape(len(quals), -1).astype(numpy.int64)
+    in_read = (numpy.arange(qual_bytes.shape[1]) < quals_lens[:, numpy.newaxis])
+    qual_sums = numpy.where(in_read, qual_bytes - qual_offset, 0).sum(axis=1)
+    return qual_sums / numpy.maximum(quals_lens, 1).astype(float)
+
+
+def get_mate_name(header):
+    """
+    Return the read name of a mate's header: its first word,
+    without a trailing /1 or /2.
+    """
+    name = header.split(None, 1)[0]
+    if name[-2:] in ("/1", "/2"):
+        name = name[0:-2]
+    return name
+
+
+def filter_mate_batch(seqs, quals,
+                      adapter=None,
+                      adapter_min_overlap=3,
+                      trim_letter=None,
+                      min_read_len=22,
+                      min_mean_qual=None,
+                      qual_offset=33):
+    """
+    Trim a batch of one mate's reads and apply the length and
+    quality filters to them.
+
+    Returns the trimmed lengths of the reads and whether each
+    read passes the filters.
+    """
+    trimmed_lens = numpy.array([len(seq) for seq in seqs], dtype=numpy.int64)
+    if adapter is not None:
+        trimmed_lens = get_adapter_starts(seqs, adapter,
+                                          min_overlap=adapter_min_overlap)
+    if trim_letter is not None:
+        clipped_seqs = [seq[0:seq_len] for seq, seq_len \
+                        in izip(seqs, trimmed_lens)]
+        trimmed_lens = trimmed_lens - \
+            get_trailing_stretch_lens(clipped_seqs, trim_letter)
+    passed = (trimmed_lens >= min_read_len)
+    if min_mean_qual is not None:
+        passed &= (get_mean_quals(quals, trimmed_lens,
+                                  qual_offset=qual_offset) >= min_mean_qual)
+    return trimmed_lens, passed
+
+
+def compress_gzip_member(text, compress_level=6):
+    """
+    Compress text into a gzip member. Concatenated gzip
+    members make up a valid gzip file.
+    """
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+    return compressor.compress(text) + compressor.flush()
+
+
+def format_trimmed_records(batch, inds, trimmed_lens):
+    """
+    Return records 'inds' of a batch, trimmed to their
+    lengths, as FASTQ text.
+    """
+    headers, seqs, headers2, quals = batch
+    return format_fastq_batch([headers[n] for n in inds],
+                              [seqs[n][0:trimmed_lens[n]] for n in inds],
+                              [headers2[n] for n in inds],
+                              [quals[n][0:trimmed_lens[n]] for n in inds])
+
+
+def filter_paired_batch(batches, filter_args,
+                        output_orphans=False,
+                        compress_level=6):
+    """
+    Trim and filter a batch of read pairs (a batch of records of
+    each mate, in the same order.)
+
+    A pair is kept if both mates pass the filters. If only one
+    mate passes, it is an orphan: it is kept separately if
+    'output_orphans' is True and dropped otherwise.
+
+    Returns the gzip compressed kept pairs of each mate, the
+    compressed orphans of each mate and the batch statistics.
+    """
+    headers_1, headers_2 = batches[0][0], batches[1][0]
+    for rec_num in xrange(len(headers_1)):
+        if get_mate_name(headers_1[rec_num]) != \
+           get_mate_name(headers_2[rec_num]):
+            raise ValueError("Mates out of sync: %s and %s" \
+                             %(headers_1[rec_num], headers_2[rec_num]))
+    mate_results = [filter_mate_batch(batch[1], batch[3], **mate_args) \
+                    for batch, mate_args in izip(batches, filter_args)]
+    passed_1, passed_2 = mate_results[0][1], mate_results[1][1]
+    pair_inds = numpy.flatnonzero(passed_1 & passed_2)
+    orphan_inds = [numpy.flatnonzero(passed_1 & ~passed_2),
+                   numpy.flatnonzero(passed_2 & ~passed_1)]
+    pairs_data = []
+    orphans_data = []
+    for mate_num in [0, 1]:
+        trimmed_lens = mate_results[mate_num][0]
+        pairs_data.append(\
+            compress_gzip_member(format_trimmed_records(batches[mate_num],
+                                                        pair_inds,
+                                                        trimmed_lens),
+                                 compress_level=compress_level))
+        if output_orphans:
+            orphans_data.append(\
+                compress_gzip_member(format_trimmed_records(batches[mate_num],
+                                                            orphan_inds[mate_num],
+                                                            trimmed_lens),
+                                     compress_level=compress_level))
+    stats = {"num_pairs": len(headers_1),
+             "num_pairs_kept": len(pair_inds),
+             "num_orphans_1": len(orphan_inds[0]),
+             "num_orphans_2": len(orphan_inds[1]),
+             "num_pairs_dropped": int((~(passed_1 | passed_2)).sum())}
+    return pairs_data, orphans_data, stats
+
+
+def _filter_paired_batch(filter_task):
+    """
+    Filter a batch of read pairs. Used by the process pool.
+    """
+    batches, filter_args, output_orphans, compress_level = filter_task
+    return filter_paired_batch(batches, filter_args,
+                               output_orphans=output_orphans,
+                               compress_level=compress_level)
+
+
+def get_fastq_basename(fastq_filename):
+    """
+    Return the basename of a FASTQ file without its
+    extensions (e.g. .fastq.gz)
+    """
+    basename = os.path.basename(fastq_filename)
+    if basename.endswith(".gz"):
+        basename = basename[0:-3]
+    return os.path.splitext(basename)[0]
+
+
+def get_paired_stats_filename(fastq_filenames, output_dir):
+    """
+    Return the filename of the statistics of a paired-end
+    library preprocessed by preprocess_paired_fastq.
+    """
+    return os.path.join(output_dir,
+                        "%s.preprocessed.stats.txt" \
+                        %(get_fastq_basename(fastq_filenames[0])))
+
+
+def load_paired_stats(stats_filename):
+    """
+    Load the statistics of a preprocessed paired-end library.
+    """
+    stats_file = open(stats_filename, "r")
+    fields = stats_file.readline().strip().split("\t")
+    values = stats_file.readline().strip().split("\t")
+    stats_file.close()
+    return dict((field, int(value)) for field, value in zip(fields, values))
+
+
+def preprocess_paired_fastq(fastq_filenames, output_dir,
+                            adapters=(None, None),
+                            adapter_min_overlap=3,
+                            trim_letter=None,
+                            min_read_len=22,
+                            min_mean_qual=None,
+                            qual_offset=33,
+                            output_orphans=False,
+                            num_processors=1,
+                            batch_size=100000,
+                            compress_level=6):
+    """
+    Preprocess the two mate files of a paired-end library in one
+    pass, keeping the mates in sync.
+
+    The mates are read in lockstep batches. Each mate is trimmed
+    and filtered (see filter_mate_batch), and the pairs where both
+    mates pass are written, in their original order, to
+    '<mate basename>.preprocessed.fastq.gz'. Pairs with one passing
+    mate are dropped, or written to '<mate basename>.orphans.fastq.gz'
+    if 'output_orphans' is True.
+
+    Batches are filtered and compressed over 'num_processors'
+    processes, so both outputs are written in parallel.
+
+    - fastq_filenames: FASTQ files of mate 1 and mate 2
+    - adapters: 3' adapter to clip from each mate (or None)
+    - trim_letter: if given, trim trailing stretches of this
+      letter (e.g. 'A') after the adapter
+    - min_read_len: minimum length of a mate after trimming
+    - min_mean_qual: if given, minimum mean quality score of
+      a mate after trimming
+    - qual_offset: offset of the quality scores (33 for Sanger)
+
+    Returns the preprocessed FASTQ files of the two mates.
+    """
+    utils.make_dir(output_dir)
+    basenames = [get_fastq_basename(fastq_filename) \
+                 for fastq_filename in fastq_filenames]
+    output_filenames = [os.path.join(output_dir,
+                                     "%s.preprocessed.fastq.gz" %(basename)) \
+                        for basename in basenames]
+    orphan_filenames = [os.path.join(output_dir,
+                                     "%s.orphans.fastq.gz" %(basename)) \
+                        for basename in basenames]
+    stats_filename = get_paired_stats_filename(fastq_filenames, output_dir)
+    if all([os.path.isfile(output_filename) \
+            for output_filename in output_filenames + [stats_filename]]):
+        print "SKIPPING: %s already exist!" %(", ".join(output_filenames))
+        return output_filenames
+    print "Preprocessing paired-end reads from: %s" \
+        %(", ".join(fastq_filenames))
+    filter_args = [{"adapter": adapter,
+                    "adapter_min_overlap": adapter_min_overlap,
+                    "trim_letter": trim_letter,
+                    "min_read_len": min_read_len,
+                    "min_mean_qual": min_mean_qual,
+                    "qual_offset": qual_offset} for adapter in adapters]
+    input_files = [read_open_fastq(fastq_filename) \
+                   for fastq_filename in fastq_filenames]
+    # Write to temporary files first so that an interrupted
+    # run is not mistaken for a finished one
+    out_filenames = list(output_filenames)
+    if output_orphans:
+        out_filenames.extend(orphan_filenames)
+    tmp_filenames = [utils.get_tmp_filename(out_filename) \
+                     for out_filename in out_filenames]
+    out_files = [open(tmp_filename, "wb") for tmp_filename in tmp_filenames]
+    t1 = time.time()
+    filter_tasks = ((batches, filter_args, output_orphans, compress_level) \
+                    for batches in read_paired_fastq_batches(input_files,
+                                                             batch_size=batch_size))
+    pool = None
+    if num_processors > 1:
+        pool = multiprocessing.Pool(processes=num_processors)
+    stats = dict((stat, 0) for stat in PAIRED_STATS_HEADER)
+    try:
+        while True:
+            # Only hand out a few batches per process at a
+            # time, to bound the number of reads in memory
+            window_tasks = list(islice(filter_tasks, 2 * num_processors))
+            if len(window_tasks) == 0:
+                break
+            if pool is None:
+                results = map(_filter_paired_batch, window_tasks)
+            else:
+                results = pool.map(_filter_paired_batch, window_tasks)
+            for pairs_data, orphans_data, batch_stats in results:
+                for out_file, data in izip(out_files,
+                                           pairs_data + orphans_data):
+                    out_file.write(data)
+                for stat in PAIRED_STATS_HEADER:
+                    stats[stat] += batch_stats[stat]
+    except:
+        for out_file, tmp_filename in izip(out_files, tmp_filenames):
+            out_file.close()
+            os.remove(tmp_filename)
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for input_file in input_files:
+            input_file.close()
+    for out_file in out_files:
+        out_file.close()
+    with utils.atomic_write(stats_filename) as stats_file:
+        stats_file.write("%s\n" %("\t".join(PAIRED_STATS_HEADER)))
+        stats_file.write("%s\n" %("\t".join([str(stats[stat]) \
+                                              for stat in PAIRED_STATS_HEADER])))
+    for tmp_filename, out_filename in izip(tmp_filenames, out_filenames):
+        os.rename(tmp_filename, out_filename)
+    t2 = time.time()
+    print "Preprocessing took %.2f mins." %((t2 - t1)/60.)
+    print "  - Kept %d of %d pairs (%d and %d orphans, %d dropped)" \
+        %(stats["num_pairs_kept"],
+          stats["num_pairs"],
+          stats["num_orphans_1"],
+          stats["num_orphans_2"],
+          stats["num_pairs_dropped"])
+    return output_filenames
+
+
+##
+## Indexed access to FASTQ files
+##
+## A FASTQ index records 'checkpoints': records from which a file
+## can be read without reading what comes before. A checkpoint is
+## an access point of the file (see below) and the offset of the
+## record's start in the data read from that point.
+##
+## Any offset of an uncompressed file is an access point. For
+## gzipped files, access points are deflate block boundaries (see
+## gzip_utils), so that a file made of a single gzip member (plain
+## gzip) can be split as well as one made of many (e.g. BGZF.)
+## Each access point of a gzipped file comes with the 32 KB of
+## uncompressed data before it, stored in the index.
+##
+## Records are taken to be four lines each.
+##
+class FastqIndex:
+    """
+    Index of the records of a FASTQ file.
+    """
+    def __init__(self, compressed, point_offsets, point_bits,
+                 windows, window_offsets, within_offsets,
+                 record_nums, num_records):
+        self.compressed = bool(compressed)
+        # Checkpoints, in order of records. Access points with
+        # bits of -1 are read with the gzip module (when the
+        # zlib library cannot be used)
+        self.point_offsets = numpy.asarray(point_offsets,
+                                           dtype=numpy.int64)
+        self.point_bits = numpy.asarray(point_bits, dtype=numpy.int8)
+        # Windows of the access points, concatenated
+        self.windows = numpy.asarray(windows, dtype=numpy.uint8)
+        self.window_offsets = numpy.asarray(window_offsets,
+                                            dtype=numpy.int64)
+        self.within_offsets = numpy.asarray(within_offsets,
+                                            dtype=numpy.int64)
+        self.record_nums = numpy.asarray(record_nums, dtype=numpy.int64)
+        self.num_records = int(num_records)
+
+
+    def __len__(self):
+        return self.num_records
+
+
+    def __repr__(self):
+        return "FastqIndex(%d records, %d checkpoints)" \
+            %(self.num_records, len(self.record_nums))
+
+
+    def get_checkpoint(self, record_num):
+        """
+        Return the last checkpoint at or before a record.
+        """
+        return numpy.searchsorted(self.record_nums, record_num,
+                                  side="right") - 1
+
+
+    def get_window(self, checkpoint):
+        """
+        Return the window of a checkpoint's access point.
+        """
+        return self.windows[self.window_offsets[checkpoint]:\
+                            self.window_offsets[checkpoint + 1]].tostring()
+
+
+    def get_chunks(self, num_chunks):
+        """
+        Split the records into (at most) 'num_chunks' chunks of
+        about equal size that start at checkpoints. Returns a list
+        of (first record, number of records) pairs.
+        """
+        targets = numpy.linspace(0, self.num_records,
+                                 num_chunks + 1)[0:-1].astype(numpy.int64)
+        chunk_starts = \
+            numpy.unique(self.record_nums[[self.get_checkpoint(target) \
+                                           for target in targets]])
+        chunk_ends = numpy.append(chunk_starts[1:], self.num_records)
+        return [(int(first), int(last - first)) for first, last \
+                in zip(chunk_starts, chunk_ends) if last > first]
+
+
+    def save(self, output_filename,
+             fastq_filename=None):
+        """
+        Serialize the index as a NumPy .npz file.
+
+        - fastq_filename: the indexed file. Its size and modification
+          time are recorded so that the serialized index can be
+          invalidated when the file changes.
+        """
+        file_stat = [-1, -1]
+        if fastq_filename is not None:
+            file_stat = utils.get_file_stat(fastq_filename)
+        with utils.atomic_write(output_filename, "wb") as index_file:
+            numpy.savez_compressed(index_file,
+                                   index_version=numpy.array([FASTQ_INDEX_VERSION]),
+                                   file_stat=numpy.array(file_stat,
+                                                         dtype=numpy.float64),
+                                   compressed=numpy.array([self.compressed]),
+                                   point_offsets=self.point_offsets,
+                                   point_bits=self.point_bits,
+                                   windows=self.windows,
+                                   window_offsets=self.window_offsets,
+                                   within_offsets=self.within_offsets,
+                                   record_nums=self.record_nums,
+                                   num_records=numpy.array([self.num_records]))
+        return output_filename
+
+
+def is_gzip_file(filename):
+    """
+    Return True if a file is gzip compressed (judging by its
+    magic bytes, so BGZF files count as well.)
+    """
+    in_file = open(filename, "rb")
+    magic = in_file.read(2)
+    in_file.close()
+    return magic == gzip_utils.GZIP_MAGIC
+
+
+def iter_plain_blocks(in_file, read_size=(1 << 20)):
+    """
+    Read an uncompressed file, yielding (data, access point)
+    pieces as gzip_utils.iter_gzip_blocks does. Any offset of
+    the file is an access point.
+    """
+    offset = 0
+    yield "", (offset, 0)
+    while True:
+        data = in_file.read(read_size)
+        if not data:
+            break
+        offset += len(data)
+        yield data, (offset, 0)
+
+
+def iter_gzip_start_blocks(gz_file, read_size=(1 << 20)):
+    """
+    Decompress a gzip file with the gzip module, yielding (data,
+    access point) pieces where the only access point is the
+    start of the file.
+    """
+    yield "", (0, -1)
+    data_file = gzip.GzipFile(fileobj=gz_file, mode="rb")
+    while True:
+        data = data_file.read(read_size)
+        if not data:
+            break
+        yield data, None
+
+
+def iter_piece_lines(pieces, skip=0):
+    """
+    Split pieces of data into lines, after skipping the
+    first 'skip' bytes.
+    """
+    rest = ""
+    for data in pieces:
+        if skip > 0:
+            data, skip = data[skip:], max(skip - len(data), 0)
+        lines = (rest + data).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if rest:
+        yield rest
+
+
+def build_fastq_index(fastq_filename,
+                      checkpoint_interval=100000):
+    """
+    Index a FASTQ file (gzipped or not) in one pass.
+
+    - checkpoint_interval: minimum number of records between
+      checkpoints
+    """
+    print "Indexing %s..." %(fastq_filename)
+    t1 = time.time()
+    compressed = is_gzip_file(fastq_filename)
+    fastq_file = open(fastq_filename, "rb")
+    if not compressed:
+        pieces = iter_plain_blocks(fastq_file)
+    elif gzip_utils.has_libz():
+        pieces = gzip_utils.iter_gzip_blocks(fastq_file)
+    else:
+        print "WARNING: Cannot find the zlib library, so %s can only " \
+              "be read from its start." %(fastq_filename)
+        pieces = iter_gzip_start_blocks(fastq_file)
+    checkpoints = []
+    windows = []
+    # Last uncompressed data read, to start decompressing from
+    # access points of gzipped files
+    window = ""
+    # Number of lines seen so far, and whether the current
+    # position is at the start of a line
+    line_num = 0
+    at_line_start = True
+    data_offset = 0
+    # Access point waiting for the next record start
+    next_point = None
+    for data, point in pieces:
+        pos = 0
+        while next_point is not None:
+            if at_line_start and (line_num % 4 == 0) and (pos < len(data)):
+                point_offset, point_bits, point_data_offset, point_window = \
+                    next_point
+                checkpoints.append((point_offset,
+                                    point_bits,
+                                    data_offset + pos - point_data_offset,
+                                    line_num / 4))
+                windows.append(point_window)
+                next_point = None
+                break
+            newline_pos = data.find("\n", pos)
+            if newline_pos == -1:
+                break
+            line_num += 1
+            pos = newline_pos + 1
+            at_line_start = True
+        if pos < len(data):
+            line_num += data.count("\n", pos)
+            at_line_start = (data[-1] == "\n")
+        data_offset += len(data)
+        if compressed:
+            window = (window + data)[-gzip_utils.WINDOW_SIZE:]
+        if (point is not None) and (next_point is None) and \
+           ((len(checkpoints) == 0) or \
+            ((line_num / 4) - checkpoints[-1][3] >= checkpoint_interval)):
+            next_point = (point[0], point[1], data_offset, window)
+    fastq_file.close()
+    # A last line without a newline still ends a record
+    if not at_line_start:
+        line_num += 1
+    if len(checkpoints) == 0:
+        checkpoints.append((0, -1 if compressed else 0, 0, 0))
+        windows.append("")
+    point_offsets, point_bits, within_offsets, record_nums = \
+        zip(*checkpoints)
+    window_offsets = numpy.cumsum([0] + [len(w) for w in windows])
+    index = FastqIndex(compressed, point_offsets, point_bits,
+                       numpy.frombuffer("".join(windows), dtype=numpy.uint8),
+                       window_offsets, within_offsets, record_nums,
+                       line_num / 4)
+    t2 = time.time()
+    print "Indexed %d records (%d checkpoints) in %.2f secs" \
+        %(index.num_records, len(index.record_nums), (t2 - t1))
+    return index
+
+
+def load_fastq_index(index_filename,
+                     fastq_filename=None):
+    """
+    Load a serialized FastqIndex.
+
+    If 'fastq_filename' is given, return None if the index was
+    not made from the current version of the file.
+    """
+    index_data = numpy.load(index_filename)
+    try:
+        if ("index_version" not in index_data.files) or \
+           (int(index_data["index_version"][0]) != FASTQ_INDEX_VERSION):
+            return None
+        if (fastq_filename is not None) and \
+           (list(index_data["file_stat"]) != \
+            utils.get_file_stat(fastq_filename)):
+            return None
+        index = FastqIndex(index_data["compressed"][0],
+                           index_data["point_offsets"],
+                           index_data["point_bits"],
+                           index_data["windows"],
+                           index_data["window_offsets"],
+                           index_data["within_offsets"],
+                           index_data["record_nums"],
+                           index_data["num_records"][0])
+    finally:
+        index_data.close()
+    return index
+
+
+def get_fastq_index(fastq_filename,
+                    index_filename=None,
+                    checkpoint_interval=100000):
+    """
+    Return the FastqIndex of a FASTQ file, building it only if
+    there is no up-to-date serialized index.
+
+    - index_filename: where the index is serialized (defaults
+      to the FASTQ filename with a '.fqi.npz' extension.)
+    """
+    if index_filename is None:
+        index_filename = "%s.fqi.npz" %(fastq_filename)
+    if os.path.isfile(index_filename):
+        index = load_fastq_index(index_filename,
+                                 fastq_filename=fastq_filename)
+        if index is not None:
+            return index
+        print "FASTQ index %s is out of date." %(index_filename)
+    index = build_fastq_index(fastq_filename,
+                              checkpoint_interval=checkpoint_interval)
+    try:
+        index.save(index_filename, fastq_filename=fastq_filename)
+    except (IOError, OSError):
+        print "WARNING: Cannot save FASTQ index %s" %(index_filename)
+    return index
+
+
+def iter_fastq_range_lines(fastq_filename, first_record,
+                           num_records, index=None):
+    """
+    Yield the lines of 'num_records' records of a FASTQ file,
+    starting from record 'first_record', reading from the last
+    checkpoint before it.
+    """
+    if index is None:
+        index = get_fastq_index(fastq_filename)
+    checkpoint = index.get_checkpoint(first_record)
+    num_skipped = int(first_record - index.record_nums[checkpoint])
+    point_offset = int(index.point_offsets[checkpoint])
+    point_bits = int(index.point_bits[checkpoint])
+    within_offset = int(index.within_offsets[checkpoint])
+    fastq_file = open(fastq_filename, "rb")
+    try:
+        if not index.compressed:
+            fastq_file.seek(point_offset + within_offset)
+            lines = fastq_file
+        elif point_bits < 0:
+            fastq_file.seek(point_offset)
+            lines = gzip.GzipFile(fileobj=fastq_file, mode="rb")
+            lines.read(within_offset)
+        else:
+            pieces = gzip_utils.iter_gzip_from_point(fastq_file,
+                                                     point_offset,
+                                                     point_bits,
+                                                     index.get_window(checkpoint))
+            lines = iter_piece_lines(pieces, skip=within_offset)
+        for line in islice(lines, 4 * num_skipped,
+                           4 * (num_skipped + num_records)):
+            yield line
+    finally:
+        fastq_file.close()
+
+
+def read_fastq_range(fastq_filename, first_record, num_records,
+                     index=None):
+    """
+    Parse a range of records of a FASTQ file, yielding records
+    as read_fastq does.
+    """
+    return read_fastq(iter_fastq_range_lines(fastq_filename,
+                                             first_record,
+                                             num_records,
+                                             index=index))
+
+
+def read_fastq_range_batches(fastq_filename, first_record, num_records,
+                             index=None,
+                             batch_size=100000):
+    """
+    Parse a range of records of a FASTQ file in batches, as
+    read_fastq_batches does.
+    """
+    return read_fastq_batches(iter_fastq_range_lines(fastq_filename,
+                                                     first_record,
+                                                     num_records,
+                                                     index=index),
+                              batch_size=batch_size)
+
+
+def _run_on_fastq_chunk(chunk_task):
+    """
+    Run a function on one chunk of a FASTQ file. Used by the
+    process pool.
+    """
+    chunk_func, fastq_filename, index, chunk, chunk_args = chunk_task
+    first_record, num_records = chunk
+    return chunk_func(fastq_filename, index, first_record, num_records,
+                      *chunk_args)
+
+
+def map_fastq_chunks(fastq_filename, chunk_func,
+                     chunk_args=(),
+                     num_processors=1,
+                     num_chunks=None,
+                     index=None):
+    """
+    Run a function on chunks of a FASTQ file in parallel, each
+    process reading its own records from the file.
+
+    - chunk_func: module-level function called as
+
+        chunk_func(fastq_filename, index, first_record, num_records,
+                   *chunk_args)
+
+      which can read its records with read_fastq_range_batches
+    - num_chunks: number of chunks (defaults to four per process)
+
+    Returns the results of the chunks, in order of records.
+    """
+    if index is None:
+        index = get_fastq_index(fastq_filename)
+    if num_chunks is None:
+        num_chunks = 4 * num_processors
+    chunks = index.get_chunks(num_chunks)
+    if len(chunks) < min(num_chunks, len(index.record_nums)):
+        print "WARNING: %s can only be split into %d chunks." \
+            %(fastq_filename, len(chunks))
+    chunk_tasks = [(chunk_func, fastq_filename, index, chunk,
+                    tuple(chunk_args)) for chunk in chunks]
+    t1 = time.time()
+    if num_processors <= 1:
+        results = map(_run_on_fastq_chunk, chunk_tasks)
+    else:
+        pool = multiprocessing.Pool(processes=num_processors)
+        try:
+            results = pool.map(_run_on_fastq_chunk, chunk_tasks,
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    t2 = time.time()
+    print "Processed %d chunks of %s on %d processors in %.2f secs" \
+        %(len(chunk_tasks),
+          os.path.basename(fastq_filename),
+          num_processors,
+          (t2 - t1))
+    return results
+
+
                                                                                 
 def fastq_get_rec_id(line):
     if line.startswith("@"):
@@ -68,43 +938,166 @@ def fastq_get_rec_id(line):
     else:
         return line
 
-def fastq2fasta(settings_filename,
-                output_dir,
-                fieldname="fastq_filenames"):
+def format_fasta_batch(headers, seqs):
     """
-    Convert FASTQ to FASTA.
+    Return a batch of FASTQ records as FASTA text. Headers
+    must have their leading '@'.
     """
-    output_dir = os.path.join(output_dir, "fasta")
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
+    if len(headers) == 0:
+        return ""
+    lines = [None] * (2 * len(headers))
+    lines[0::2] = [">%s" %(header[1:]) for header in headers]
+    lines[1::2] = seqs
+    return "%s\n" %("\n".join(lines))
 
-    settings_info, parsed_settings = \
-                   settings.load_settings(settings_filename)
 
-    fastq_filenames = settings_info["data"][fieldname]
+def convert_fastq_to_fasta(fastq_filename, output_filename,
+                           batch_size=100000,
+                           compress_level=6):
+    """
+    Convert a FASTQ file (possibly gzipped) to FASTA in one
+    streaming pass. The output is gzipped if its name ends
+    in '.gz'.
 
-    queue_name = "quick"
+    Returns the number of records converted.
+    """
+    compressed = output_filename.endswith(".gz")
+    fastq_file = read_open_fastq(fastq_filename)
+    tmp_filename = utils.get_tmp_filename(output_filename)
+    out_file = open(tmp_filename, "wb")
+    num_records = 0
+    try:
+        for headers, seqs, headers2, quals in \
+            read_fastq_batches(fastq_file, batch_size=batch_size):
+            fasta_text = format_fasta_batch(headers, seqs)
+            if compressed:
+                fasta_text = compress_gzip_member(fasta_text,
+                                                  compress_level=compress_level)
+            out_file.write(fasta_text)
+            num_records += len(headers)
+    except:
+        out_file.close()
+        os.remove(tmp_filename)
+        raise
+    finally:
+        fastq_file.close()
+    out_file.close()
+    os.rename(tmp_filename, output_filename)
+    return num_records
 
-    for fastq in fastq_filenames:
-        sample_id, fastq_filename = fastq
-        print "Converting %s to FASTA" %(sample_id)
-        print "  FASTQ: %s" %(fastq_filename)
-        job_id = "fastq2fasta_%s" %(sample_id)
-        fastq_basename = os.path.basename(fastq_filename)
-        output_filename = os.path.join(output_dir,
-                                       "%s.fa" %(fastq_basename))
 
+def _convert_fastq_to_fasta(convert_task):
+    """
+    Convert one FASTQ file. Used by the process pool.
+    """
+    fastq_filename, output_filename, batch_size, compress_level = convert_task
+    t1 = time.time()
+    num_records = convert_fastq_to_fasta(fastq_filename, output_filename,
+                                         batch_size=batch_size,
+                                         compress_level=compress_level)
+    t2 = time.time()
+    return output_filename, num_records, (t2 - t1)
+
+
+def convert_fastqs_to_fasta(fastq_filenames, output_dir,
+                            num_processors=1,
+                            compress=False,
+                            batch_size=100000,
+                            compress_level=6):
+    """
+    Convert many FASTQ files to FASTA, converting files
+    concurrently on 'num_processors' processes.
+
+    Each file is written to '<FASTQ basename>.fa' (or '.fa.gz'
+    if 'compress' is True) in 'output_dir', where the basename
+    is without the FASTQ extensions. Existing outputs
+    are skipped. Returns the list of output files.
+    """
+    utils.make_dir(output_dir)
+    output_ext = "fa"
+    if compress:
+        output_ext = "fa.gz"
+    output_filenames = []
+    convert_tasks = []
+    for fastq_filename in fastq_filenames:
+        output_filename = \
+            os.path.join(output_dir,
+                         "%s.%s" %(get_fastq_basename(fastq_filename),
+                                   output_ext))
+        output_filenames.append(output_filename)
         if os.path.isfile(output_filename):
-            print "WARNING: %s exists. Aborting..." \
-                  %(output_filename)
+            print "WARNING: %s exists. Skipping..." %(output_filename)
             continue
-        fastq2fasta_cmd = "perl %s fq2fa %s > %s" %(FQCONVERT,
-                                                    fastq_filename,
-                                                    output_filename)
-        print "Running: %s" %(fastq2fasta_cmd)
-        cluster.run_on_cluster(fastq2fasta_cmd, job_id, output_dir,
-                               queue_name=queue_name,
-                               other_args="-l nodes=1:E5620")
+        convert_tasks.append((fastq_filename, output_filename,
+                              batch_size, compress_level))
+    t1 = time.time()
+    if num_processors <= 1:
+        results = (_convert_fastq_to_fasta(task) for task in convert_tasks)
+    else:
+        pool = multiprocessing.Pool(processes=num_processors)
+        results = pool.imap_unordered(_convert_fastq_to_fasta, convert_tasks)
+    try:
+        for output_filename, num_records, convert_time in results:
+            print "  - Wrote %d records to %s (%.2f secs)" \
+                %(num_records, output_filename, convert_time)
+    finally:
+        if num_processors > 1:
+            pool.close()
+            pool.join()
+    t2 = time.time()
+    print "Converted %d FASTQ files to FASTA in %.2f secs" \
+        %(len(convert_tasks), (t2 - t1))
+    return output_filenames
+
+
+def fastq2fasta(settings_filename,
+                output_dir,
+                fieldname="fastq_files",
+                num_processors=1,
+                compress=False,
+                cluster_type=None):
+    """
+    Convert FASTQ to FASTA.
+
+    Takes a settings file whose 'data' section lists the
+    FASTQ files as (sample_id, fastq_filename) pairs under
+    'fieldname'.
+
+    - cluster_type: if given, convert all the files as one
+      job on the cluster, using 'num_processors' processes
+    """
+    output_dir = os.path.join(output_dir, "fasta")
+    utils.make_dir(output_dir)
+    if cluster_type is not None:
+        logger = utils.get_logger("fastq2fasta", output_dir)
+        my_cluster = cluster.Cluster(cluster_type, output_dir, logger)
+        convert_cmd = "python %s --fastq2fasta %s --fastq-fieldname %s " \
+                      "--output-dir %s --num-processors %d" \
+                      %(os.path.abspath(__file__).replace(".pyc", ".py"),
+                        settings_filename,
+                        fieldname,
+                        os.path.dirname(output_dir),
+                        num_processors)
+        if compress:
+            convert_cmd += " --compress"
+        print "Running: %s" %(convert_cmd)
+        my_cluster.launch_and_wait(convert_cmd, "fastq2fasta",
+                                   ppn=num_processors)
+        return
+    # Only the FASTQ list is needed, so read it directly rather
+    # than loading (and checking) a full pipeline settings file
+    config = ConfigParser.ConfigParser()
+    if not config.read(settings_filename):
+        raise Exception, "Cannot read settings file %s" %(settings_filename)
+    if not config.has_option("data", fieldname):
+        raise Exception, "No '%s' field in [data] section of %s" \
+              %(fieldname, settings_filename)
+    fastq_filenames = [fastq_filename for sample_id, fastq_filename \
+                       in json.loads(config.get("data", fieldname))]
+    print "Converting %d FASTQ files to FASTA" %(len(fastq_filenames))
+    convert_fastqs_to_fasta(fastq_filenames, output_dir,
+                            num_processors=num_processors,
+                            compress=compress)
 
 def file_type(input):
     """given an input file, determine the type and return both type and record delimiter (> or @)"""
@@ -223,6 +1216,16 @@ def main():
                       "FASTQ filenames.")
     parser.add_option("--fastq-fieldname", dest="fastq_fieldname", default="fastq_files",
                       type="str", nargs=1)
+    parser.add_option("--num-processors", dest="num_processors", default=1,
+                      type="int", nargs=1,
+                      help="Number of FASTQ files to convert at once.")
+    parser.add_option("--compress", dest="compress", action="store_true",
+                      default=False,
+                      help="Gzip the FASTA output files.")
+    parser.add_option("--cluster-type", dest="cluster_type", default=None,
+                      type="str", nargs=1,
+                      help="Convert FASTQ files as one job on the cluster "
+                      "(bsub or qsub).")
     parser.add_option("--chunk-fasta", dest="chunk_fasta", nargs=2, default=None,
                       help="Chunk FASTA filename. Takes FASTA file and size (in Megabytes) to "
                       "chunk to.")
@@ -238,7 +1241,10 @@ def main():
 
     if options.fastq2fasta != None:
         settings_filename = os.path.abspath(os.path.expanduser(options.fastq2fasta))
-        fastq2fasta(settings_filename, output_dir, fieldname=options.fastq_fieldname)
+        fastq2fasta(settings_filename, output_dir, fieldname=options.fastq_fieldname,
+                    num_processors=options.num_processors,
+                    compress=options.compress,
+                    cluster_type=options.cluster_type)
     elif options.chunk_fasta != None:
         fasta_filename = os.path.abspath(os.path.expanduser(options.chunk_fasta[0]))
         chunk_size = int(options.chunk_fasta[1])
@@ -3,8 +3,13 @@
 ##
 import os
 import sys
+import re
 import time
 
+import itertools
+import multiprocessing
+from urllib import quote as url_quote
+
 import numpy
 from numpy import *
 
@@ -13,6 +18,11 @@ import misopy.gff_utils as gff_utils
 
 from collections import namedtuple
 
+# Characters escaped in GFF3 fields, as by misopy's gff_utils.Writer
+GFF_SEQID_PAT = re.compile(r'[^a-zA-Z0-9./:^*$@!+_?-|]')
+GFF_SOURCE_PAT = re.compile(r'[^a-zA-Z0-9./\(\): ^*$@!+_?-]')
+GFF_VALUE_PAT = re.compile(r'[\t\n\r\f\v;=%&,]')
+
 class Gene:
     """
     Representation of a gene model.
@@ -20,7 +30,8 @@ class Gene:
     By convention, all coordinates will be a 1-based start (GFF conventions.)
     """
     __slots__ = ['transcripts', 'chrom', 'strand', 'label', 'gene_symbol',
-                 'parts', 'const_exons', 'has_cds']
+                 'parts', 'cds_parts', 'const_exons', 'has_cds',
+                 'unique_parts']
     def __init__(self, transcripts, chrom, strand,
                  label=None,
                  gene_symbol=None):
@@ -31,6 +42,8 @@ class Gene:
         self.gene_symbol = gene_symbol
         self.const_exons = []
         self.has_cds = False
+        # Cached unique parts, keyed by whether they are CDS only
+        self.unique_parts = {}
         # Determine if the gene has at least one
         # CDS containing transcript
         for t in transcripts:
@@ -47,6 +60,25 @@ class Gene:
         for trans in self.transcripts:
             self.cds_parts.extend(trans.cds_parts)
 
+
+    def invalidate_cache(self):
+        """
+        Discard cached data derived from the gene's transcripts.
+        Must be called after the transcripts or their parts
+        are modified.
+        """
+        self.unique_parts = {}
+        self.const_exons = []
+        self.has_cds = False
+        self.parts = []
+        self.cds_parts = []
+        for trans in self.transcripts:
+            trans.invalidate_cache()
+            if trans.cds_coords is not None:
+                self.has_cds = True
+            self.parts.extend(trans.parts)
+            self.cds_parts.extend(trans.cds_parts)
+
             
     def get_inclusive_trans_coords(self):
         """
@@ -74,7 +106,12 @@ class Gene:
     def get_parts(self, cds_only=False):
         """
         Get all parts from all transcripts.
+
+        Parts with the same coordinates are returned once. The
+        result is cached.
         """
+        if cds_only in self.unique_parts:
+            return self.unique_parts[cds_only]
         seen_parts = {}
         parts = []
         for trans in self.transcripts:
@@ -89,9 +126,25 @@ class Gene:
                     continue
                 parts.append(exon)
                 seen_parts[(exon.start, exon.end)] = True
+        self.unique_parts[cds_only] = parts
         return parts
         
         
+    def get_const_exons_transcripts(self, cds_only=False):
+        """
+        Return the transcripts that constitutive exons are
+        computed over: all transcripts, or only the CDS containing
+        transcripts if 'cds_only' is True.
+        """
+        if cds_only:
+            # If asked for CDS-only but there's no CDS,
+            # then there are no transcripts to use
+            if not self.has_cds:
+                return []
+            return self.get_cds_transcripts()
+        return self.transcripts
+
+
     def compute_const_exons(self,
                             base_diff=6,
                             cds_only=False,
@@ -111,16 +164,10 @@ class Gene:
           when no truly constitutive exons are available.
         """
         self.const_exons = []
-        transcripts = []
-        if cds_only:
-            # If asked for CDS-only but there's no CDS,
-            # then quit
-            if not self.has_cds:
-                return self.const_exons
-            transcripts = self.get_cds_transcripts()
-        else:
-            transcripts = self.transcripts
+        transcripts = self.get_const_exons_transcripts(cds_only=cds_only)
         num_trans = len(transcripts)
+        if num_trans == 0:
+            return self.const_exons
         # If we have only one transcript then all
         # exons are constitutive
         if num_trans == 1:
@@ -129,37 +176,15 @@ class Gene:
             else:
                 self.const_exons = transcripts[0].parts
             return self.const_exons
-        # Iterate through each exon and determine what fraction
-        # of the transcripts it appears in.
+        # Determine what fraction of the transcripts each exon
+        # appears in.
         exons = self.get_parts(cds_only=cds_only)
-        # Exons that occur in at least a fraction of the transcripts
-        approx_const_exons = []
-        # Exons that occur in all transcripts
-        fully_const_exons = []
-        for exon in exons:
-            # Calculate if the exon is in or out of each
-            # transcript
-            exon_status = array([trans.has_part(exon,
-                                                base_diff=base_diff,
-                                                cds_only=cds_only) \
-                                 for trans in transcripts])
-            # Compute the fraction of transcripts in which the exon
-            # occurs.
-            in_transcripts_frac = \
-                len(where(exon_status == True)[0]) / float(num_trans)
-            if in_transcripts_frac >= frac_const:
-                # Track which exons are fully constitutive, i.e.
-                # occur in all exons
-                if in_transcripts_frac == 1:
-                    fully_const_exons.append(exon)
-                approx_const_exons.append(exon)
-        # If there's one or more fully constitutive exons, use these only
-        if len(fully_const_exons) >= 1:
-            self.const_exons = fully_const_exons
-        else:
-            # Otherwise use the nearly-constitutive exons (i.e. exons
-            # that occur in a high fraction of the transcripts)
-            self.const_exons = approx_const_exons
+        exons_coords = get_const_exons_coords(exons, transcripts,
+                                              cds_only=cds_only)
+        const_inds = get_const_exon_indices(*exons_coords,
+                                            base_diff=base_diff,
+                                            frac_const=frac_const)
+        self.const_exons = [exons[ind] for ind in const_inds]
         return self.const_exons
 
 #     def old_compute_const_exons(self,
@@ -273,8 +298,11 @@ class Transcript:
     Transcript of a gene.
     """
     __slots__ = ['parts', 'chrom', 'strand', 'label',
+                 'start', 'end', 'gene', 'has_cds',
                  'cds_start', 'cds_end', 'cds_coords',
-                 'cds_parts', 'parent']
+                 'cds_parts', 'parent',
+                 'cds_min_len', 'exon_coords', 'cds_exon_coords',
+                 'intron_coords']
     def __init__(self, parts, chrom, strand,
                  label=None,
                  cds_start=None,
@@ -294,10 +322,33 @@ class Transcript:
         self.cds_coords = (self.cds_start,
                            self.cds_end)
         self.parent = parent
+        # Derived data, computed on first use
+        self.cds_min_len = None
+        self.exon_coords = None
+        self.cds_exon_coords = None
+        self.intron_coords = None
         self.cds_parts = self.get_cds_parts()
         self.has_cds = False
         if len(self.cds_parts) > 0:
             self.has_cds = True
+
+
+    def invalidate_cache(self):
+        """
+        Discard cached data derived from the transcript's parts
+        and CDS coordinates (CDS parts, exon and intron coordinates.)
+        Must be called after the parts or CDS coordinates are modified.
+        """
+        self.start = self.parts[0].start
+        self.end = self.parts[-1].end
+        self.cds_coords = (self.cds_start,
+                           self.cds_end)
+        self.cds_min_len = None
+        self.exon_coords = None
+        self.cds_exon_coords = None
+        self.intron_coords = None
+        self.cds_parts = self.get_cds_parts()
+        self.has_cds = (len(self.cds_parts) > 0)
             
         
     def __repr__(self):
@@ -324,27 +375,50 @@ class Transcript:
         - cds_only: whether to use CDS only parts of the
           transcript
         """
-        trans_parts = []
-        if cds_only:
-            trans_parts = self.get_cds_parts()
-        else:
-            trans_parts = self.parts
-        if len(trans_parts) == 0:
+        exon_coords = self.get_exon_coords(cds_only=cds_only)
+        if len(exon_coords) == 0:
             # If no parts found, assume that the exon
             # is not present in the transcript
             return False
-        # Compute the start coord difference and end coord difference
-        # between our exon and each exon in the current transcript
-        start_end_diffs = array([(abs(part.start - curr_exon.start),
-                                  abs(part.end - curr_exon.end)) \
-                                  for curr_exon in trans_parts])
         # The exon is NOT considered constitutive if there are no exons
         # in the transcripts whose start/end diff with the current exon
         # is less than or equal to 'base_diff'
-        status = all(start_end_diffs <= base_diff, axis=1)
-        if all(status == False):
-            return False
-        return True
+        status = (numpy.abs(exon_coords[:, 0] - part.start) <= base_diff) & \
+                 (numpy.abs(exon_coords[:, 1] - part.end) <= base_diff)
+        return bool(status.any())
+
+
+    def get_exon_coords(self, cds_only=False):
+        """
+        Return the (start, end) coordinates of the transcript's
+        parts, or of its CDS parts if 'cds_only' is True, as an
+        N x 2 array sorted by start. The result is cached.
+        """
+        if cds_only:
+            if self.cds_exon_coords is None:
+                self.cds_exon_coords = \
+                    get_parts_coords(self.get_cds_parts())
+            return self.cds_exon_coords
+        if self.exon_coords is None:
+            self.exon_coords = get_parts_coords(self.parts)
+        return self.exon_coords
+
+
+    def get_intron_coords(self):
+        """
+        Return the (start, end) coordinates of the introns between
+        the transcript's parts as an N x 2 array. The result is
+        cached.
+        """
+        if self.intron_coords is None:
+            exon_coords = self.get_exon_coords()
+            # Introns start right after the end of an exon and
+            # end right before the start of the next exon
+            intron_coords = numpy.column_stack((exon_coords[:-1, 1] + 1,
+                                                exon_coords[1:, 0] - 1))
+            self.intron_coords = \
+                intron_coords[intron_coords[:, 0] <= intron_coords[:, 1]]
+        return self.intron_coords
 
     
     def get_cds_parts(self, min_cds_len=10):
@@ -354,11 +428,17 @@ class Transcript:
 
         If the CDS length is less than 'min_cds_len' nucleotides,
         skip it altogether.
+
+        The CDS parts are cached: they are only recomputed if
+        asked for with a different 'min_cds_len'.
         """
+        if self.cds_min_len == min_cds_len:
+            return self.cds_parts
+        self.cds_min_len = min_cds_len
+        self.cds_exon_coords = None
         self.cds_parts = []
-        cds_len = self.cds_end - self.cds_start + 1
         if (self.cds_start is None) or \
-           (cds_len < min_cds_len):
+           (self.cds_end - self.cds_start + 1 < min_cds_len):
             return self.cds_parts
         # Compute the parts that are in the CDS
         for part in self.parts:
@@ -454,19 +534,223 @@ def output_parts_as_gff(gff_out, parts, chrom, strand,
                         na_val="NA"):
     """
     Output a set of parts to GFF.
+
+    - gff_out: a gff_utils.Writer
+    """
+    attributes = [("gene_id", [gene_id] * len(parts)),
+                  ("ID", ["%s.%s" %(rec_type, part.label) for part in parts]),
+                  ("Parent", [part.parent for part in parts])]
+    gff_lines = format_gff_lines([chrom] * len(parts),
+                                 [part.start for part in parts],
+                                 [part.end for part in parts],
+                                 [strand] * len(parts),
+                                 attributes,
+                                 source=source,
+                                 rec_type=rec_type)
+    gff_out.stream.write("".join(gff_lines))
+
+
+def quote_gff_values(values, pattern=GFF_VALUE_PAT):
+    """
+    Escape the characters of GFF3 field values that are
+    reserved in the given field.
+    """
+    values = map(str, values)
+    # Most values need no escaping; check them all at once
+    if pattern.search("".join(values)) is None:
+        return values
+    quote_sub = lambda match: url_quote(match.group(0))
+    return [pattern.sub(quote_sub, value) for value in values]
+
+
+def format_gff_lines(chroms, starts, ends, strands, attributes,
+                     source=".",
+                     rec_type="exon"):
+    """
+    Return GFF3 lines for records given as parallel arrays
+    (or lists), formatted as by misopy's gff_utils.Writer.
+
+    - chroms, strands: chromosome and strand of each record
+    - starts, ends: 1-based coordinates of each record
+    - attributes: list of (tag, values) pairs, giving the
+      value of the tag for each record, in output order
+    - source, rec_type: source and type of all records
+    """
+    if len(starts) == 0:
+        return []
+    # Chromosomes repeat, so only escape the distinct ones
+    chrom_names = dict((chrom, quote_gff_values([chrom], GFF_SEQID_PAT)[0]) \
+                       for chrom in set(chroms))
+    rec_prefix = "\t%s\t%s\t" %(quote_gff_values([source], GFF_SOURCE_PAT)[0],
+                                 quote_gff_values([rec_type], GFF_SOURCE_PAT)[0])
+    attr_values = [["%s=%s" %(tag, value) \
+                    for value in quote_gff_values(values)] \
+                   for tag, values in attributes]
+    attr_strs = [";".join(attrs) for attrs in itertools.izip(*attr_values)]
+    gff_lines = ["%s%s%d\t%d\t.\t%s\t.\t%s\n" %(chrom_names[chrom],
+                                                  rec_prefix,
+                                                  start, end,
+                                                  strand,
+                                                  attr_str) \
+                 for chrom, start, end, strand, attr_str \
+                 in itertools.izip(chroms, starts, ends, strands, attr_strs)]
+    return gff_lines
+
+
+def get_parts_coords(parts):
+    """
+    Return the (start, end) coordinates of parts as an
+    N x 2 array sorted by start.
+    """
+    coords = numpy.empty((len(parts), 2), dtype=int64)
+    for n, part in enumerate(parts):
+        coords[n, 0] = part.start
+        coords[n, 1] = part.end
+    return coords[numpy.argsort(coords[:, 0], kind="mergesort")]
+
+
+##
+## Constitutive exons utilities
+##
+def get_const_exons_coords(exons, transcripts,
+                           cds_only=False):
+    """
+    Return the flat coordinate arrays that constitutive exons
+    are computed from:
+
+      (exon_starts, exon_ends, part_starts, part_ends,
+       part_trans, num_trans)
+
+    where the part arrays hold the parts of all the transcripts
+    and 'part_trans' is the index of the transcript each part
+    belongs to.
+    """
+    exon_starts = array([exon.start for exon in exons], dtype=int64)
+    exon_ends = array([exon.end for exon in exons], dtype=int64)
+    trans_coords = [trans.get_exon_coords(cds_only=cds_only) \
+                    for trans in transcripts]
+    part_coords = numpy.concatenate(trans_coords)
+    part_trans = repeat(arange(len(transcripts)),
+                        [len(coords) for coords in trans_coords])
+    return (exon_starts,
+            exon_ends,
+            part_coords[:, 0],
+            part_coords[:, 1],
+            part_trans,
+            len(transcripts))
+
+
+def get_const_exon_indices(exon_starts, exon_ends,
+                           part_starts, part_ends,
+                           part_trans, num_trans,
+                           base_diff=6,
+                           frac_const=.8):
+    """
+    Return the indices of the constitutive exons of a gene,
+    given its exons and the parts of its transcripts as flat
+    coordinate arrays (see get_const_exons_coords.)
+
+    An exon occurs in a transcript if the transcript has a part
+    whose start and end are both within 'base_diff' of the exon's.
+    Exons that occur in all transcripts are returned if there
+    are any; otherwise exons that occur in at least 'frac_const'
+    of the transcripts are returned.
+
+    Parts are sorted by start so that only the parts whose start
+    is within 'base_diff' of an exon's start are compared to it.
+    """
+    num_exons = len(exon_starts)
+    if (num_exons == 0) or (num_trans == 0):
+        return array([], dtype=int64)
+    # Find the window of sorted parts that start within
+    # 'base_diff' of each exon start
+    parts_order = argsort(part_starts, kind="mergesort")
+    sorted_starts = part_starts[parts_order]
+    window_starts = searchsorted(sorted_starts, exon_starts - base_diff,
+                                 side="left")
+    window_ends = searchsorted(sorted_starts, exon_starts + base_diff,
+                               side="right")
+    window_lens = window_ends - window_starts
+    # Expand the windows into (exon, part) candidate pairs
+    cand_exons = repeat(arange(num_exons), window_lens)
+    cand_offsets = arange(window_lens.sum()) - \
+        repeat(cumsum(window_lens) - window_lens, window_lens)
+    cand_parts = parts_order[repeat(window_starts, window_lens) + cand_offsets]
+    # Keep pairs whose ends match too
+    matched = numpy.abs(part_ends[cand_parts] - exon_ends[cand_exons]) \
+        <= base_diff
+    # Record which transcripts each exon occurs in
+    in_transcripts = zeros((num_exons, num_trans), dtype=bool)
+    in_transcripts[cand_exons[matched], part_trans[cand_parts[matched]]] = True
+    # Compute the fraction of transcripts in which each exon
+    # occurs.
+    in_transcripts_frac = in_transcripts.sum(axis=1) / float(num_trans)
+    approx_const = in_transcripts_frac >= frac_const
+    # Track which exons are fully constitutive, i.e.
+    # occur in all transcripts
+    fully_const = approx_const & (in_transcripts_frac == 1)
+    # If there's one or more fully constitutive exons, use these only
+    if fully_const.any():
+        return where(fully_const)[0]
+    # Otherwise use the nearly-constitutive exons (i.e. exons
+    # that occur in a high fraction of the transcripts)
+    return where(approx_const)[0]
+
+
+def _get_const_exon_indices_task(task):
+    """
+    Compute constitutive exon indices for one gene. Used by
+    the process pool.
+    """
+    exons_coords, base_diff, frac_const = task
+    return get_const_exon_indices(*exons_coords,
+                                  base_diff=base_diff,
+                                  frac_const=frac_const)
+
+
+def compute_genes_const_exons(genes,
+                              base_diff=6,
+                              cds_only=False,
+                              frac_const=.8,
+                              num_processors=1):
+    """
+    Compute the constitutive exons of a collection of genes,
+    setting the 'const_exons' of each gene.
+
+    Genes are sent to a pool of 'num_processors' processes as
+    flat coordinate arrays. Returns the genes.
     """
-    for part in parts:
-        attributes = {
-            'ID': ["%s.%s" %(rec_type, part.label)],
-            'Parent': [part.parent],
-            'gene_id': [gene_id],
-            }
-        rec_start, rec_end = part.start, part.end
-        gff_rec = gff_utils.GFF(chrom, source, rec_type,
-                                rec_start, rec_end,
-                                attributes=attributes,
-                                strand=strand)
-        gff_out.write(gff_rec)
+    genes = list(genes)
+    tasks = []
+    task_genes = []
+    for gene in genes:
+        transcripts = gene.get_const_exons_transcripts(cds_only=cds_only)
+        if len(transcripts) <= 1:
+            # No comparison between transcripts needed
+            gene.compute_const_exons(base_diff=base_diff,
+                                     cds_only=cds_only,
+                                     frac_const=frac_const)
+            continue
+        exons = gene.get_parts(cds_only=cds_only)
+        exons_coords = get_const_exons_coords(exons, transcripts,
+                                              cds_only=cds_only)
+        tasks.append((exons_coords, base_diff, frac_const))
+        task_genes.append((gene, exons))
+    if num_processors > 1:
+        # Send genes to the processes in a few chunks each
+        chunksize = len(tasks) / (num_processors * 4) + 1
+        pool = multiprocessing.Pool(processes=num_processors)
+        try:
+            const_inds = pool.map(_get_const_exon_indices_task, tasks,
+                                  chunksize=chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        const_inds = map(_get_const_exon_indices_task, tasks)
+    for (gene, exons), gene_const_inds in zip(task_genes, const_inds):
+        gene.const_exons = [exons[ind] for ind in gene_const_inds]
+    return genes
 
 
 ##
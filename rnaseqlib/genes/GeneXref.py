@@ -0,0 +1,387 @@
+##
+## Cross-reference index of gene identifiers
+##
+## Maps between Ensembl gene and transcript IDs, UCSC known
+## transcript IDs, RefSeq IDs, gene symbols and gene descriptions.
+## Each mapping is a pair of arrays sorted by key, so that a list
+## of IDs is mapped with one searchsorted call. The index is built
+## once from the UCSC tables and serialized next to them as
+## 'ensGene.xref.npz'.
+##
+## Identifier types:
+##
+##   - ensembl_gene: Ensembl gene ID (ensGene 'name2')
+##   - ensembl_trans: Ensembl transcript ID (ensGene 'name')
+##   - known: UCSC known transcript ID (kgID)
+##   - refseq: RefSeq ID
+##   - symbol: gene symbol
+##   - desc: gene description
+##
+import os
+import sys
+import time
+
+from collections import defaultdict
+
+import numpy
+
+import pandas
+
+import rnaseqlib
+import rnaseqlib.genes.TranscriptStore as TranscriptStore
+
+# Version of the serialized index; bump when the layout changes
+XREF_VERSION = 1
+
+# UCSC tables the index is built from
+XREF_TABLES = ["ensGene.txt",
+               "ensemblToGeneName.txt",
+               "knownToEnsembl.txt",
+               "kgXref.txt"]
+
+# Mappings held by the index, as (from type, to type)
+XREF_MAPS = [("ensembl_trans", "ensembl_gene"),
+             ("ensembl_gene", "ensembl_trans"),
+             ("ensembl_trans", "known"),
+             ("known", "ensembl_trans"),
+             ("ensembl_gene", "refseq"),
+             ("refseq", "ensembl_gene"),
+             ("ensembl_gene", "symbol"),
+             ("symbol", "ensembl_gene"),
+             ("ensembl_gene", "desc")]
+
+# Indices loaded in this process, by filename
+loaded_xrefs = {}
+
+
+class XrefMap:
+    """
+    Mapping from keys to one or more values, stored as
+    arrays sorted by key. The values of a key keep the
+    order in which they were given.
+    """
+    def __init__(self, keys, values,
+                 sort=True):
+        self.keys = numpy.asarray(keys).astype("S")
+        self.values = numpy.asarray(values).astype("S")
+        if sort:
+            keys_order = numpy.argsort(self.keys, kind="mergesort")
+            self.keys = self.keys[keys_order]
+            self.values = self.values[keys_order]
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def __repr__(self):
+        return "XrefMap(%d entries)" %(len(self.keys))
+
+
+    def get_ranges(self, query_keys):
+        """
+        Return the start and end indices of the entries
+        of each of the query keys.
+        """
+        query_keys = numpy.asarray(query_keys).astype("S")
+        starts = numpy.searchsorted(self.keys, query_keys, side="left")
+        ends = numpy.searchsorted(self.keys, query_keys, side="right")
+        return starts, ends
+
+
+    def lookup(self, query_keys, na_val="NA"):
+        """
+        Return an array of the first value of each of the
+        query keys ('na_val' for keys that are not mapped.)
+        """
+        starts, ends = self.get_ranges(query_keys)
+        found = (ends > starts)
+        values = numpy.empty(len(starts), dtype=object)
+        values[:] = na_val
+        values[found] = self.values[starts[found]].astype(object)
+        return values
+
+
+    def lookup_all(self, query_keys):
+        """
+        Return a list of the values of each of the
+        query keys.
+        """
+        starts, ends = self.get_ranges(query_keys)
+        return [self.values[start:end].tolist() \
+                for start, end in zip(starts, ends)]
+
+
+    def to_dict(self):
+        """
+        Return the mapping as a defaultdict of lists.
+        """
+        mapping = defaultdict(list)
+        for key, value in zip(self.keys.tolist(), self.values.tolist()):
+            mapping[key].append(value)
+        return mapping
+
+
+class GeneXref:
+    """
+    Cross-reference index of gene identifiers.
+    """
+    def __init__(self, maps, na_val="NA"):
+        # Mappings by (from type, to type)
+        self.maps = maps
+        self.na_val = na_val
+
+
+    def __repr__(self):
+        return "GeneXref(%s)" \
+            %(", ".join("%s->%s" %(from_type, to_type) \
+                        for from_type, to_type in sorted(self.maps)))
+
+
+    def get_map(self, from_type, to_type):
+        if (from_type, to_type) not in self.maps:
+            raise Exception, "No mapping from %s to %s." %(from_type,
+                                                           to_type)
+        return self.maps[(from_type, to_type)]
+
+
+    def map_ids(self, ids, from_type, to_type):
+        """
+        Map a list of IDs, returning an array with the first
+        match of each (NA for IDs with no match.)
+        """
+        return self.get_map(from_type, to_type).lookup(ids,
+                                                       na_val=self.na_val)
+
+
+    def map_ids_all(self, ids, from_type, to_type):
+        """
+        Map a list of IDs, returning a list of all the
+        matches of each.
+        """
+        return self.get_map(from_type, to_type).lookup_all(ids)
+
+
+    def get_genes_symbols(self, gene_ids):
+        """
+        Return an array of the symbols of a list of Ensembl genes.
+        """
+        return self.map_ids(gene_ids, "ensembl_gene", "symbol")
+
+
+    def get_genes_descs(self, gene_ids):
+        """
+        Return an array of the descriptions of a list of Ensembl genes.
+        """
+        return self.map_ids(gene_ids, "ensembl_gene", "desc")
+
+
+    def save(self, output_filename,
+             table_dir=None):
+        """
+        Serialize the index as a NumPy .npz file.
+
+        - table_dir: directory of the tables the index was built
+          from. Their sizes and modification times are recorded so
+          that the index can be invalidated when they change.
+        """
+        arrays = {}
+        for (from_type, to_type), xref_map in self.maps.iteritems():
+            map_name = "%s.%s" %(from_type, to_type)
+            arrays["%s.keys" %(map_name)] = xref_map.keys
+            arrays["%s.values" %(map_name)] = xref_map.values
+        tables_stat = get_tables_stat(table_dir) if table_dir is not None \
+                      else []
+        # Write to a temporary file first so that an interrupted
+        # save does not leave a truncated index behind
+        tmp_filename = "%s.tmp.npz" %(output_filename.rsplit(".npz", 1)[0])
+        numpy.savez(tmp_filename,
+                    xref_version=numpy.array([XREF_VERSION]),
+                    tables_stat=numpy.array(tables_stat, dtype=numpy.float64),
+                    **arrays)
+        os.rename(tmp_filename, output_filename)
+        return output_filename
+
+
+def read_ucsc_table(table_filename, usecols, names):
+    """
+    Read columns of a headerless UCSC table as strings. Returns
+    an empty table (with a warning) if the table does not exist.
+    """
+    if not os.path.isfile(table_filename):
+        print "WARNING: Cannot find table %s" %(table_filename)
+        return pandas.DataFrame(dict((name, []) for name in names),
+                                columns=names)
+    table = pandas.read_table(table_filename,
+                              sep="\t",
+                              header=None,
+                              usecols=usecols,
+                              dtype=str)
+    table.columns = names
+    return table
+
+
+def first_values(table, key_col, value_col, keys):
+    """
+    Return an array of the values of the first rows of 'table'
+    whose 'key_col' matches each of the keys (NaN if none.)
+    """
+    values = table.drop_duplicates(subset=[key_col]).set_index(key_col)
+    return values[value_col].reindex(keys).values
+
+
+def make_map(table, key_col, value_col):
+    """
+    Make an XrefMap from the unique (key, value) pairs of two
+    columns, skipping pairs with a missing key or value.
+    """
+    pairs = table[[key_col, value_col]].dropna().drop_duplicates()
+    return XrefMap(pairs[key_col].values, pairs[value_col].values)
+
+
+def build_gene_xref(table_dir, na_val="NA"):
+    """
+    Build the cross-reference index from the UCSC tables
+    in 'table_dir'.
+
+    Gene symbols come from ensemblToGeneName if available and
+    otherwise from kgXref; symbols and descriptions of a gene
+    are those of its first transcript in ensGene.
+    """
+    print "Building gene cross-reference index from %s" %(table_dir)
+    t1 = time.time()
+    ensGene = read_ucsc_table(os.path.join(table_dir, "ensGene.txt"),
+                              [1, 12],
+                              ["name", "name2"])
+    trans_to_names = read_ucsc_table(os.path.join(table_dir,
+                                                  "ensemblToGeneName.txt"),
+                                     [0, 1],
+                                     ["name", "value"])
+    known_to_ensembl = read_ucsc_table(os.path.join(table_dir,
+                                                    "knownToEnsembl.txt"),
+                                       [0, 1],
+                                       ["knownGene_name", "name"])
+    kgXref = read_ucsc_table(os.path.join(table_dir, "kgXref.txt"),
+                             [0, 4, 5, 7],
+                             ["kgID", "geneSymbol", "refseq", "description"])
+    kgXref = kgXref.dropna(subset=["kgID"])
+    maps = {}
+    maps[("ensembl_trans", "ensembl_gene")] = \
+        make_map(ensGene, "name", "name2")
+    maps[("ensembl_gene", "ensembl_trans")] = \
+        make_map(ensGene, "name2", "name")
+    maps[("ensembl_trans", "known")] = \
+        make_map(known_to_ensembl, "name", "knownGene_name")
+    maps[("known", "ensembl_trans")] = \
+        make_map(known_to_ensembl, "knownGene_name", "name")
+    # Every gene to RefSeq pair through the UCSC IDs of
+    # the gene's transcripts
+    trans_refseqs = pandas.merge(ensGene, known_to_ensembl,
+                                 how="left")
+    trans_refseqs = pandas.merge(trans_refseqs, kgXref,
+                                 how="left",
+                                 left_on=["knownGene_name"],
+                                 right_on=["kgID"])
+    trans_refseqs = trans_refseqs[trans_refseqs["refseq"] != na_val]
+    maps[("ensembl_gene", "refseq")] = \
+        make_map(trans_refseqs, "name2", "refseq")
+    maps[("refseq", "ensembl_gene")] = \
+        make_map(trans_refseqs, "refseq", "name2")
+    # Symbols and descriptions of each transcript, via
+    # its first UCSC ID
+    trans_ids = ensGene["name"].values
+    known_ids = first_values(known_to_ensembl, "name", "knownGene_name",
+                             trans_ids)
+    if len(trans_to_names) > 0:
+        symbols = first_values(trans_to_names, "name", "value", trans_ids)
+    else:
+        symbols = first_values(kgXref, "kgID", "geneSymbol", known_ids)
+    genes_info = pandas.DataFrame({"name2": ensGene["name2"].values,
+                                   "symbol": symbols,
+                                   "desc": first_values(kgXref, "kgID",
+                                                        "description",
+                                                        known_ids)})
+    genes_info = genes_info.drop_duplicates(subset=["name2"])
+    maps[("ensembl_gene", "symbol")] = \
+        make_map(genes_info, "name2", "symbol")
+    maps[("symbol", "ensembl_gene")] = \
+        make_map(genes_info, "symbol", "name2")
+    maps[("ensembl_gene", "desc")] = \
+        make_map(genes_info, "name2", "desc")
+    t2 = time.time()
+    print "Building index took %.2f secs" %(t2 - t1)
+    return GeneXref(maps, na_val=na_val)
+
+
+def load_gene_xref(xref_filename,
+                   table_dir=None,
+                   na_val="NA"):
+    """
+    Load a serialized cross-reference index.
+
+    If 'table_dir' is given, return None if the index was not
+    built from the current version of its tables.
+    """
+    xref_data = numpy.load(xref_filename)
+    try:
+        if ("xref_version" not in xref_data.files) or \
+           (xref_data["xref_version"][0] != XREF_VERSION):
+            return None
+        if table_dir is not None:
+            if list(xref_data["tables_stat"]) != get_tables_stat(table_dir):
+                return None
+        maps = {}
+        for from_type, to_type in XREF_MAPS:
+            map_name = "%s.%s" %(from_type, to_type)
+            maps[(from_type, to_type)] = \
+                XrefMap(xref_data["%s.keys" %(map_name)],
+                        xref_data["%s.values" %(map_name)],
+                        sort=False)
+    finally:
+        xref_data.close()
+    return GeneXref(maps, na_val=na_val)
+
+
+def get_gene_xref(table_dir,
+                  xref_filename=None,
+                  na_val="NA"):
+    """
+    Return the cross-reference index of the UCSC tables in
+    'table_dir'. The index is built and serialized if it does
+    not exist or is out of date, and kept in memory once loaded.
+
+    - xref_filename: where the index is serialized (defaults to
+      'ensGene.xref.npz' in the tables directory.)
+    """
+    if xref_filename is None:
+        xref_filename = os.path.join(table_dir, "ensGene.xref.npz")
+    if xref_filename in loaded_xrefs:
+        return loaded_xrefs[xref_filename]
+    gene_xref = None
+    if os.path.isfile(xref_filename):
+        gene_xref = load_gene_xref(xref_filename,
+                                   table_dir=table_dir,
+                                   na_val=na_val)
+        if gene_xref is None:
+            print "Gene cross-reference index %s is out of date." \
+                %(xref_filename)
+    if gene_xref is None:
+        gene_xref = build_gene_xref(table_dir, na_val=na_val)
+        gene_xref.save(xref_filename, table_dir=table_dir)
+    loaded_xrefs[xref_filename] = gene_xref
+    return gene_xref
+
+
+def get_tables_stat(table_dir):
+    """
+    Return the sizes and modification times of the tables
+    the index is built from (-1 for missing tables.)
+    """
+    tables_stat = []
+    for table_name in XREF_TABLES:
+        table_filename = os.path.join(table_dir, table_name)
+        if os.path.isfile(table_filename):
+            tables_stat.extend(TranscriptStore.get_table_stat(table_filename))
+        else:
+            tables_stat.extend([-1., -1.])
+    return tables_stat
@@ -0,0 +1,880 @@
+##
+## Columnar store of transcript models
+##
+## The transcripts of a genePred-style table (such as ensGene.txt)
+## are held as flat NumPy arrays rather than as Gene, Transcript
+## and Part objects:
+##
+##   - per transcript: chromosome code, strand, transcript and
+##     CDS bounds, transcript ID and gene ID
+##   - exons: flat start/end arrays in CSR layout, i.e. the exons
+##     of transcript i are exon_starts[exon_offsets[i]:exon_offsets[i+1]]
+##   - genes: transcript indices grouped by gene in CSR layout,
+##     genes in order of first appearance in the table
+##
+## Coordinates are kept as in the table (0-based starts, 1-based
+## ends.) Gene objects are only built on request (see GenesView.)
+##
+## Any UCSC gene table in genePred layout can be read: plain
+## genePred, genePredExt (ensGene, refGene) and knownGene, with
+## or without the leading 'bin' column.
+##
+import os
+import sys
+import time
+import hashlib
+
+import numpy
+
+import pandas
+
+import rnaseqlib
+import rnaseqlib.genes.GeneModel as GeneModel
+
+# Version of the serialized store; bump when the layout changes
+STORE_VERSION = 2
+
+# Arrays that make up a serialized store
+STORE_ARRAYS = ["trans_ids",
+                "gene_ids",
+                "chroms",
+                "chrom_names",
+                "strands",
+                "tx_starts",
+                "tx_ends",
+                "cds_starts",
+                "cds_ends",
+                "exon_starts",
+                "exon_ends",
+                "exon_offsets"]
+
+# Columns of UCSC gene tables
+GENEPRED_FIELDS = ["name",
+                   "chrom",
+                   "strand",
+                   "txStart",
+                   "txEnd",
+                   "cdsStart",
+                   "cdsEnd",
+                   "exonCount",
+                   "exonStarts",
+                   "exonEnds"]
+GENEPRED_EXT_FIELDS = GENEPRED_FIELDS + ["score",
+                                         "name2",
+                                         "cdsStartStat",
+                                         "cdsEndStat",
+                                         "exonFrames"]
+KNOWNGENE_FIELDS = GENEPRED_FIELDS + ["proteinID",
+                                      "alignID"]
+
+# Table layouts by number of columns
+GENEPRED_LAYOUTS = {10: GENEPRED_FIELDS,
+                    11: ["bin"] + GENEPRED_FIELDS,
+                    12: KNOWNGENE_FIELDS,
+                    15: GENEPRED_EXT_FIELDS,
+                    16: ["bin"] + GENEPRED_EXT_FIELDS}
+
+
+class TranscriptStore:
+    """
+    Columnar representation of a table of transcripts.
+    """
+    def __init__(self, trans_ids, gene_ids,
+                 chroms, chrom_names, strands,
+                 tx_starts, tx_ends,
+                 cds_starts, cds_ends,
+                 exon_starts, exon_ends, exon_offsets,
+                 na_val="NA"):
+        self.trans_ids = trans_ids
+        self.gene_ids = gene_ids
+        self.chroms = chroms
+        self.chrom_names = chrom_names
+        self.strands = strands
+        self.tx_starts = tx_starts
+        self.tx_ends = tx_ends
+        self.cds_starts = cds_starts
+        self.cds_ends = cds_ends
+        self.exon_starts = exon_starts
+        self.exon_ends = exon_ends
+        self.exon_offsets = exon_offsets
+        self.na_val = na_val
+        # Genes in order of first appearance
+        self.gene_labels = None
+        # Transcripts grouped by gene: the transcripts of
+        # gene g are gene_trans[gene_offsets[g]:gene_offsets[g+1]]
+        self.gene_trans = None
+        self.gene_offsets = None
+        # Sorted gene labels and their gene numbers, for lookups
+        self.sorted_gene_labels = None
+        self.sorted_gene_nums = None
+        self.index_genes()
+
+
+    def __len__(self):
+        return len(self.trans_ids)
+
+
+    def __repr__(self):
+        return "TranscriptStore(%d transcripts, %d genes)" \
+            %(len(self.trans_ids), len(self.gene_labels))
+
+
+    def index_genes(self):
+        """
+        Group transcripts by gene. Transcripts of a gene are
+        kept in table order.
+        """
+        sorted_labels, first_inds, gene_codes = \
+            numpy.unique(self.gene_ids,
+                         return_index=True,
+                         return_inverse=True)
+        # Number genes by their first appearance in the table
+        appearance_order = numpy.argsort(first_inds, kind="mergesort")
+        gene_nums = numpy.empty(len(sorted_labels), dtype=numpy.int64)
+        gene_nums[appearance_order] = numpy.arange(len(sorted_labels))
+        trans_gene_nums = gene_nums[gene_codes]
+        self.gene_labels = sorted_labels[appearance_order]
+        self.gene_trans = numpy.argsort(trans_gene_nums, kind="mergesort")
+        self.gene_offsets = get_offsets(numpy.bincount(trans_gene_nums,
+                                                       minlength=len(sorted_labels)))
+        self.sorted_gene_labels = sorted_labels
+        self.sorted_gene_nums = gene_nums
+
+
+    def get_num_genes(self):
+        return len(self.gene_labels)
+
+
+    def get_gene_num(self, gene_id):
+        """
+        Return the number of a gene, or None if the gene
+        is not in the store.
+        """
+        ind = numpy.searchsorted(self.sorted_gene_labels, gene_id)
+        if (ind == len(self.sorted_gene_labels)) or \
+           (self.sorted_gene_labels[ind] != gene_id):
+            return None
+        return self.sorted_gene_nums[ind]
+
+
+    def get_gene_transcripts(self, gene_num):
+        """
+        Return the indices of a gene's transcripts.
+        """
+        return self.gene_trans[self.gene_offsets[gene_num]:\
+                               self.gene_offsets[gene_num + 1]]
+
+
+    def get_exon_transcripts(self):
+        """
+        Return the index of the transcript of every exon,
+        i.e. the exon arrays' CSR offsets expanded to one
+        entry per exon.
+        """
+        return numpy.repeat(numpy.arange(len(self.trans_ids)),
+                            numpy.diff(self.exon_offsets))
+
+
+    def get_transcript_genes(self):
+        """
+        Return the gene number of every transcript.
+        """
+        trans_genes = numpy.empty(len(self.trans_ids), dtype=numpy.int64)
+        trans_genes[self.gene_trans] = \
+            numpy.repeat(numpy.arange(len(self.gene_labels)),
+                         numpy.diff(self.gene_offsets))
+        return trans_genes
+
+
+    def get_intron_coords(self):
+        """
+        Return the introns of all transcripts as the gaps
+        between consecutive exons of each transcript.
+
+        Returns (intron_trans, intron_starts, intron_ends) where
+        intron_trans is the index of each intron's transcript.
+        Intron starts are 0-based, like exon starts.
+        """
+        exon_trans = self.get_exon_transcripts()
+        # Consecutive exons of the same transcript flank an intron
+        same_trans = (exon_trans[1:] == exon_trans[:-1])
+        intron_trans = exon_trans[:-1][same_trans]
+        intron_starts = self.exon_ends[:-1][same_trans]
+        intron_ends = self.exon_starts[1:][same_trans]
+        return intron_trans, intron_starts, intron_ends
+
+
+    def get_transcript_exons(self, trans_num):
+        """
+        Return the (0-based) exon starts and exon ends
+        of a transcript.
+        """
+        first, last = self.exon_offsets[trans_num], \
+                      self.exon_offsets[trans_num + 1]
+        return self.exon_starts[first:last], self.exon_ends[first:last]
+
+
+    def get_transcript_lens(self):
+        """
+        Return the length (sum of exon lengths) of every
+        transcript.
+        """
+        return numpy.bincount(self.get_exon_transcripts(),
+                              weights=(self.exon_ends - self.exon_starts),
+                              minlength=len(self.trans_ids)).astype(numpy.int64)
+
+
+    def get_exon_tx_starts(self):
+        """
+        Return the transcript coordinate of the 5'-most base
+        of every exon, i.e. the length of the exons upstream of
+        it in its transcript (downstream in the genome for
+        transcripts on the minus strand.)
+        """
+        exon_trans = self.get_exon_transcripts()
+        exon_lens = self.exon_ends - self.exon_starts
+        tx_lens = self.get_transcript_lens()
+        # Length of the exons before each exon of its transcript,
+        # in genome order
+        prev_lens = (numpy.cumsum(exon_lens) - exon_lens) - \
+                    get_offsets(tx_lens)[exon_trans]
+        next_lens = tx_lens[exon_trans] - prev_lens - exon_lens
+        return numpy.where(self.strands[exon_trans] == "-",
+                           next_lens, prev_lens)
+
+
+    def get_tx_positions(self, trans_nums, positions):
+        """
+        Return the transcript coordinates (0-based, from the
+        transcript's 5' end) of genomic positions (0-based) in
+        the given transcripts, or -1 where a position is not in
+        an exon of its transcript.
+        """
+        trans_nums = numpy.asarray(trans_nums, dtype=numpy.int64)
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        # Exons are in genome order within each transcript, so
+        # keying them by transcript then start sorts them
+        exon_keys = (self.get_exon_transcripts() << 32) + self.exon_starts
+        exon_nums = numpy.searchsorted(exon_keys,
+                                       (trans_nums << 32) + positions,
+                                       side="right") - 1
+        exon_nums = numpy.maximum(exon_nums, 0)
+        tx_positions = numpy.empty(len(positions), dtype=numpy.int64)
+        tx_positions.fill(-1)
+        if len(exon_keys) == 0:
+            return tx_positions
+        in_exon = (exon_nums >= self.exon_offsets[trans_nums]) & \
+                  (exon_nums < self.exon_offsets[trans_nums + 1]) & \
+                  (positions >= self.exon_starts[exon_nums]) & \
+                  (positions < self.exon_ends[exon_nums])
+        exon_nums = exon_nums[in_exon]
+        exon_tx_starts = self.get_exon_tx_starts()[exon_nums]
+        plus_pos = exon_tx_starts + \
+                   (positions[in_exon] - self.exon_starts[exon_nums])
+        minus_pos = exon_tx_starts + \
+                    (self.exon_ends[exon_nums] - 1 - positions[in_exon])
+        tx_positions[in_exon] = numpy.where(self.strands[trans_nums[in_exon]] == "-",
+                                            minus_pos, plus_pos)
+        return tx_positions
+
+
+    def get_cds_tx_coords(self):
+        """
+        Return the CDS bounds of every transcript in transcript
+        coordinates, as (cds_tx_starts, cds_tx_ends) with 0-based
+        starts (the first base of the start codon) and 1-based
+        ends (the last base of the stop codon.) Both are -1 for
+        non-coding transcripts.
+        """
+        trans_nums = numpy.arange(len(self.trans_ids))
+        first_pos = self.get_tx_positions(trans_nums, self.cds_starts)
+        last_pos = self.get_tx_positions(trans_nums, self.cds_ends - 1)
+        is_minus = (self.strands == "-")
+        cds_tx_starts = numpy.where(is_minus, last_pos, first_pos)
+        cds_tx_ends = numpy.where(is_minus, first_pos, last_pos) + 1
+        is_coding = (self.cds_ends > self.cds_starts) & \
+                    (first_pos >= 0) & (last_pos >= 0)
+        cds_tx_starts[~is_coding] = -1
+        cds_tx_ends[~is_coding] = -1
+        return cds_tx_starts, cds_tx_ends
+
+
+    def get_principal_transcripts(self):
+        """
+        Return the indices of the principal transcript of each
+        coding gene: the transcript with the longest CDS (then
+        the longest transcript, then the first in the table.)
+        """
+        cds_tx_starts, cds_tx_ends = self.get_cds_tx_coords()
+        cds_lens = cds_tx_ends - cds_tx_starts
+        trans_genes = self.get_transcript_genes()
+        order = numpy.lexsort([numpy.arange(len(self.trans_ids)),
+                               -self.get_transcript_lens(),
+                               -cds_lens,
+                               trans_genes])
+        # The first transcript of each gene in this order
+        is_first = numpy.ones(len(order), dtype=bool)
+        is_first[1:] = (trans_genes[order][1:] != trans_genes[order][:-1])
+        principal = order[is_first]
+        return numpy.sort(principal[cds_lens[principal] > 0])
+
+
+    def get_nonoverlapping_transcripts(self, trans_nums):
+        """
+        Return the transcripts among 'trans_nums' whose exons do
+        not overlap the exons of another of these transcripts on
+        the same strand, so that positions in their exons can be
+        assigned to one transcript.
+        """
+        trans_nums = numpy.asarray(trans_nums, dtype=numpy.int64)
+        exon_trans = self.get_exon_transcripts()
+        selected = numpy.zeros(len(self.trans_ids), dtype=bool)
+        selected[trans_nums] = True
+        exon_nums = numpy.flatnonzero(selected[exon_trans])
+        exon_trans = exon_trans[exon_nums]
+        strand_keys = get_strand_keys(self.chroms[exon_trans],
+                                      self.strands[exon_trans])
+        exon_starts = strand_keys + self.exon_starts[exon_nums]
+        exon_ends = strand_keys + self.exon_ends[exon_nums]
+        order = numpy.argsort(exon_starts, kind="mergesort")
+        exon_starts = exon_starts[order]
+        exon_ends = exon_ends[order]
+        exon_trans = exon_trans[order]
+        # Exons of a transcript do not overlap each other, so an
+        # exon that starts before the furthest end of the exons
+        # sorted before it overlaps another transcript's exon
+        overlaps = numpy.zeros(len(exon_starts), dtype=bool)
+        if len(exon_starts) > 1:
+            prev_ends = numpy.maximum.accumulate(exon_ends)[:-1]
+            overlaps[1:] = (exon_starts[1:] < prev_ends)
+            overlaps[:-1] |= (exon_ends[:-1] > exon_starts[1:])
+        overlapping = numpy.zeros(len(self.trans_ids), dtype=bool)
+        overlapping[exon_trans[overlaps]] = True
+        return trans_nums[~overlapping[trans_nums]]
+
+
+    def make_transcript(self, trans_num):
+        """
+        Build a Transcript object for a transcript.
+        """
+        chrom = self.chrom_names[self.chroms[trans_num]]
+        strand = self.strands[trans_num]
+        transcript_id = self.trans_ids[trans_num]
+        exon_starts, exon_ends = self.get_transcript_exons(trans_num)
+        # Convert start coordinates into 1-based coordinates
+        parts = [GeneModel.Part(int(start) + 1, int(end), chrom, strand,
+                                parent=transcript_id) \
+                 for start, end in zip(exon_starts, exon_ends)]
+        # Convert cds coordinates into 1-based as well
+        transcript = GeneModel.Transcript(parts, chrom, strand,
+                                          label=transcript_id,
+                                          cds_start=int(self.cds_starts[trans_num]) + 1,
+                                          cds_end=int(self.cds_ends[trans_num]),
+                                          parent=self.gene_ids[trans_num])
+        return transcript
+
+
+    def make_gene(self, gene_num,
+                  trans_to_names=None):
+        """
+        Build a Gene object (with its transcripts and parts)
+        for a gene.
+
+        - trans_to_names: optional mapping from transcripts
+          to gene symbols
+        """
+        gene_id = self.gene_labels[gene_num]
+        gene_symbol = self.na_val
+        transcripts = []
+        for trans_num in self.get_gene_transcripts(gene_num):
+            transcripts.append(self.make_transcript(trans_num))
+            if trans_to_names is not None:
+                gene_symbol = trans_to_names[self.trans_ids[trans_num]]
+        # Take chrom/strand from the last transcript
+        last_trans = transcripts[-1]
+        gene_model = GeneModel.Gene(transcripts,
+                                    last_trans.chrom,
+                                    last_trans.strand,
+                                    label=gene_id,
+                                    gene_symbol=gene_symbol)
+        return gene_model
+
+
+    def save(self, output_filename,
+             table_filename=None,
+             dep_filenames=[],
+             read_key=""):
+        """
+        Serialize the store as a NumPy .npz file.
+
+        - table_filename: table the store was parsed from. Its
+          size and modification time are recorded so that the
+          serialized store can be invalidated when the table
+          changes.
+        - dep_filenames: other tables the store was built from
+          (e.g. a transcript to gene mapping), recorded likewise
+        - read_key: key of the arguments the table was parsed
+          with (see get_read_key), recorded likewise
+        """
+        table_stat = [-1, -1]
+        if table_filename is not None:
+            table_stat = get_table_stat(table_filename,
+                                        dep_filenames=dep_filenames)
+        arrays = dict((name, getattr(self, name)) for name in STORE_ARRAYS)
+        # Write to a temporary file first so that an interrupted
+        # save does not leave a truncated store behind
+        tmp_filename = "%s.tmp.npz" %(output_filename.rsplit(".npz", 1)[0])
+        numpy.savez(tmp_filename,
+                    store_version=numpy.array([STORE_VERSION]),
+                    table_stat=numpy.array(table_stat, dtype=numpy.float64),
+                    read_key=numpy.array([read_key]),
+                    **arrays)
+        os.rename(tmp_filename, output_filename)
+        return output_filename
+
+
+class TranscriptCoords:
+    """
+    Mapping from genomic positions to positions along a set of
+    transcripts of a TranscriptStore.
+
+    Positions of all the transcripts are laid end to end: the
+    transcript coordinate x of transcript t is the global
+    position tx_offsets[t] + x. The exons of the transcripts
+    must not overlap on a strand (see
+    TranscriptStore.get_nonoverlapping_transcripts.)
+    """
+    def __init__(self, store, trans_nums):
+        self.trans_nums = numpy.asarray(trans_nums, dtype=numpy.int64)
+        self.trans_ids = store.trans_ids[self.trans_nums]
+        self.chrom_names = store.chrom_names
+        self.tx_lens = store.get_transcript_lens()[self.trans_nums]
+        self.tx_offsets = get_offsets(self.tx_lens)
+        cds_tx_starts, cds_tx_ends = store.get_cds_tx_coords()
+        self.cds_tx_starts = cds_tx_starts[self.trans_nums]
+        self.cds_tx_ends = cds_tx_ends[self.trans_nums]
+        # Exons of the transcripts, sorted by chromosome, strand
+        # and start
+        local_nums = numpy.empty(len(store.trans_ids), dtype=numpy.int64)
+        local_nums.fill(-1)
+        local_nums[self.trans_nums] = numpy.arange(len(self.trans_nums))
+        exon_trans = local_nums[store.get_exon_transcripts()]
+        exon_nums = numpy.flatnonzero(exon_trans >= 0)
+        exon_trans = exon_trans[exon_nums]
+        strand_keys = get_strand_keys(store.chroms[self.trans_nums][exon_trans],
+                                      store.strands[self.trans_nums][exon_trans])
+        exon_keys = strand_keys + store.exon_starts[exon_nums]
+        order = numpy.argsort(exon_keys, kind="mergesort")
+        self.exon_keys = exon_keys[order]
+        self.exon_trans = exon_trans[order]
+        self.exon_starts = store.exon_starts[exon_nums][order]
+        self.exon_ends = store.exon_ends[exon_nums][order]
+        self.exon_minus = (store.strands[self.trans_nums][self.exon_trans] == "-")
+        self.exon_tx_starts = store.get_exon_tx_starts()[exon_nums][order]
+
+
+    def __len__(self):
+        return len(self.trans_nums)
+
+
+    def get_chrom_code(self, chrom):
+        """
+        Return the code of a chromosome name, or None if no
+        transcript is on it.
+        """
+        ind = numpy.searchsorted(self.chrom_names, chrom)
+        if (ind == len(self.chrom_names)) or (self.chrom_names[ind] != chrom):
+            return None
+        return ind
+
+
+    def map_positions(self, chrom_code, strands, positions):
+        """
+        Map genomic positions (0-based) on a chromosome to
+        transcript coordinates.
+
+        - chrom_code: code of the chromosome (see get_chrom_code)
+        - strands: strand ('+' or '-') of each position
+        - positions: the positions
+
+        Returns (trans, tx_positions): the (local) index of the
+        transcript of each position and its coordinate in the
+        transcript, both -1 for positions outside the exons of
+        the transcripts.
+        """
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        trans = numpy.empty(len(positions), dtype=numpy.int64)
+        trans.fill(-1)
+        tx_positions = trans.copy()
+        if len(self.exon_keys) == 0:
+            return trans, tx_positions
+        keys = get_strand_keys(numpy.repeat(chrom_code, len(positions)),
+                               strands) + positions
+        exon_nums = numpy.searchsorted(self.exon_keys, keys, side="right") - 1
+        in_exon = (exon_nums >= 0)
+        exon_nums = numpy.maximum(exon_nums, 0)
+        # The exon must be on the same chromosome and strand, and
+        # end after the position
+        in_exon &= ((self.exon_keys[exon_nums] >> 32) == (keys >> 32)) & \
+                   (positions < self.exon_ends[exon_nums])
+        exon_nums = exon_nums[in_exon]
+        in_positions = positions[in_exon]
+        trans[in_exon] = self.exon_trans[exon_nums]
+        tx_positions[in_exon] = \
+            self.exon_tx_starts[exon_nums] + \
+            numpy.where(self.exon_minus[exon_nums],
+                        self.exon_ends[exon_nums] - 1 - in_positions,
+                        in_positions - self.exon_starts[exon_nums])
+        return trans, tx_positions
+
+
+    def get_global_positions(self, trans, tx_positions):
+        """
+        Return the global positions of transcript coordinates.
+        """
+        return self.tx_offsets[trans] + tx_positions
+
+
+    def split_global_positions(self, global_positions):
+        """
+        Return the (transcript, transcript coordinate) of
+        global positions.
+        """
+        trans = numpy.searchsorted(self.tx_offsets, global_positions,
+                                   side="right") - 1
+        return trans, global_positions - self.tx_offsets[trans]
+
+
+def get_coding_transcript_coords(store):
+    """
+    Return TranscriptCoords for the principal transcripts of
+    the coding genes of a store, leaving out the transcripts
+    that overlap each other on a strand.
+    """
+    trans_nums = store.get_principal_transcripts()
+    kept_nums = store.get_nonoverlapping_transcripts(trans_nums)
+    print "Using %d of %d principal coding transcripts (%d overlap others)" \
+        %(len(kept_nums), len(trans_nums), len(trans_nums) - len(kept_nums))
+    return TranscriptCoords(store, kept_nums)
+
+
+class GenesView:
+    """
+    Read-only, dictionary-like view of the genes of a
+    TranscriptStore, keyed by gene ID.
+
+    Gene objects are built when accessed and are not kept,
+    so each access returns a new Gene.
+    """
+    def __init__(self, store,
+                 trans_to_names=None):
+        self.store = store
+        self.trans_to_names = trans_to_names
+
+
+    def __len__(self):
+        return self.store.get_num_genes()
+
+
+    def __contains__(self, gene_id):
+        return self.store.get_gene_num(gene_id) is not None
+
+
+    def __getitem__(self, gene_id):
+        gene_num = self.store.get_gene_num(gene_id)
+        if gene_num is None:
+            raise KeyError, gene_id
+        return self.store.make_gene(gene_num,
+                                    trans_to_names=self.trans_to_names)
+
+
+    def __iter__(self):
+        return self.iterkeys()
+
+
+    def __repr__(self):
+        return "GenesView(%d genes)" %(len(self))
+
+
+    def has_key(self, gene_id):
+        return gene_id in self
+
+
+    def get(self, gene_id, default=None):
+        if gene_id not in self:
+            return default
+        return self[gene_id]
+
+
+    def iterkeys(self):
+        return iter(self.store.gene_labels)
+
+
+    def itervalues(self):
+        for gene_num in xrange(self.store.get_num_genes()):
+            yield self.store.make_gene(gene_num,
+                                       trans_to_names=self.trans_to_names)
+
+
+    def iteritems(self):
+        for gene in self.itervalues():
+            yield gene.label, gene
+
+
+    def keys(self):
+        return list(self.iterkeys())
+
+
+    def values(self):
+        return list(self.itervalues())
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+def get_offsets(counts):
+    """
+    Return CSR-style offsets (of length len(counts) + 1)
+    from an array of counts.
+    """
+    offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def get_strand_keys(chroms, strands):
+    """
+    Return keys that sort positions by chromosome and strand
+    when added to them: (2 * chrom code + is minus strand) in
+    the bits above the first 32.
+    """
+    return ((numpy.asarray(chroms, dtype=numpy.int64) * 2) + \
+            (numpy.asarray(strands) == "-")) << 32
+
+
+def parse_coords_lists(coords_lists):
+    """
+    Parse comma-separated coordinate lists (such as the
+    'exonStarts' column of a genePred table) into a flat array
+    of coordinates and an array of per-list offsets.
+
+    The lists are parsed in one pass by joining them into
+    a single string.
+    """
+    # Make sure every list ends with a delimiter, so that
+    # joined lists stay separate
+    coords_lists = [coords if coords.endswith(",") else coords + "," \
+                    for coords in coords_lists]
+    counts = numpy.array([coords.count(",") for coords in coords_lists],
+                         dtype=numpy.int64)
+    coords = numpy.fromstring("".join(coords_lists),
+                              dtype=numpy.int64,
+                              sep=",")
+    offsets = get_offsets(counts)
+    if offsets[-1] != len(coords):
+        raise Exception, "Malformed coordinate lists: expected %d " \
+                         "coordinates, parsed %d." %(offsets[-1],
+                                                     len(coords))
+    return coords, offsets
+
+
+def get_genePred_fields(table_filename, delimiter="\t"):
+    """
+    Return the header of a genePred-style table, guessed
+    from its number of columns (see GENEPRED_LAYOUTS.)
+    """
+    table_file = open(table_filename)
+    first_line = table_file.readline()
+    table_file.close()
+    num_cols = len(first_line.rstrip("\r\n").split(delimiter))
+    if num_cols not in GENEPRED_LAYOUTS:
+        raise Exception, "Cannot parse %s: %d columns is not a known " \
+                         "genePred layout." %(table_filename, num_cols)
+    return GENEPRED_LAYOUTS[num_cols]
+
+
+def read_genePred_store(table_filename, fieldnames=None,
+                        trans_field="name",
+                        gene_field="name2",
+                        delimiter="\t",
+                        na_val="NA",
+                        trans_to_genes=None):
+    """
+    Parse a genePred-style table into a TranscriptStore.
+
+    - table_filename: the table (e.g. ensGene.txt)
+    - fieldnames: the table's header (guessed from the number
+      of columns if not given)
+    - trans_field: column holding transcript IDs
+    - gene_field: column holding gene IDs
+    - trans_to_genes: Series mapping transcript IDs to gene IDs,
+      used if the table has no gene column (e.g. knownGene.)
+      Transcripts without a gene are taken as their own gene.
+    """
+    print "Parsing %s into transcript store..." %(table_filename)
+    t1 = time.time()
+    if fieldnames is None:
+        fieldnames = get_genePred_fields(table_filename,
+                                         delimiter=delimiter)
+    usecols = [trans_field, "chrom", "strand",
+               "txStart", "txEnd", "cdsStart", "cdsEnd",
+               "exonStarts", "exonEnds"]
+    str_cols = [trans_field, "chrom", "strand",
+                "exonStarts", "exonEnds"]
+    has_gene_field = (gene_field in fieldnames)
+    if has_gene_field:
+        usecols.append(gene_field)
+        str_cols.append(gene_field)
+    table = pandas.read_table(table_filename,
+                              sep=delimiter,
+                              names=fieldnames,
+                              usecols=usecols,
+                              dtype=dict((col, str) for col in str_cols),
+                              na_filter=False)
+    trans_ids = table[trans_field].values.astype("S")
+    if has_gene_field:
+        gene_ids = table[gene_field].values.astype("S")
+    elif trans_to_genes is not None:
+        gene_ids = trans_to_genes.reindex(trans_ids).values
+        no_gene = pandas.isnull(gene_ids)
+        gene_ids[no_gene] = trans_ids[no_gene]
+        gene_ids = gene_ids.astype("S")
+    else:
+        gene_ids = trans_ids.copy()
+    chrom_names, chroms = numpy.unique(table["chrom"].values.astype("S"),
+                                       return_inverse=True)
+    exon_starts, exon_offsets = parse_coords_lists(table["exonStarts"].values)
+    exon_ends, end_offsets = parse_coords_lists(table["exonEnds"].values)
+    if not numpy.array_equal(exon_offsets, end_offsets):
+        raise Exception, "Mismatched exonStarts and exonEnds in %s" \
+            %(table_filename)
+    store = TranscriptStore(trans_ids,
+                            gene_ids,
+                            chroms.astype(numpy.int32),
+                            chrom_names,
+                            table["strand"].values.astype("S1"),
+                            table["txStart"].values.astype(numpy.int64),
+                            table["txEnd"].values.astype(numpy.int64),
+                            table["cdsStart"].values.astype(numpy.int64),
+                            table["cdsEnd"].values.astype(numpy.int64),
+                            exon_starts,
+                            exon_ends,
+                            exon_offsets,
+                            na_val=na_val)
+    t2 = time.time()
+    print "Parsing took %.2f secs" %(t2 - t1)
+    return store
+
+
+def load_transcript_store(store_filename,
+                          table_filename=None,
+                          dep_filenames=[],
+                          read_key=None,
+                          na_val="NA"):
+    """
+    Load a serialized TranscriptStore.
+
+    If 'table_filename' is given, return None if the store was
+    not made from the current version of the table (and of
+    the tables in 'dep_filenames'.) If 'read_key' is given,
+    return None if the store was parsed with other arguments
+    (see get_read_key.)
+    """
+    store_data = numpy.load(store_filename)
+    try:
+        if ("store_version" not in store_data.files) or \
+           (store_data["store_version"][0] != STORE_VERSION):
+            return None
+        if table_filename is not None:
+            if list(store_data["table_stat"]) != \
+               get_table_stat(table_filename,
+                              dep_filenames=dep_filenames):
+                return None
+        if (read_key is not None) and \
+           (str(store_data["read_key"][0]) != read_key):
+            return None
+        arrays = [store_data[name] for name in STORE_ARRAYS]
+    finally:
+        store_data.close()
+    return TranscriptStore(*arrays, na_val=na_val)
+
+
+def get_transcript_store(table_filename, fieldnames=None,
+                         store_filename=None,
+                         dep_filenames=[],
+                         **read_args):
+    """
+    Return a TranscriptStore for a genePred-style table, using
+    a serialized store if one exists for the current version of
+    the table.
+
+    - store_filename: where the store is serialized (defaults
+      to the table filename with a '.store.npz' extension.)
+    - dep_filenames: other tables the store is built from
+      (e.g. the source of 'trans_to_genes')
+    - read_args: passed on to read_genePred_store. A serialized
+      store is only used if it was parsed with the same header
+      and arguments.
+    """
+    if store_filename is None:
+        store_filename = "%s.store.npz" \
+            %(os.path.splitext(table_filename)[0])
+    if fieldnames is None:
+        fieldnames = get_genePred_fields(table_filename,
+                                         delimiter=read_args.get("delimiter",
+                                                                 "\t"))
+    read_key = get_read_key(fieldnames, **read_args)
+    if os.path.isfile(store_filename):
+        na_val = read_args.get("na_val", "NA")
+        store = load_transcript_store(store_filename,
+                                      table_filename=table_filename,
+                                      dep_filenames=dep_filenames,
+                                      read_key=read_key,
+                                      na_val=na_val)
+        if store is not None:
+            print "Loaded transcript store %s" %(store_filename)
+            return store
+        print "Transcript store %s is out of date." %(store_filename)
+    store = read_genePred_store(table_filename, fieldnames,
+                                **read_args)
+    store.save(store_filename,
+               table_filename=table_filename,
+               dep_filenames=dep_filenames,
+               read_key=read_key)
+    return store
+
+
+def get_read_key(fieldnames,
+                 trans_field="name",
+                 gene_field="name2",
+                 delimiter="\t",
+                 na_val="NA",
+                 trans_to_genes=None):
+    """
+    Return a key (an MD5 digest) of the arguments a table is
+    parsed with by read_genePred_store, so that a serialized
+    store is not reused for other arguments. 'na_val' does not
+    change the parsed arrays and is left out.
+    """
+    key = hashlib.md5()
+    key.update(repr([list(fieldnames), trans_field, gene_field,
+                     delimiter]))
+    if trans_to_genes is not None:
+        key.update("\n".join(["%s\t%s" %(trans_id, gene_id) \
+                               for trans_id, gene_id \
+                               in trans_to_genes.iteritems()]))
+    return key.hexdigest()
+
+
+def get_table_stat(table_filename, dep_filenames=[]):
+    """
+    Return the size and modification time of a table (followed
+    by those of the tables in 'dep_filenames'.)
+    """
+    table_stat = []
+    for filename in [table_filename] + list(dep_filenames):
+        file_stat = os.stat(filename)
+        table_stat.extend([float(file_stat.st_size),
+                           float(file_stat.st_mtime)])
+    return table_stat
@@ -0,0 +1,308 @@
+##
+## Random access to gzip files
+##
+## A gzip file made of a single member (as written by gzip) can
+## only be decompressed from its start. As in zran.c from the zlib
+## distribution, it can still be read from 'access points' in its
+## middle: any deflate block boundary is a place where decompression
+## can resume given
+##
+##   - the offset of the compressed byte the block starts in, and
+##     the number of bits of that byte already used (a block does
+##     not start on a byte boundary)
+##   - the last 32 KB of uncompressed data before the point (the
+##     window that the next blocks can refer back to)
+##
+## Python's zlib module does not expose block boundaries, priming
+## with bits or setting a dictionary on a decompressor, so the zlib
+## library is called directly through ctypes. Files made of several
+## members (e.g. BGZF) are handled as well, members being read one
+## after the other.
+##
+import ctypes
+import ctypes.util
+
+# Size of the deflate window
+WINDOW_SIZE = 32768
+
+# Bytes that start a gzip member
+GZIP_MAGIC = "\x1f\x8b"
+
+# Size of the trailer (CRC32 and length) that ends a gzip member
+GZIP_TRAILER_SIZE = 8
+
+# zlib constants (zlib.h)
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+# Window bits of gzip streams and of raw deflate streams
+GZIP_WBITS = 31
+RAW_WBITS = -15
+
+# Size of the output buffer of a decompressor
+OUTPUT_SIZE = (1 << 18)
+
+
+class ZStream(ctypes.Structure):
+    """
+    zlib's z_stream structure.
+    """
+    _fields_ = [("next_in", ctypes.c_void_p),
+                ("avail_in", ctypes.c_uint),
+                ("total_in", ctypes.c_ulong),
+                ("next_out", ctypes.c_void_p),
+                ("avail_out", ctypes.c_uint),
+                ("total_out", ctypes.c_ulong),
+                ("msg", ctypes.c_char_p),
+                ("state", ctypes.c_void_p),
+                ("zalloc", ctypes.c_void_p),
+                ("zfree", ctypes.c_void_p),
+                ("opaque", ctypes.c_void_p),
+                ("data_type", ctypes.c_int),
+                ("adler", ctypes.c_ulong),
+                ("reserved", ctypes.c_ulong)]
+
+
+def load_libz():
+    """
+    Load the zlib library. Returns None if it cannot be found.
+    """
+    lib_names = [ctypes.util.find_library("z"),
+                 "libz.so.1",
+                 "libz.dylib"]
+    for lib_name in lib_names:
+        if lib_name is None:
+            continue
+        try:
+            libz = ctypes.CDLL(lib_name)
+        except OSError:
+            continue
+        libz.zlibVersion.restype = ctypes.c_char_p
+        stream_p = ctypes.POINTER(ZStream)
+        libz.inflateInit2_.argtypes = [stream_p, ctypes.c_int,
+                                       ctypes.c_char_p, ctypes.c_int]
+        libz.inflate.argtypes = [stream_p, ctypes.c_int]
+        libz.inflateEnd.argtypes = [stream_p]
+        libz.inflatePrime.argtypes = [stream_p, ctypes.c_int, ctypes.c_int]
+        libz.inflateSetDictionary.argtypes = [stream_p, ctypes.c_char_p,
+                                              ctypes.c_uint]
+        return libz
+    return None
+
+LIBZ = load_libz()
+
+
+def has_libz():
+    """
+    Return True if gzip files can be read from access points.
+    """
+    return LIBZ is not None
+
+
+class Inflater:
+    """
+    zlib decompression stream.
+    """
+    def __init__(self, wbits):
+        if LIBZ is None:
+            raise Exception, "Cannot find the zlib library."
+        self.stream = ZStream()
+        ret = LIBZ.inflateInit2_(ctypes.byref(self.stream), wbits,
+                                 LIBZ.zlibVersion(),
+                                 ctypes.sizeof(ZStream))
+        if ret != Z_OK:
+            raise Exception, "Cannot initialize zlib stream (error %d)" %(ret)
+        self.input_buf = None
+        self.output_buf = ctypes.create_string_buffer(OUTPUT_SIZE)
+        self.closed = False
+
+
+    def feed(self, data):
+        """
+        Set the input of the stream (once the previous input
+        is used up.)
+        """
+        self.input_buf = ctypes.create_string_buffer(data, len(data))
+        self.stream.next_in = ctypes.addressof(self.input_buf)
+        self.stream.avail_in = len(data)
+
+
+    def get_avail_in(self):
+        return self.stream.avail_in
+
+
+    def get_unused_input(self):
+        """
+        Return the input not yet used by the stream.
+        """
+        if self.stream.avail_in == 0:
+            return ""
+        return ctypes.string_at(self.stream.next_in, self.stream.avail_in)
+
+
+    def prime(self, bits, value):
+        """
+        Insert the last 'bits' bits of 'value' in the input,
+        to resume decompression in the middle of a byte.
+        """
+        LIBZ.inflatePrime(ctypes.byref(self.stream), bits, value)
+
+
+    def set_dictionary(self, window):
+        """
+        Set the window that the following data refers back to.
+        """
+        ret = LIBZ.inflateSetDictionary(ctypes.byref(self.stream),
+                                        window, len(window))
+        if ret != Z_OK:
+            raise Exception, "Cannot set zlib dictionary (error %d)" %(ret)
+
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        """
+        Decompress as much of the input as fits in the output
+        buffer (or, with Z_BLOCK, up to the next block boundary.)
+        Returns the zlib status and the decompressed data.
+        """
+        self.stream.next_out = ctypes.addressof(self.output_buf)
+        self.stream.avail_out = OUTPUT_SIZE
+        ret = LIBZ.inflate(ctypes.byref(self.stream), flush)
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            raise Exception, "Error decompressing gzip data: %s (error %d)" \
+                %(self.stream.msg, ret)
+        data = ctypes.string_at(self.output_buf,
+                                OUTPUT_SIZE - self.stream.avail_out)
+        return ret, data
+
+
+    def close(self):
+        if not self.closed:
+            LIBZ.inflateEnd(ctypes.byref(self.stream))
+            self.closed = True
+
+
+def read_next_member(gz_file, unused, skip=0, read_size=(1 << 20)):
+    """
+    Return the input that starts the next gzip member, after
+    skipping 'skip' bytes of 'unused' (the input left over by
+    the previous member), and the number of bytes read from the
+    file. Returns None for the input if there is no next member
+    (trailing padding is ignored, as by gzip.)
+    """
+    num_read = 0
+    while len(unused) < skip + len(GZIP_MAGIC):
+        data = gz_file.read(read_size)
+        if not data:
+            break
+        num_read += len(data)
+        unused += data
+    unused = unused[skip:]
+    if unused[0:len(GZIP_MAGIC)] != GZIP_MAGIC:
+        return None, num_read
+    return unused, num_read
+
+
+def iter_gzip_blocks(gz_file, read_size=(1 << 20)):
+    """
+    Decompress a gzip file (possibly of several members) from
+    its start, yielding (data, access point) pieces.
+
+    The access point is given as (offset, bits) if the position
+    right after the piece's data is a place where decompression
+    can resume (see iter_gzip_from_point), and is None otherwise.
+    """
+    inflater = Inflater(GZIP_WBITS)
+    num_read = 0
+    at_eof = False
+    try:
+        while True:
+            if (inflater.get_avail_in() == 0) and (not at_eof):
+                data = gz_file.read(read_size)
+                if data:
+                    inflater.feed(data)
+                    num_read += len(data)
+                else:
+                    at_eof = True
+            ret, data = inflater.inflate(Z_BLOCK)
+            point = None
+            data_type = inflater.stream.data_type
+            # At the end of a block (or of the member header)
+            # that is not the member's last block
+            if (ret != Z_STREAM_END) and (data_type & 128) and \
+               (not (data_type & 64)):
+                point = (num_read - inflater.get_avail_in(), data_type & 7)
+            if data or (point is not None):
+                yield data, point
+            if ret == Z_STREAM_END:
+                unused, member_num_read = \
+                    read_next_member(gz_file, inflater.get_unused_input(),
+                                     read_size=read_size)
+                num_read += member_num_read
+                inflater.close()
+                if unused is None:
+                    break
+                inflater = Inflater(GZIP_WBITS)
+                inflater.feed(unused)
+            elif (ret == Z_BUF_ERROR) and at_eof:
+                raise Exception, "Unexpected end of gzip file %s" \
+                    %(gz_file.name)
+    finally:
+        inflater.close()
+
+
+def iter_gzip_from_point(gz_file, offset, bits, window,
+                         read_size=(1 << 20)):
+    """
+    Decompress a gzip file from an access point (see
+    iter_gzip_blocks) to its end, yielding pieces of data.
+
+    - window: the (up to WINDOW_SIZE) bytes of uncompressed data
+      before the point
+    """
+    inflater = Inflater(RAW_WBITS)
+    try:
+        if bits > 0:
+            # The point is in the middle of a byte
+            gz_file.seek(offset - 1)
+            inflater.prime(bits, ord(gz_file.read(1)) >> (8 - bits))
+        else:
+            gz_file.seek(offset)
+        if len(window) > 0:
+            inflater.set_dictionary(window)
+        # The stream is raw deflate up to the end of the member,
+        # and the following members are read whole
+        is_raw = True
+        at_eof = False
+        while True:
+            if (inflater.get_avail_in() == 0) and (not at_eof):
+                data = gz_file.read(read_size)
+                if data:
+                    inflater.feed(data)
+                else:
+                    at_eof = True
+            ret, data = inflater.inflate(Z_NO_FLUSH)
+            if data:
+                yield data
+            if ret == Z_STREAM_END:
+                skip = 0
+                if is_raw:
+                    # A raw stream stops before the member trailer
+                    skip = GZIP_TRAILER_SIZE
+                unused, member_num_read = \
+                    read_next_member(gz_file, inflater.get_unused_input(),
+                                     skip=skip,
+                                     read_size=read_size)
+                inflater.close()
+                if unused is None:
+                    break
+                inflater = Inflater(GZIP_WBITS)
+                inflater.feed(unused)
+                is_raw = False
+            elif (ret == Z_BUF_ERROR) and at_eof:
+                raise Exception, "Unexpected end of gzip file %s" \
+                    %(gz_file.name)
+    finally:
+        inflater.close()
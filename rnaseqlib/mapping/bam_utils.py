@@ -0,0 +1,214 @@
+##
+## Utilities for processing indexed BAM files in parallel
+##
+## Counting passes are split into shards (a reference, or a window
+## of a reference) that are fetched through the BAM index, counted
+## by a 'kernel' in a pool of processes and merged.
+##
+## A kernel is a module-level function (so that it can be sent
+## to worker processes) with the signature:
+##
+##   kernel(bam_filename, shard, *kernel_args)
+##
+## where shard is a (chrom, start, end) tuple. It should visit
+## reads with iter_shard_reads() and return counts: a number,
+## a numpy array, a dictionary of counts or a set.
+##
+import os
+import sys
+import time
+
+import multiprocessing
+
+import numpy
+
+import pysam
+
+
+def is_bam_indexed(bam_filename):
+    """
+    Return True if the BAM file has an index.
+    """
+    return os.path.isfile("%s.bai" %(bam_filename))
+
+
+def get_bam_shards(bam_filename,
+                   shard_size=None,
+                   references=None):
+    """
+    Return a list of (chrom, start, end) shards covering the
+    references of a BAM file, largest first.
+
+    - shard_size: if given, split references into windows of
+      at most this many bases, so that shards are balanced
+      across long and short chromosomes.
+    - references: only return shards of these references.
+    """
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    ref_lens = zip(bam_file.references, bam_file.lengths)
+    bam_file.close()
+    shards = []
+    for chrom, chrom_len in ref_lens:
+        if (references is not None) and (chrom not in references):
+            continue
+        if shard_size is None:
+            shards.append((chrom, 0, chrom_len))
+            continue
+        for start in xrange(0, chrom_len, shard_size):
+            shards.append((chrom, start, min(start + shard_size, chrom_len)))
+    # Launch the largest shards first so that they do not
+    # end up running last
+    shards.sort(key=lambda shard: shard[2] - shard[1], reverse=True)
+    return shards
+
+
+def iter_shard_reads(bam_file, shard):
+    """
+    Yield the reads in a shard.
+
+    Only reads that start in the shard are returned, so that
+    reads overlapping two shards are visited once.
+    """
+    chrom, start, end = shard
+    for read in bam_file.fetch(reference=chrom,
+                               start=start,
+                               end=end):
+        if read.pos < start:
+            continue
+        yield read
+
+
+def merge_counts(first, second):
+    """
+    Merge two kernel results.
+
+    Numbers and numpy arrays are added (arrays of different
+    lengths are padded with zeros), dictionaries are added
+    key by key and sets are joined.
+    """
+    if first is None:
+        return second
+    if second is None:
+        return first
+    if isinstance(first, set):
+        first.update(second)
+        return first
+    if isinstance(first, dict):
+        for key, value in second.iteritems():
+            if key in first:
+                first[key] = merge_counts(first[key], value)
+            else:
+                first[key] = value
+        return first
+    if isinstance(first, numpy.ndarray):
+        if first.shape != second.shape:
+            merged_shape = tuple(max(x, y) for x, y in zip(first.shape,
+                                                            second.shape))
+            merged = numpy.zeros(merged_shape,
+                                 dtype=numpy.result_type(first, second))
+            merged[tuple(slice(0, n) for n in first.shape)] += first
+            merged[tuple(slice(0, n) for n in second.shape)] += second
+            return merged
+    return first + second
+
+
+def _run_kernel(kernel_task):
+    """
+    Run a kernel on one shard. Used by the process pool.
+    """
+    kernel, bam_filename, shard, kernel_args = kernel_task
+    return kernel(bam_filename, shard, *kernel_args)
+
+
+def map_reduce_bam(bam_filename, kernel,
+                   kernel_args=(),
+                   num_processors=1,
+                   shard_size=None,
+                   references=None,
+                   reducer=merge_counts):
+    """
+    Run a counting kernel on every shard of an indexed BAM
+    file and merge the results.
+
+    - bam_filename: coordinate-sorted, indexed BAM
+    - kernel: module-level kernel function (see top of file)
+    - kernel_args: extra arguments passed to the kernel
+    - num_processors: number of processes to use
+    - shard_size: size of genomic shards (None for one
+      shard per reference)
+    - references: only count these references
+    - reducer: function merging two kernel results
+
+    Reads that are not placed on a reference are not visited.
+    """
+    if not is_bam_indexed(bam_filename):
+        raise Exception, "Cannot shard %s since it is not indexed." \
+            %(bam_filename)
+    shards = get_bam_shards(bam_filename,
+                            shard_size=shard_size,
+                            references=references)
+    kernel_tasks = [(kernel, bam_filename, shard, tuple(kernel_args)) \
+                    for shard in shards]
+    result = None
+    t1 = time.time()
+    if num_processors <= 1:
+        for kernel_task in kernel_tasks:
+            result = reducer(result, _run_kernel(kernel_task))
+    else:
+        pool = multiprocessing.Pool(processes=num_processors)
+        try:
+            for shard_result in pool.imap_unordered(_run_kernel,
+                                                    kernel_tasks):
+                result = reducer(result, shard_result)
+        finally:
+            pool.close()
+            pool.join()
+    t2 = time.time()
+    print "Counted %d shards of %s on %d processors in %.2f secs" \
+        %(len(kernel_tasks),
+          os.path.basename(bam_filename),
+          num_processors,
+          (t2 - t1))
+    return result
+
+
+##
+## Counting kernels
+##
+def qname_lens_kernel(bam_filename, shard):
+    """
+    Return the IDs of the mapped reads in the shard mapped to
+    their read lengths. Unmapped mates placed at their mate's
+    position are skipped.
+    """
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    qname_lens = dict((read.qname, read.rlen) \
+                      for read in iter_shard_reads(bam_file, shard) \
+                      if not read.is_unmapped)
+    bam_file.close()
+    return qname_lens
+
+
+def merge_qname_lens(first, second):
+    """
+    Merge two qname_lens_kernel results. Reads aligned in
+    both shards keep one length rather than a sum.
+    """
+    if first is None:
+        return second
+    if second is None:
+        return first
+    first.update(second)
+    return first
+
+
+def num_reads_kernel(bam_filename, shard):
+    """
+    Return the number of alignments in the shard.
+    """
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    num_reads = 0
+    for read in iter_shard_reads(bam_file, shard):
+        num_reads += 1
+    bam_file.close()
+    return num_reads
@@ -1,10 +1,16 @@
 ##
-## Basic wrappers for bedtools
+## Basic wrappers for bedtools, and in-process sorting
+## and merging of intervals
 ##
 import os
 import sys
 import time
 
+import itertools
+
+import numpy
+import pandas
+
 import rnaseqlib
 import rnaseqlib.utils as utils
 
@@ -67,35 +73,219 @@ def count_reads_matching_intervals(bam_filename,
     return num_reads
 
 
+def read_bed_arrays(bed_filename):
+    """
+    Read the first six columns of a BED file as arrays.
+
+    Returns (chroms, starts, ends, names, strands). Names and
+    strands are None if the BED has fewer columns.
+    """
+    bed_table = pandas.read_table(bed_filename,
+                                  sep="\t",
+                                  header=None,
+                                  dtype={0: str, 3: str, 5: str})
+    num_cols = len(bed_table.columns)
+    names, strands = None, None
+    if num_cols > 3:
+        names = bed_table[3].values.astype(str)
+    if num_cols > 5:
+        strands = bed_table[5].values.astype(str)
+    return (bed_table[0].values.astype(str),
+            bed_table[1].values.astype(numpy.int64),
+            bed_table[2].values.astype(numpy.int64),
+            names,
+            strands)
+
+
+def sort_intervals(chroms, starts, ends,
+                   strands=None,
+                   groups=None):
+    """
+    Return the indices that sort intervals by chromosome,
+    then start, then end (the order of sortBed.)
+
+    - strands: if given, sort by strand after chromosome
+    - groups: if given, sort by group (e.g. a gene number)
+      after chromosome and strand
+    """
+    sort_keys = [ends, starts]
+    if groups is not None:
+        sort_keys.append(groups)
+    if strands is not None:
+        sort_keys.append(strands)
+    sort_keys.append(chroms)
+    return numpy.lexsort(sort_keys)
+
+
+def get_key_changes(sorted_keys):
+    """
+    Return a boolean array that is True where any of the
+    sorted key arrays changes value (and at the first entry.)
+    """
+    num_entries = len(sorted_keys[0])
+    changes = numpy.zeros(num_entries, dtype=bool)
+    if num_entries == 0:
+        return changes
+    changes[0] = True
+    for key in sorted_keys:
+        changes[1:] |= (key[1:] != key[:-1])
+    return changes
+
+
+def merge_intervals(chroms, starts, ends,
+                    strands=None,
+                    groups=None):
+    """
+    Merge overlapping or book-ended intervals (as mergeBed does.)
+
+    - chroms, starts, ends: intervals (0-based starts)
+    - strands: if given, only merge intervals on the same
+      strand (mergeBed -s)
+    - groups: if given, only merge intervals of the same group
+
+    Returns (order, merged_offsets, merged_starts, merged_ends):
+    the input intervals that make up merged interval i are
+    order[merged_offsets[i]:merged_offsets[i+1]]. The merged
+    intervals are sorted as in sort_intervals().
+    """
+    order = sort_intervals(chroms, starts, ends,
+                           strands=strands,
+                           groups=groups)
+    sorted_keys = [chroms[order]]
+    if strands is not None:
+        sorted_keys.append(strands[order])
+    if groups is not None:
+        sorted_keys.append(groups[order])
+    sorted_starts = numpy.asarray(starts, dtype=numpy.int64)[order]
+    sorted_ends = numpy.asarray(ends, dtype=numpy.int64)[order]
+    if len(order) == 0:
+        return order, numpy.zeros(1, dtype=numpy.int64), \
+               sorted_starts, sorted_ends
+    # Shift every chromosome/strand/group past the previous one,
+    # so that a running maximum of the ends is enough to find
+    # where a new merged interval begins
+    key_nums = numpy.cumsum(get_key_changes(sorted_keys)) - 1
+    shift = key_nums * (sorted_ends.max() + 1)
+    max_ends = numpy.maximum.accumulate(sorted_ends + shift)
+    merged_firsts = numpy.ones(len(order), dtype=bool)
+    merged_firsts[1:] = (sorted_starts[1:] + shift[1:]) > max_ends[:-1]
+    merged_offsets = numpy.append(numpy.flatnonzero(merged_firsts),
+                                  len(order))
+    merged_starts = sorted_starts[merged_offsets[:-1]]
+    merged_ends = numpy.maximum.reduceat(sorted_ends,
+                                         merged_offsets[:-1])
+    return order, merged_offsets, merged_starts, merged_ends
+
+
+def join_merged_names(names, order, merged_offsets,
+                      delimiter=";"):
+    """
+    Return the names of merged intervals (see merge_intervals)
+    as the names of their intervals joined by 'delimiter',
+    as with mergeBed -nms.
+    """
+    sorted_names = numpy.asarray(names)[order]
+    return [delimiter.join(sorted_names[first:last]) \
+            for first, last in itertools.izip(merged_offsets[:-1],
+                                              merged_offsets[1:])]
+
+
+def subtract_intervals(groups, starts, ends,
+                       sub_groups, sub_starts, sub_ends):
+    """
+    Remove from each interval the parts that overlap an
+    interval of the same group in the second set.
+
+    - groups: integer group of each interval (e.g. a gene number)
+
+    Returns (groups, starts, ends) of the remaining pieces,
+    with book-ended pieces merged.
+    """
+    groups = numpy.asarray(groups, dtype=numpy.int64)
+    sub_groups = numpy.asarray(sub_groups, dtype=numpy.int64)
+    # Sweep over interval boundaries: intervals add 1 to the
+    # coverage and subtracted intervals add a weight larger than
+    # any possible coverage by intervals
+    sub_weight = len(starts) + 1
+    event_groups = numpy.concatenate([groups, groups,
+                                      sub_groups, sub_groups])
+    event_pos = numpy.concatenate([starts, ends, sub_starts, sub_ends])
+    event_pos = event_pos.astype(numpy.int64)
+    event_deltas = numpy.concatenate([numpy.ones(len(starts)),
+                                      -numpy.ones(len(ends)),
+                                      numpy.repeat(sub_weight, len(sub_starts)),
+                                      numpy.repeat(-sub_weight, len(sub_ends))])
+    order = numpy.lexsort([event_pos, event_groups])
+    event_groups = event_groups[order]
+    event_pos = event_pos[order]
+    coverage = numpy.cumsum(event_deltas[order])
+    # A piece lies between consecutive boundaries of a group and
+    # is kept if it is covered by intervals only
+    keep = (event_groups[1:] == event_groups[:-1]) & \
+           (event_pos[1:] > event_pos[:-1]) & \
+           (coverage[:-1] > 0) & \
+           (coverage[:-1] < sub_weight)
+    piece_groups = event_groups[:-1][keep]
+    piece_starts = event_pos[:-1][keep]
+    piece_ends = event_pos[1:][keep]
+    # Join pieces of an interval that were split by the
+    # boundaries of overlapping intervals
+    order, merged_offsets, merged_starts, merged_ends = \
+        merge_intervals(piece_groups, piece_starts, piece_ends)
+    return piece_groups[order[merged_offsets[:-1]]], \
+           merged_starts, merged_ends
+
+
 def sort_bed(input_filename, output_filename):
     """
-    Sort a BED file. Input filename can be a GFF or
-    a BED file.
+    Sort a BED file by chromosome, then start, then end
+    (as sortBed does.)
     """
     print "Sorting BED: %s" %(input_filename)
     if os.path.isfile(output_filename):
         print "%s exists. Skipping..." %(output_filename)
-    sort_cmd = "sortBed -i %s > "
+        return output_filename
+    with open(input_filename) as input_file:
+        bed_lines = [line for line in input_file \
+                     if not (line.startswith("#") or \
+                             line.startswith("track"))]
+    bed_fields = [line.split("\t", 3) for line in bed_lines]
+    chroms = numpy.array([fields[0] for fields in bed_fields])
+    starts = numpy.array([int(fields[1]) for fields in bed_fields])
+    ends = numpy.array([int(fields[2]) for fields in bed_fields])
+    order = sort_intervals(chroms, starts, ends)
+    with utils.atomic_write(output_filename) as output_file:
+        output_file.write("".join([bed_lines[ind] for ind in order]))
+    return output_filename
 
 
-def merge_bed(input_filename, output_filename,
-              sort_input=True):
+def merge_bed(input_filename, output_filename):
     """
-    Merge a BED file. Input filename can be a GFF or a
-    BED file.
+    Merge the overlapping intervals on the same strand of a
+    BED file, keeping the names of the merged intervals (as
+    sortBed | mergeBed -nms -s does.)
+
+    The output is a sorted BED with the columns: chrom, start,
+    end, names (semicolon-separated) and strand.
     """
-    merge_cmd = ""
     if os.path.isfile(output_filename):
         print "%s exists. Skipping..." %(output_filename)
         return output_filename
-    if sort_input:
-        merge_cmd = "sortBed -i %s | mergeBed -i stdin -nms -s > %s" \
-            %(input_filename,
-              output_filename)
-        print "Executing: %s" %(merge_cmd)
-        os.system(merge_cmd)
-    else:
-        raise Exception, "Not implemented."
+    chroms, starts, ends, names, strands = read_bed_arrays(input_filename)
+    if strands is None:
+        raise Exception, "Cannot merge %s by strand: no strand column." \
+            %(input_filename)
+    order, merged_offsets, merged_starts, merged_ends = \
+        merge_intervals(chroms, starts, ends, strands=strands)
+    merged_firsts = order[merged_offsets[:-1]]
+    with utils.atomic_write(output_filename) as output_file:
+        output_bed_arrays(output_file,
+                          chroms[merged_firsts],
+                          merged_starts,
+                          merged_ends,
+                          join_merged_names(names, order, merged_offsets),
+                          strands[merged_firsts],
+                          score=None)
     return output_filename
 
     
@@ -125,9 +315,50 @@ def output_intervals_as_bed(out_file, chrom, interval_coords, strand,
 
     NOTE: Assumes interval_coords are in 0-based format already!
     """
-    for part in interval_coords:
-        start, end = part
-        bed_line = make_bed_line(chrom, start, end,
-                                 name, score, strand)
-        out_file.write("%s\n" %(bed_line))
-        
+    output_bed_arrays(out_file,
+                      [chrom] * len(interval_coords),
+                      [start for start, end in interval_coords],
+                      [end for start, end in interval_coords],
+                      [name] * len(interval_coords),
+                      [strand] * len(interval_coords),
+                      score=score)
+
+
+def format_bed_lines(chroms, starts, ends, names, strands,
+                     score="1"):
+    """
+    Return BED lines for intervals given as parallel arrays
+    (or lists.)
+
+    - score: score of all intervals; if None, the score column
+      is left out (the layout of mergeBed -s output.)
+
+    NOTE: Assumes starts are in 0-based format already!
+    """
+    if score is None:
+        return ["%s\t%d\t%d\t%s\t%s\n" %(chrom, start, end,
+                                         name, strand) \
+                for chrom, start, end, name, strand \
+                in itertools.izip(chroms, starts, ends, names, strands)]
+    return ["%s\t%d\t%d\t%s\t%s\t%s\n" %(chrom, start, end,
+                                         name, score, strand) \
+            for chrom, start, end, name, strand \
+            in itertools.izip(chroms, starts, ends, names, strands)]
+
+
+def output_bed_arrays(out_file, chroms, starts, ends,
+                      names, strands,
+                      score="1"):
+    """
+    Output intervals given as parallel arrays (or lists) as BED,
+    formatting all lines in one pass and writing them in
+    large chunks.
+
+    - score: score of all intervals (see format_bed_lines)
+
+    NOTE: Assumes starts are in 0-based format already!
+    """
+    utils.write_lines(out_file,
+                      format_bed_lines(chroms, starts, ends,
+                                       names, strands,
+                                       score=score))
@@ -17,6 +17,7 @@ from collections import defaultdict
 import rnaseqlib
 import rnaseqlib.utils as utils
 import rnaseqlib.tables as tables
+import rnaseqlib.genes.GeneXref as GeneXref
 import rnaseqlib.miso.miso_utils as miso_utils
 
 from miso_utils import \
@@ -61,8 +62,8 @@ class PsiTable:
         # Where the MISO sample comparisons are
         self.comparisons_dir = self.misowrap_obj.comparisons_dir
         self.filtered_events = {}
-        # Load gene tables
-        self.gene_table = None
+        # Load gene ID cross-reference index
+        self.gene_xref = None
         self.genes_to_descs = defaultdict(list)
         self.load_gene_table()
         self.verbose = verbose
@@ -85,12 +86,11 @@ class PsiTable:
 
     def load_gene_table(self):
         """
-        Try to load a gene table if one is given.
+        Load the gene ID cross-reference index of the
+        gene tables given in the settings.
         """
-        # Load gene table based on settings info
-        self.gene_table = tables.GeneTable(self.misowrap_obj.tables_dir,
-                                           "ensGene",
-                                           tables_only=True)
+        self.gene_xref = GeneXref.get_gene_xref(self.misowrap_obj.tables_dir,
+                                                na_val=self.na_val)
             
 
         
@@ -110,8 +110,7 @@ class PsiTable:
             genes_symbols_str = self.na_val
             if event_id in events_to_genes:
                 genes = events_to_genes[event_id]
-                genes_symbols = [self.gene_table.genes_to_names[g] \
-                                 for g in genes]
+                genes_symbols = self.gene_xref.get_genes_symbols(genes)
                 genes_str = ",".join(genes)
                 genes_symbols_str = ",".join(genes_symbols)
             all_genes_values.append(genes_str)
@@ -0,0 +1,619 @@
+##
+## Ribo-Seq footprints along transcripts
+##
+## Footprints are counted in one pass over a sorted, indexed BAM
+## file: the 5' end of every read is mapped to a position along
+## the principal transcript of a coding gene (see
+## TranscriptStore.TranscriptCoords) and counted by read length
+## and position. The counts are kept sparse, keyed by
+##
+##   length number * total transcript length + global position
+##
+## where the global position of transcript coordinate x of
+## transcript t is tx_offsets[t] + x.
+##
+## The P-site offset of each read length (the distance of the
+## P-site from the read's 5' end) is estimated from the reads
+## around start codons, and used to count footprints per codon.
+##
+## Ribo-Seq QC is computed from the same counts: metagene profiles
+## around start and stop codons, and the distribution of P-sites
+## over the three frames of CDSs (3-nt periodicity.)
+##
+import os
+import sys
+import time
+
+import numpy
+
+import pandas
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.mapping.bam_utils as bam_utils
+import rnaseqlib.clip.clip_utils as clip_utils
+
+# Range of footprint lengths counted
+MIN_FOOTPRINT_LEN = 20
+MAX_FOOTPRINT_LEN = 40
+
+# Range of P-site offsets considered
+MIN_PSITE_OFFSET = 6
+MAX_PSITE_OFFSET = 18
+
+# Version of the serialized footprint counts
+FOOTPRINTS_VERSION = 1
+
+# Bases around start and stop codons in metagene profiles
+METAGENE_UPSTREAM = 50
+METAGENE_DOWNSTREAM = 100
+
+# Ribo-Seq QC statistics
+PERIODICITY_STATS_HEADER = ["num_cds_footprints",
+                            "percent_frame0",
+                            "percent_frame1",
+                            "percent_frame2",
+                            "periodicity_score"]
+
+
+class FootprintCounts:
+    """
+    Counts of footprint 5' ends by read length and position
+    along a set of transcripts.
+    """
+    def __init__(self, trans_ids, tx_offsets,
+                 cds_tx_starts, cds_tx_ends,
+                 read_lens, keys, counts):
+        self.trans_ids = trans_ids
+        self.tx_offsets = tx_offsets
+        self.cds_tx_starts = cds_tx_starts
+        self.cds_tx_ends = cds_tx_ends
+        # Read length of each length number
+        self.read_lens = read_lens
+        # Sorted footprint keys and their counts
+        self.keys = keys
+        self.counts = counts
+
+
+    def __repr__(self):
+        return "FootprintCounts(%d transcripts, %d footprints)" \
+            %(len(self.trans_ids), self.counts.sum())
+
+
+    def get_footprints(self):
+        """
+        Return the footprints as (len_nums, trans, tx_positions,
+        counts): the length number, transcript and transcript
+        coordinate of the 5' end of each counted position.
+        """
+        total_len = max(self.tx_offsets[-1], 1)
+        len_nums = self.keys // total_len
+        global_positions = self.keys % total_len
+        trans = numpy.searchsorted(self.tx_offsets, global_positions,
+                                   side="right") - 1
+        return len_nums, trans, global_positions - self.tx_offsets[trans], \
+               self.counts
+
+
+    def get_cds_profiles(self, anchor="start",
+                         upstream=MAX_PSITE_OFFSET,
+                         downstream=MAX_PSITE_OFFSET,
+                         psite_offsets=None):
+        """
+        Return the profiles of footprints around start or stop
+        codons, summed over transcripts, as a matrix with a row
+        per read length and a column per position from
+        'upstream' bases before the first base of the codon to
+        'downstream' bases after it.
+
+        - anchor: 'start' or 'stop' codon
+        - psite_offsets: if given, profile the P-sites of the
+          footprints (lengths with no offset are left out.)
+          Otherwise the 5' ends are profiled.
+        """
+        len_nums, trans, tx_positions, counts = self.get_footprints()
+        if psite_offsets is not None:
+            has_offset = (psite_offsets[len_nums] >= 0)
+            len_nums, trans, tx_positions, counts = \
+                len_nums[has_offset], trans[has_offset], \
+                tx_positions[has_offset], counts[has_offset]
+            tx_positions = tx_positions + psite_offsets[len_nums]
+        if anchor == "start":
+            anchor_positions = self.cds_tx_starts
+        elif anchor == "stop":
+            anchor_positions = self.cds_tx_ends - 3
+        else:
+            raise Exception, "Unknown anchor %s" %(anchor)
+        window_len = upstream + downstream
+        rel_positions = tx_positions - anchor_positions[trans] + upstream
+        in_window = (rel_positions >= 0) & (rel_positions < window_len)
+        profiles = numpy.bincount(len_nums[in_window] * window_len + \
+                                  rel_positions[in_window],
+                                  weights=counts[in_window],
+                                  minlength=len(self.read_lens) * window_len)
+        return profiles.reshape((len(self.read_lens), window_len))
+
+
+    def estimate_psite_offsets(self, min_offset=MIN_PSITE_OFFSET,
+                               max_offset=MAX_PSITE_OFFSET,
+                               min_reads=10):
+        """
+        Estimate the P-site offset of each read length.
+
+        Ribosomes initiating at a start codon have it in their
+        P-site, so the 5' ends of the footprints of a length pile
+        up at its P-site offset upstream of start codons. The
+        offset of a length is the distance (between 'min_offset'
+        and 'max_offset') with the most 5' ends upstream of start
+        codons.
+
+        Returns the offset of each length (see self.read_lens),
+        -1 for lengths with fewer than 'min_reads' 5' ends in
+        the window, and the profile the offsets were taken from.
+        """
+        profiles = self.get_cds_profiles(anchor="start",
+                                         upstream=max_offset,
+                                         downstream=0)
+        # Column max_offset - d holds the 5' ends d bases upstream
+        # of start codons; reverse so that column d - min_offset
+        # is offset d
+        window = profiles[:, 0:(max_offset - min_offset + 1)][:, ::-1]
+        psite_offsets = numpy.argmax(window, axis=1) + min_offset
+        psite_offsets[window.sum(axis=1) < min_reads] = -1
+        return psite_offsets, profiles
+
+
+    def get_num_codons(self):
+        """
+        Return the number of whole codons in the CDS of every
+        transcript.
+        """
+        return numpy.maximum((self.cds_tx_ends - self.cds_tx_starts) // 3, 0)
+
+
+    def get_cds_psites(self, psite_offsets):
+        """
+        Return the footprints whose P-site falls in a whole codon
+        of a CDS, as (len_nums, trans, cds_positions, counts)
+        where cds_positions are the P-sites relative to the
+        first base of the CDS.
+
+        - psite_offsets: P-site offset of each read length (-1
+          for lengths that are not counted)
+        """
+        len_nums, trans, tx_positions, counts = self.get_footprints()
+        cds_positions = tx_positions + psite_offsets[len_nums] - \
+                        self.cds_tx_starts[trans]
+        in_cds = (psite_offsets[len_nums] >= 0) & (cds_positions >= 0) & \
+                 (cds_positions < 3 * self.get_num_codons()[trans])
+        return len_nums[in_cds], trans[in_cds], cds_positions[in_cds], \
+               counts[in_cds]
+
+
+    def get_codon_density(self, psite_offsets):
+        """
+        Return the number of footprints whose P-site falls in
+        each codon of each CDS, as (codon_offsets, density) in
+        CSR layout: the codon counts of transcript t are
+        density[codon_offsets[t]:codon_offsets[t+1]].
+
+        - psite_offsets: P-site offset of each read length (-1
+          for lengths that are not counted)
+        """
+        num_codons = self.get_num_codons()
+        codon_offsets = numpy.zeros(len(num_codons) + 1, dtype=numpy.int64)
+        numpy.cumsum(num_codons, out=codon_offsets[1:])
+        len_nums, trans, cds_positions, counts = \
+            self.get_cds_psites(psite_offsets)
+        density = numpy.bincount(codon_offsets[trans] + cds_positions // 3,
+                                 weights=counts,
+                                 minlength=codon_offsets[-1])
+        return codon_offsets, numpy.rint(density).astype(numpy.uint32)
+
+
+    def get_frame_counts(self, psite_offsets):
+        """
+        Return the number of CDS P-sites in each frame, as a
+        matrix with a row per read length and a column per frame
+        (0 for P-sites on the first base of a codon.)
+        """
+        len_nums, trans, cds_positions, counts = \
+            self.get_cds_psites(psite_offsets)
+        frame_counts = numpy.bincount(len_nums * 3 + cds_positions % 3,
+                                      weights=counts,
+                                      minlength=len(self.read_lens) * 3)
+        return numpy.rint(frame_counts).astype(numpy.int64).reshape((-1, 3))
+
+
+    def save(self, output_filename):
+        """
+        Serialize the counts as a NumPy .npz file.
+        """
+        with utils.atomic_write(output_filename, mode="wb") as output_file:
+            numpy.savez(output_file,
+                        footprints_version=numpy.array([FOOTPRINTS_VERSION]),
+                        trans_ids=self.trans_ids,
+                        tx_offsets=self.tx_offsets,
+                        cds_tx_starts=self.cds_tx_starts,
+                        cds_tx_ends=self.cds_tx_ends,
+                        read_lens=self.read_lens,
+                        keys=self.keys,
+                        counts=self.counts)
+        return output_filename
+
+
+def load_footprint_counts(footprints_filename):
+    """
+    Load serialized FootprintCounts, or return None if they
+    were saved by another version.
+    """
+    footprints_data = numpy.load(footprints_filename)
+    try:
+        if ("footprints_version" not in footprints_data.files) or \
+           (footprints_data["footprints_version"][0] != FOOTPRINTS_VERSION):
+            return None
+        return FootprintCounts(footprints_data["trans_ids"],
+                               footprints_data["tx_offsets"],
+                               footprints_data["cds_tx_starts"],
+                               footprints_data["cds_tx_ends"],
+                               footprints_data["read_lens"],
+                               footprints_data["keys"],
+                               footprints_data["counts"])
+    finally:
+        footprints_data.close()
+
+
+def get_periodicity_score(profile):
+    """
+    Return the fraction of the (non-constant) power of a
+    coverage profile that is at a period of 3 bases. The
+    profile is cut to a multiple of 3 bases.
+    """
+    profile = numpy.asarray(profile, dtype=numpy.float64)
+    profile = profile[0:(3 * (len(profile) // 3))]
+    if len(profile) == 0:
+        return 0.
+    power = numpy.abs(numpy.fft.rfft(profile - profile.mean())) ** 2
+    total_power = power.sum()
+    if total_power == 0:
+        return 0.
+    return power[len(profile) // 3] / total_power
+
+
+def get_periodicity_stats(footprints, psite_offsets,
+                          downstream=METAGENE_DOWNSTREAM):
+    """
+    Return the Ribo-Seq QC statistics of footprints (see
+    PERIODICITY_STATS_HEADER): the number of CDS P-sites, the
+    fraction of them in each frame and the periodicity score of
+    the P-site profile over the first 'downstream' bases of
+    CDSs.
+    """
+    frame_totals = footprints.get_frame_counts(psite_offsets).sum(axis=0)
+    num_cds_footprints = int(frame_totals.sum())
+    stats = {"num_cds_footprints": num_cds_footprints}
+    for frame in xrange(3):
+        percent_frame = 0
+        if num_cds_footprints > 0:
+            percent_frame = frame_totals[frame] / float(num_cds_footprints)
+        stats["percent_frame%d" %(frame)] = percent_frame
+    cds_profile = footprints.get_cds_profiles(anchor="start",
+                                              upstream=0,
+                                              downstream=downstream,
+                                              psite_offsets=psite_offsets)
+    stats["periodicity_score"] = get_periodicity_score(cds_profile.sum(axis=0))
+    return stats
+
+
+def output_metagene_profiles(footprints, psite_offsets, output_filename,
+                             upstream=METAGENE_UPSTREAM,
+                             downstream=METAGENE_DOWNSTREAM):
+    """
+    Output the metagene profiles of footprint 5' ends and
+    P-sites around start and stop codons, by read length, as a
+    table with a row per codon, read length and position
+    (relative to the first base of the codon.)
+    """
+    positions = numpy.arange(-upstream, downstream)
+    profiles = []
+    for anchor in ["start", "stop"]:
+        five_prime_profiles = \
+            footprints.get_cds_profiles(anchor=anchor,
+                                        upstream=upstream,
+                                        downstream=downstream)
+        psite_profiles = \
+            footprints.get_cds_profiles(anchor=anchor,
+                                        upstream=upstream,
+                                        downstream=downstream,
+                                        psite_offsets=psite_offsets)
+        profiles.append(pandas.DataFrame(\
+            {"codon": anchor,
+             "read_len": numpy.repeat(footprints.read_lens, len(positions)),
+             "position": numpy.tile(positions, len(footprints.read_lens)),
+             "num_5p_ends": numpy.rint(five_prime_profiles.ravel()).astype(numpy.int64),
+             "num_psites": numpy.rint(psite_profiles.ravel()).astype(numpy.int64)},
+            columns=["codon", "read_len", "position",
+                     "num_5p_ends", "num_psites"]))
+    with utils.atomic_write(output_filename) as profiles_file:
+        pandas.concat(profiles).to_csv(profiles_file,
+                                       sep="\t",
+                                       index=False)
+    return output_filename
+
+
+def output_frame_counts(footprints, psite_offsets, output_filename):
+    """
+    Output the number of CDS P-sites in each frame by read
+    length.
+    """
+    frame_counts = footprints.get_frame_counts(psite_offsets)
+    frames = pandas.DataFrame({"read_len": footprints.read_lens,
+                               "psite_offset": psite_offsets,
+                               "frame0": frame_counts[:, 0],
+                               "frame1": frame_counts[:, 1],
+                               "frame2": frame_counts[:, 2]},
+                              columns=["read_len", "psite_offset",
+                                       "frame0", "frame1", "frame2"])
+    with utils.atomic_write(output_filename) as frames_file:
+        frames.to_csv(frames_file,
+                      sep="\t",
+                      index=False)
+    return output_filename
+
+
+def output_ribo_qc(footprint_filenames, output_dir, label):
+    """
+    Output the Ribo-Seq QC of a sample from its footprint
+    outputs (see output_footprints): metagene profiles
+    ('<label>.metagene.txt') and frame counts
+    ('<label>.frames.txt') in 'output_dir'.
+
+    Returns the periodicity statistics of the sample (see
+    get_periodicity_stats.)
+    """
+    footprints = load_footprint_counts(footprint_filenames["footprints"])
+    if footprints is None:
+        raise Exception, "Footprint counts %s are out of date." \
+            %(footprint_filenames["footprints"])
+    read_lens, psite_offsets = \
+        load_psite_offsets(footprint_filenames["psite_offsets"])
+    if not numpy.array_equal(read_lens, footprints.read_lens):
+        raise Exception, "P-site offsets %s do not match the footprint " \
+                         "read lengths." %(footprint_filenames["psite_offsets"])
+    utils.make_dir(output_dir)
+    output_metagene_profiles(footprints, psite_offsets,
+                             os.path.join(output_dir,
+                                          "%s.metagene.txt" %(label)))
+    output_frame_counts(footprints, psite_offsets,
+                        os.path.join(output_dir,
+                                     "%s.frames.txt" %(label)))
+    return get_periodicity_stats(footprints, psite_offsets)
+
+
+def sum_sparse_counts(keys_list, counts_list):
+    """
+    Add up sparse counts given as lists of (keys, counts)
+    arrays. Returns the sorted unique keys and their counts.
+    """
+    if len(keys_list) == 0:
+        return numpy.zeros(0, dtype=numpy.int64), \
+               numpy.zeros(0, dtype=numpy.int64)
+    keys, key_inds = numpy.unique(numpy.concatenate(keys_list),
+                                  return_inverse=True)
+    counts = numpy.bincount(key_inds,
+                            weights=numpy.concatenate(counts_list),
+                            minlength=len(keys))
+    return keys, numpy.rint(counts).astype(numpy.int64)
+
+
+def merge_sparse_counts(first, second):
+    """
+    Merge two (keys, counts) kernel results.
+    """
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return sum_sparse_counts([first[0], second[0]],
+                             [first[1], second[1]])
+
+
+def count_footprint_batch(coords, chrom_code,
+                          is_reverse, five_primes,
+                          read_lens, weights,
+                          min_len=MIN_FOOTPRINT_LEN,
+                          max_len=MAX_FOOTPRINT_LEN):
+    """
+    Count a batch of footprints on a chromosome.
+
+    - coords: TranscriptCoords of the transcripts
+    - is_reverse: whether each read is on the minus strand
+    - five_primes: genomic position of each read's 5' end
+    - read_lens: length of each read
+    - weights: number of reads each read stands for
+
+    Returns sparse (keys, counts).
+    """
+    read_lens = numpy.asarray(read_lens, dtype=numpy.int64)
+    strands = numpy.where(numpy.asarray(is_reverse, dtype=bool), "-", "+")
+    trans, tx_positions = coords.map_positions(chrom_code, strands,
+                                               five_primes)
+    counted = (trans >= 0) & (read_lens >= min_len) & (read_lens <= max_len)
+    keys = (read_lens[counted] - min_len) * coords.tx_offsets[-1] + \
+           coords.get_global_positions(trans[counted], tx_positions[counted])
+    return sum_sparse_counts([keys],
+                             [numpy.asarray(weights, dtype=numpy.int64)[counted]])
+
+
+def footprints_kernel(bam_filename, shard, coords,
+                      min_len=MIN_FOOTPRINT_LEN,
+                      max_len=MAX_FOOTPRINT_LEN,
+                      batch_size=100000):
+    """
+    Counting kernel: return the sparse footprint counts of the
+    reads in the shard (see bam_utils.map_reduce_bam.)
+    """
+    chrom_code = coords.get_chrom_code(shard[0])
+    if chrom_code is None:
+        return None
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    keys_list = []
+    counts_list = []
+    batch = ([], [], [], [])
+    for read in bam_utils.iter_shard_reads(bam_file, shard):
+        is_reverse, five_primes, read_lens, weights = batch
+        is_reverse.append(read.is_reverse)
+        if read.is_reverse:
+            five_primes.append(read.aend - 1)
+        else:
+            five_primes.append(read.pos)
+        read_lens.append(read.qlen)
+        weights.append(clip_utils.get_read_weight(read))
+        if len(five_primes) == batch_size:
+            keys, counts = count_footprint_batch(coords, chrom_code, *batch,
+                                                 min_len=min_len,
+                                                 max_len=max_len)
+            keys_list.append(keys)
+            counts_list.append(counts)
+            batch = ([], [], [], [])
+    bam_file.close()
+    keys, counts = count_footprint_batch(coords, chrom_code, *batch,
+                                         min_len=min_len,
+                                         max_len=max_len)
+    keys_list.append(keys)
+    counts_list.append(counts)
+    return sum_sparse_counts(keys_list, counts_list)
+
+
+def count_footprints(bam_filename, coords,
+                     min_len=MIN_FOOTPRINT_LEN,
+                     max_len=MAX_FOOTPRINT_LEN,
+                     num_processors=1):
+    """
+    Count the footprints of a sorted, indexed BAM file along
+    transcripts.
+
+    - coords: TranscriptCoords of the transcripts (see
+      TranscriptStore.get_coding_transcript_coords)
+    - min_len, max_len: range of read lengths counted
+
+    Returns FootprintCounts.
+    """
+    result = bam_utils.map_reduce_bam(bam_filename,
+                                      footprints_kernel,
+                                      kernel_args=(coords, min_len, max_len),
+                                      num_processors=num_processors,
+                                      reducer=merge_sparse_counts)
+    if result is None:
+        result = sum_sparse_counts([], [])
+    keys, counts = result
+    return FootprintCounts(coords.trans_ids,
+                           coords.tx_offsets,
+                           coords.cds_tx_starts,
+                           coords.cds_tx_ends,
+                           numpy.arange(min_len, max_len + 1),
+                           keys,
+                           counts)
+
+
+def get_footprint_filenames(output_dir, label):
+    """
+    Return the footprint output files of a sample: the
+    footprint counts, the P-site offsets and the codon density.
+    """
+    return {"footprints": os.path.join(output_dir,
+                                       "%s.footprints.npz" %(label)),
+            "psite_offsets": os.path.join(output_dir,
+                                          "%s.psite_offsets.txt" %(label)),
+            "codon_density": os.path.join(output_dir,
+                                          "%s.codon_density.npz" %(label))}
+
+
+def output_psite_offsets(psite_offsets, profiles, read_lens,
+                         output_filename):
+    """
+    Output the P-site offset of each read length, along with
+    the number of 5' ends upstream of start codons it was
+    estimated from.
+    """
+    with utils.atomic_write(output_filename) as offsets_file:
+        offsets_file.write("read_len\tpsite_offset\tnum_start_reads\n")
+        for read_len, offset, num_reads in zip(read_lens,
+                                               psite_offsets,
+                                               profiles.sum(axis=1)):
+            offsets_file.write("%d\t%d\t%d\n" %(read_len, offset, num_reads))
+
+
+def load_psite_offsets(offsets_filename):
+    """
+    Load P-site offsets as (read_lens, psite_offsets).
+    """
+    offsets = numpy.loadtxt(offsets_filename,
+                            dtype=numpy.int64,
+                            skiprows=1,
+                            ndmin=2)
+    return offsets[:, 0], offsets[:, 1]
+
+
+def output_codon_density(footprints, psite_offsets, output_filename):
+    """
+    Output the per-codon footprint density of every CDS as a
+    compressed NumPy .npz file with the transcript IDs, the CSR
+    codon offsets and the codon counts (see
+    FootprintCounts.get_codon_density.)
+    """
+    codon_offsets, density = footprints.get_codon_density(psite_offsets)
+    with utils.atomic_write(output_filename, mode="wb") as density_file:
+        numpy.savez_compressed(density_file,
+                               trans_ids=footprints.trans_ids,
+                               codon_offsets=codon_offsets,
+                               density=density,
+                               read_lens=footprints.read_lens,
+                               psite_offsets=psite_offsets)
+    return output_filename
+
+
+def output_footprints(bam_filename, coords, output_dir, label,
+                      min_len=MIN_FOOTPRINT_LEN,
+                      max_len=MAX_FOOTPRINT_LEN,
+                      num_processors=1):
+    """
+    Count the footprints of a sample, estimate its P-site
+    offsets and output its per-codon footprint density.
+
+    - bam_filename: sorted, indexed BAM of the sample's reads
+    - coords: TranscriptCoords of the transcripts
+
+    Returns the output files (see get_footprint_filenames.)
+    """
+    utils.make_dir(output_dir)
+    output_filenames = get_footprint_filenames(output_dir, label)
+    if all([os.path.isfile(filename) \
+            for filename in output_filenames.values()]):
+        print "SKIPPING: footprints of %s already exist!" %(label)
+        return output_filenames
+    print "Counting footprints of %s from: %s" %(label, bam_filename)
+    t1 = time.time()
+    footprints = None
+    if os.path.isfile(output_filenames["footprints"]):
+        footprints = load_footprint_counts(output_filenames["footprints"])
+    if footprints is None:
+        footprints = count_footprints(bam_filename, coords,
+                                      min_len=min_len,
+                                      max_len=max_len,
+                                      num_processors=num_processors)
+        footprints.save(output_filenames["footprints"])
+    psite_offsets, profiles = footprints.estimate_psite_offsets()
+    if (psite_offsets < 0).all():
+        print "WARNING: Too few reads around start codons to estimate " \
+              "P-site offsets of %s" %(label)
+    output_psite_offsets(psite_offsets, profiles, footprints.read_lens,
+                         output_filenames["psite_offsets"])
+    output_codon_density(footprints, psite_offsets,
+                         output_filenames["codon_density"])
+    t2 = time.time()
+    print "Counted %d footprints on %d transcripts in %.2f secs" \
+        %(footprints.counts.sum(), len(footprints.trans_ids), (t2 - t1))
+    return output_filenames
@@ -4,32 +4,185 @@
 import os
 import sys
 import time
+import glob
+import shutil
 
 import rnaseqlib
 import rnaseqlib.utils as utils
 import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.clip.clip_utils as clip_utils
+
+import pandas
 
 import scipy
 from scipy.stats.stats import zscore
 
+import numpy
 from numpy import *
 
+# Summary statistics of polyA trimming
+TRIMMING_STATS_HEADER = ["num_reads",
+                         "num_adapter",
+                         "num_no_polyA",
+                         "num_too_short",
+                         "num_trimmed"]
+
+# Trimming statistics reported in QC files (the number of
+# reads is already there)
+TRIMMING_QC_HEADER = ["num_adapter",
+                      "num_no_polyA",
+                      "num_too_short",
+                      "num_trimmed"]
+
 def rstrip_stretch(s, letter):
     """
     Strip (from right) consecutive stretch of letters.
     """
-    stripped_s = ""
-    first = True
-    for l in s[::-1]:
-        if first:
-            if l == letter:
-                continue
-            else:
-                stripped_s += l
-                first = False
-        else:
-            stripped_s += l
-    return stripped_s[::-1]
+    return s.rstrip(letter)
+
+
+def trim_fastq_batch(batch,
+                     min_polyA_len=3,
+                     min_read_len=22,
+                     adapter=None,
+                     adapter_min_overlap=3):
+    """
+    Trim the polyA ends of a batch of FASTQ records (as
+    returned by fastq_utils.read_fastq_batches.)
+
+    Reads that do not end in at least 'min_polyA_len' As, or
+    that are shorter than 'min_read_len' after trimming, are
+    discarded. If an adapter is given, it is clipped (along with
+    everything after it) before the polyA stretch.
+
+    Returns the trimmed records as FASTQ text and the trimming
+    statistics of the batch.
+    """
+    headers, seqs, headers2, quals = batch
+    num_reads = len(seqs)
+    num_adapter = 0
+    if adapter is not None:
+        adapter_starts = \
+            fastq_utils.get_adapter_starts(seqs, adapter,
+                                           min_overlap=adapter_min_overlap)
+        clipped = numpy.flatnonzero(adapter_starts < \
+                                    numpy.array([len(seq) for seq in seqs],
+                                                dtype=numpy.int64))
+        num_adapter = len(clipped)
+        seqs = list(seqs)
+        for seq_num in clipped:
+            seqs[seq_num] = seqs[seq_num][0:adapter_starts[seq_num]]
+    seq_lens = numpy.array([len(seq) for seq in seqs], dtype=numpy.int64)
+    polyA_lens = fastq_utils.get_trailing_stretch_lens(seqs, "A")
+    trimmed_lens = seq_lens - polyA_lens
+    # Reads must end with at least one A
+    has_polyA = (polyA_lens >= numpy.maximum(min_polyA_len, 1))
+    long_enough = (trimmed_lens >= min_read_len)
+    kept = numpy.flatnonzero(has_polyA & long_enough)
+    trimmed_text = \
+        fastq_utils.format_fastq_batch([headers[n] for n in kept],
+                                       [seqs[n][0:trimmed_lens[n]] for n in kept],
+                                       [headers2[n] for n in kept],
+                                       [quals[n][0:trimmed_lens[n]] for n in kept])
+    stats = {"num_reads": num_reads,
+             "num_adapter": num_adapter,
+             "num_no_polyA": int((~has_polyA).sum()),
+             "num_too_short": int((has_polyA & ~long_enough).sum()),
+             "num_trimmed": len(kept),
+             "polyA_len_counts": numpy.bincount(polyA_lens[has_polyA],
+                                                minlength=1),
+             "trimmed_len_counts": numpy.bincount(trimmed_lens[kept],
+                                                  minlength=1)}
+    return trimmed_text, stats
+
+
+def _trim_fastq_batch(trim_task):
+    """
+    Trim a batch of FASTQ records and compress them into a
+    gzip member.
+    """
+    batch, trim_args, compress_level = trim_task
+    trimmed_text, stats = trim_fastq_batch(batch, **trim_args)
+    return fastq_utils.compress_gzip_member(trimmed_text,
+                                            compress_level=compress_level), \
+           stats
+
+
+def _trim_fastq_chunk(fastq_filename, index, first_record, num_records,
+                      output_filename, trim_args, batch_size, compress_level):
+    """
+    Trim a chunk of records of a FASTQ file into a part file of
+    'output_filename'. Used by fastq_utils.map_fastq_chunks.
+
+    Returns the part filename and the trimming statistics.
+    """
+    part_filename = "%s.part%d" %(output_filename, first_record)
+    stats = None
+    part_file = open(part_filename, "wb")
+    try:
+        for batch in fastq_utils.read_fastq_range_batches(fastq_filename,
+                                                          first_record,
+                                                          num_records,
+                                                          index=index,
+                                                          batch_size=batch_size):
+            trimmed_data, batch_stats = \
+                _trim_fastq_batch((batch, trim_args, compress_level))
+            part_file.write(trimmed_data)
+            stats = merge_trimming_stats(stats, batch_stats)
+    finally:
+        part_file.close()
+    return part_filename, stats
+
+
+def add_counts(first, second):
+    """
+    Add two count vectors of possibly different lengths.
+    """
+    if len(first) < len(second):
+        first, second = second, first
+    counts = first.copy()
+    counts[0:len(second)] += second
+    return counts
+
+
+def merge_trimming_stats(stats, batch_stats):
+    """
+    Add the trimming statistics of a batch to 'stats'.
+    """
+    if stats is None:
+        return batch_stats
+    for stat in TRIMMING_STATS_HEADER:
+        stats[stat] += batch_stats[stat]
+    for stat in ["polyA_len_counts", "trimmed_len_counts"]:
+        stats[stat] = add_counts(stats[stat], batch_stats[stat])
+    return stats
+
+
+def output_trimming_stats(stats, stats_filename,
+                          lens_filename):
+    """
+    Output the trimming statistics: a one-row summary (as in QC
+    files) and the distributions of polyA stretch lengths and of
+    trimmed read lengths.
+    """
+    summary = pandas.DataFrame([dict((stat, stats[stat]) \
+                                     for stat in TRIMMING_STATS_HEADER)],
+                               columns=TRIMMING_STATS_HEADER)
+    summary.to_csv(stats_filename,
+                   sep="\t",
+                   index=False)
+    num_lens = len(add_counts(stats["polyA_len_counts"],
+                              stats["trimmed_len_counts"]))
+    zero_counts = numpy.zeros(num_lens, dtype=numpy.int64)
+    lens_dist = pandas.DataFrame({"length": numpy.arange(num_lens),
+                                  "num_polyA": add_counts(zero_counts,
+                                                          stats["polyA_len_counts"]),
+                                  "num_trimmed": add_counts(zero_counts,
+                                                            stats["trimmed_len_counts"])},
+                                 columns=["length", "num_polyA", "num_trimmed"])
+    lens_dist.to_csv(lens_filename,
+                     sep="\t",
+                     index=False)
 
 def compute_te(ribo_rpkms, rna_rpkms,
                na_val=NaN):
@@ -38,7 +191,8 @@ def compute_te(ribo_rpkms, rna_rpkms,
 
       ribo_rpkm / rna_rpkms
 
-    Takes lists/vectors as input.
+    Takes vectors, or matrices with a column per RNA/Ribo
+    sample pair, as input and computes all TEs at once.
 
     If rna_rpkm is 0 then TE is undefined.
 
@@ -46,73 +200,175 @@ def compute_te(ribo_rpkms, rna_rpkms,
     - rna_rpkms: rna-seq RPKMs
     - na_val: NA value to use
     """
-    if len(ribo_rpkms) != len(rna_rpkms):
-        raise Exception, "Error: compute_te requires same length " \
-                         "vectors as input."
-    te = []
-    for ribo, rna in zip(ribo_rpkms, rna_rpkms):
-        te_val = na_val
-        if rna != 0:
-            # If the RNA is detectable, define
-            # the TE
-            if ribo == 0:
-                te_val = 0
-            else:
-                te_val = ribo / float(rna)
-        te.append(te_val)
+    ribo_rpkms = numpy.asarray(ribo_rpkms, dtype=numpy.float64)
+    rna_rpkms = numpy.asarray(rna_rpkms, dtype=numpy.float64)
+    if ribo_rpkms.shape != rna_rpkms.shape:
+        raise Exception, "Error: compute_te requires same shape " \
+                         "inputs."
+    te = numpy.empty(ribo_rpkms.shape, dtype=numpy.float64)
+    te.fill(na_val)
+    # If the RNA is detectable, define the TE
+    detected = (rna_rpkms != 0)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        te[detected] = ribo_rpkms[detected] / rna_rpkms[detected]
+    te[detected & (ribo_rpkms == 0)] = 0
     return te
+
+
+def normalize_te(te, na_val=NaN):
+    """
+    Log (base 2) and z-score normalize TEs, each column of a
+    matrix of TEs separately.
+
+    TEs whose log is undefined (NA or 0) are masked: they are
+    left out of the mean and standard deviation of their column
+    and are 'na_val' in the output.
+    """
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        log_te = numpy.ma.masked_invalid(numpy.log2(numpy.asarray(te,
+                                                                  dtype=numpy.float64)))
+    normed_te = (log_te - log_te.mean(axis=0)) / log_te.std(axis=0)
+    return normed_te.filled(na_val)
     
 
+def get_trimming_stats_filename(fastq_filename, output_dir):
+    """
+    Return the filename of the trimming statistics of a FASTQ
+    file trimmed by trim_polyA_ends.
+    """
+    # Strip the trailing extension
+    output_basename = ".".join(os.path.basename(fastq_filename).split(".")[0:-1])
+    return os.path.join(output_dir,
+                        "%s.trimmed_polyA.stats.txt" %(output_basename))
+
+
+def load_trimming_stats(stats_filename):
+    """
+    Load the trimming statistics summary of a FASTQ file.
+    """
+    summary = pandas.read_table(stats_filename, sep="\t")
+    return dict((stat, int(summary[stat][0])) \
+                for stat in TRIMMING_STATS_HEADER)
+
+
 def trim_polyA_ends(fastq_filename,
                     output_dir,
                     compressed=False,
                     min_polyA_len=3,
-                    min_read_len=22):
+                    min_read_len=22,
+                    adapter=None,
+                    adapter_min_overlap=3,
+                    num_processors=1,
+                    batch_size=100000,
+                    compress_level=6):
     """
     Trim polyA ends from reads.
+
+    Reads are trimmed in batches of 'batch_size' records (see
+    trim_fastq_batch), each written as its own gzip member. With
+    more than one processor, the input is split into chunks (see
+    fastq_utils.map_fastq_chunks) that are each read, trimmed
+    and compressed by their own process.
+    Trimming statistics are output alongside the trimmed reads.
+
+    - adapter: if given, 3' adapter to clip before the polyA
+    - compress_level: gzip compression level of the output
     """
     print "Trimming polyA trails from: %s" %(fastq_filename)
     # Strip the trailing extension
     output_basename = ".".join(os.path.basename(fastq_filename).split(".")[0:-1])
+    stats_filename = get_trimming_stats_filename(fastq_filename, output_dir)
+    lens_filename = os.path.join(output_dir,
+                                 "%s.trimmed_polyA.lens.txt" %(output_basename))
     output_basename = "%s.trimmed_polyA.fastq.gz" %(output_basename)
     output_filename = os.path.join(output_dir, output_basename)
     utils.make_dir(output_dir)
-    if os.path.isfile(output_filename):
+    if os.path.isfile(output_filename) and os.path.isfile(stats_filename):
         print "SKIPPING: %s already exists!" %(output_filename)
         return output_filename
     print "  - Outputting trimmed sequences to: %s" %(output_filename)
-    input_file = fastq_utils.read_open_fastq(fastq_filename)
-    output_file = fastq_utils.write_open_fastq(output_filename)
+    trim_args = {"min_polyA_len": min_polyA_len,
+                 "min_read_len": min_read_len,
+                 "adapter": adapter,
+                 "adapter_min_overlap": adapter_min_overlap}
     t1 = time.time()
-    for line in fastq_utils.read_fastq(input_file):
-        header, seq, header2, qual = line
-        if seq.endswith("A"):
-            # Skip sequences that do not end with at least N
-            # many As
-            if seq[-min_polyA_len:] != ("A" * min_polyA_len):
-                continue
-            # Get sequence stripped of contiguous strech of polyAs
-            stripped_seq = rstrip_stretch(seq, "A")
-            if len(stripped_seq) < min_read_len:
-                # Skip altogether reads that are shorter than
-                # the required length after trimming
-                continue
-            # Strip the quality scores to match trimmed sequence
-            new_qual = qual[0:len(stripped_seq)]
-            new_rec = (header, stripped_seq, header2, new_qual)
-            # Write the record with trimmed sequence back out to file
-            fastq_utils.write_fastq(output_file, new_rec)
+    stats = None
+    # Write to a temporary file first so that an interrupted
+    # trimming is not mistaken for a finished one
+    with utils.atomic_write(output_filename, "wb") as output_file:
+        if num_processors > 1:
+            # Each process reads, trims and compresses its own
+            # range of records into a part file
+            try:
+                chunk_results = \
+                    fastq_utils.map_fastq_chunks(fastq_filename,
+                                                 _trim_fastq_chunk,
+                                                 chunk_args=(output_file.name,
+                                                             trim_args,
+                                                             batch_size,
+                                                             compress_level),
+                                                 num_processors=num_processors)
+                for part_filename, chunk_stats in chunk_results:
+                    part_file = open(part_filename, "rb")
+                    shutil.copyfileobj(part_file, output_file)
+                    part_file.close()
+                    stats = merge_trimming_stats(stats, chunk_stats)
+            finally:
+                for part_filename in glob.glob("%s.part*" %(output_file.name)):
+                    os.remove(part_filename)
+        else:
+            input_file = fastq_utils.read_open_fastq(fastq_filename)
+            try:
+                for batch in fastq_utils.read_fastq_batches(input_file,
+                                                            batch_size=batch_size):
+                    trimmed_data, batch_stats = \
+                        _trim_fastq_batch((batch, trim_args, compress_level))
+                    # Write the trimmed records back out to file
+                    output_file.write(trimmed_data)
+                    stats = merge_trimming_stats(stats, batch_stats)
+            finally:
+                input_file.close()
+        if stats is None:
+            stats = trim_fastq_batch(([], [], [], []), **trim_args)[1]
+        output_trimming_stats(stats, stats_filename, lens_filename)
     t2 = time.time()
     print "Trimming took %.2f mins." %((t2 - t1)/60.)
-    output_file.close()
+    print "  - Trimmed %d of %d reads (%d had no polyA, %d were too short)" \
+        %(stats["num_trimmed"],
+          stats["num_reads"],
+          stats["num_no_polyA"],
+          stats["num_too_short"])
+    print "  - Trimming statistics in: %s" %(stats_filename)
     return output_filename
             
 
-def compute_read_len_dist():
+def compute_read_len_dist(fastq_filename, batch_size=100000):
     """
-    Compute distribution of read lengths.
+    Compute distribution of read lengths of a FASTQ file in
+    one streaming pass.
+
+    Collapsed reads are counted as the number of reads they
+    stand for. Returns the number of reads and their length
+    histogram (see fastq_utils.get_read_len_hist.)
     """
-    pass
+    num_reads = 0
+    read_len_hist = numpy.zeros(fastq_utils.READ_LEN_HIST_SIZE,
+                                dtype=numpy.int64)
+    fastq_file = fastq_utils.read_open_fastq(fastq_filename)
+    try:
+        for headers, seqs, headers2, quals in \
+            fastq_utils.read_fastq_batches(fastq_file,
+                                           batch_size=batch_size):
+            weights = numpy.array([clip_utils.get_collapsed_count(header) \
+                                   for header in headers],
+                                  dtype=numpy.int64)
+            num_reads += int(weights.sum())
+            read_len_hist += \
+                fastq_utils.get_read_len_hist([len(seq) for seq in seqs],
+                                              weights=weights)
+    finally:
+        fastq_file.close()
+    return num_reads, read_len_hist
 
 
 if __name__ == "__main__":
@@ -13,8 +13,6 @@ from scipy import *
 
 import misopy
 
-from scipy.stats.stats import zscore
-
 import rnaseqlib
 import rnaseqlib.ribo.ribo_utils as ribo_utils
 
@@ -150,18 +148,40 @@ class RiboExpressionTable:
 
         - rna_to_ribo_samples: mapping from RNA sample names
           to ribo sample names
-        Move me later to RiboExpressionTable class.
+
+        The TEs of all sample pairs are computed at once on the
+        matrices of Ribo and RNA values.
         """
-        for rna_sample, ribo_sample in rna_to_ribo_samples.iteritems():
-            te_label = "TE_%s_%s" %(ribo_sample, rna_sample)
-            te = ribo_utils.compute_te(self.table[ribo_sample],
-                                       self.table[rna_sample])
-            # Add TE values to table
-            self.table[te_label] = te
+        sample_pairs = rna_to_ribo_samples.items()
+        if len(sample_pairs) == 0:
+            return self.table
+        rna_samples = [rna_sample for rna_sample, ribo_sample in sample_pairs]
+        ribo_samples = [ribo_sample for rna_sample, ribo_sample in sample_pairs]
+        te = ribo_utils.compute_te(self.table[ribo_samples].values,
+                                   self.table[rna_samples].values)
+        te_labels = ["TE_%s_%s" %(ribo_sample, rna_sample) \
+                     for rna_sample, ribo_sample in sample_pairs]
+        # Add TE values to table
+        self.add_columns(te, te_labels)
         # Normalize TE
         self.add_normalized_te()
         return self.table
 
+
+    def add_columns(self, values, labels):
+        """
+        Add the columns of a matrix of values to the table in
+        one step, replacing existing columns of the same labels.
+        """
+        kept_cols = [col for col in self.table.columns \
+                     if col not in labels]
+        new_table = pandas.DataFrame(values,
+                                     index=self.table.index,
+                                     columns=labels)
+        self.table = pandas.concat([self.table[kept_cols], new_table],
+                                   axis=1)
+        return self.table
+
             
     def add_normalized_te(self, normed_prefix="norm"):
         """
@@ -171,14 +191,18 @@ class RiboExpressionTable:
         beginning with 'normed_prefix'.
 
         Normed TEs are first logged (base 2) and then z-score
-        normalized.
+        normalized, all TE columns at once. TEs that are NA or 0
+        are left out of the normalization and have NA normed TEs.
         """
         print "Normalizing TE..."
         te_cols = [c for c in self.table.columns \
                    if c.startswith("TE_")]
-        for col in te_cols:
-            normed_col = "%s_%s" %(normed_prefix, col)
-            self.table[normed_col] = zscore(self.table[col].apply(log2).dropna())
+        if len(te_cols) == 0:
+            return self.table
+        normed_te = ribo_utils.normalize_te(self.table[te_cols].values)
+        normed_cols = ["%s_%s" %(normed_prefix, col) for col in te_cols]
+        self.add_columns(normed_te, normed_cols)
+        return self.table
             
 
     def filter_table(self, table,
@@ -9,6 +9,8 @@ from collections import defaultdict
 
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.mapping.bam_utils as bam_utils
+import rnaseqlib.clip.clip_utils as clip_utils
 
 import misopy
 import misopy.exon_utils as exon_utils
@@ -43,12 +45,9 @@ def load_sample_rpkms(sample,
             # Add gene_symbol and gene_desc columns
             # to RPKM DataFrame
             gene_table = rna_base.gene_tables[table_name.split(".")[0]]
-            gene_symbols = [gene_table.genes_to_names[gid] \
-                            for gid in rpkm_table["gene_id"]]
-            gene_descs = [gene_table.genes_to_desc[gid] \
-                          for gid in rpkm_table["gene_id"]]
-            rpkm_table["gene_symbol"] = gene_symbols
-            rpkm_table["gene_desc"] = gene_descs
+            gene_ids = rpkm_table["gene_id"].values
+            rpkm_table["gene_symbol"] = gene_table.get_genes_names(gene_ids)
+            rpkm_table["gene_desc"] = gene_table.get_genes_descs(gene_ids)
         else:
             print "WARNING: Cannot find RPKM filename %s" %(rpkm_filename)
         rpkm_tables[table_name] = rpkm_table
@@ -104,16 +103,59 @@ def output_rpkm(sample,
         print "Sample %s has %s mapped reads" %(sample.label, num_mapped)
         read_len = settings_info["readlen"]
         logger.info("Outputting RPKM from GFF aligned BAM (table %s)" %(table_name))
+        num_processors = settings_info["mapping"]["num_processors"]
         output_rpkm_from_gff_aligned_bam(exons_bam_fname,
                                          num_mapped,
                                          read_len,
                                          const_exons,
-                                         rpkm_output_filename)
+                                         rpkm_output_filename,
+                                         num_processors=num_processors)
     logger.info("Finished outputting RPKM for %s to %s" %(sample.label,
                                                           rpkm_output_filename))
     return rpkm_output_filename
     
     
+def count_gff_aligned_regions(bam_reads, region_to_count):
+    """
+    Count the reads aligned to each gff region, given reads
+    tagged by bedtools (with 'gff' field.)
+
+    Adds the counts to 'region_to_count', a mapping from
+    region strings to counts, and returns it. Collapsed reads
+    are counted as the number of reads they stand for.
+    """
+    for bam_read in bam_reads:
+        # Read aligns to region of interest
+        gff_aligned_regions = bam_read.opt("YB")
+        parsed_regions = gff_aligned_regions.split("gff:")[1:]
+        # Compile region counts and lengths
+        for region in parsed_regions:
+            region_chrom, coord_field = region.split(",")[0].split(":")[0:2]
+            # Region internally converted to 0-based start, so we must add 1
+            # to get it back
+            region_start, region_end = map(int, coord_field.split("-"))
+            region_start += 1
+            region_str = "%s:%s-%s" %(region_chrom,
+                                      str(region_start),
+                                      str(region_end))
+            # Count reads in region
+            region_to_count[region_str] += clip_utils.get_read_weight(bam_read)
+    return region_to_count
+
+
+def gff_regions_kernel(bam_filename, shard):
+    """
+    Counting kernel: return the number of reads aligned to
+    each gff region in the shard.
+    """
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    region_to_count = \
+        count_gff_aligned_regions(bam_utils.iter_shard_reads(bam_file, shard),
+                                  {})
+    bam_file.close()
+    return region_to_count
+    
+
 def output_rpkm_from_gff_aligned_bam(bam_filename,
                                      num_mapped,
                                      read_len,
@@ -123,7 +165,8 @@ def output_rpkm_from_gff_aligned_bam(bam_filename,
                                                   "rpkm",
                                                   "counts",
                                                   "exons"],
-                                     na_val="NA"):
+                                     na_val="NA",
+                                     num_processors=1):
     """
     Given a BAM file aligned by bedtools (with 'gff' field),
     compute RPKM for each region, incorporating relevant
@@ -136,29 +179,30 @@ def output_rpkm_from_gff_aligned_bam(bam_filename,
      - read_len: read length
      - const_exons: Constitutive exons object
      - output_filename: output filename
+     - num_processors: number of processors to count reads
+       with. The BAM file is indexed if needed.
     """
-    bam_file = pysam.Samfile(bam_filename, "rb")
     print "Computing RPKM from BAM aligned to GFF..."
     print "  - BAM: %s" %(bam_filename)
     print "  - Output filename: %s" %(output_filename)
     # Map of gff region to read counts
     region_to_count = defaultdict(int)
-    for bam_read in bam_file:
-        # Read aligns to region of interest
-        gff_aligned_regions = bam_read.opt("YB")
-        parsed_regions = gff_aligned_regions.split("gff:")[1:]
-        # Compile region counts and lengths
-        for region in parsed_regions:
-            region_chrom, coord_field = region.split(",")[0].split(":")[0:2]
-            # Region internally converted to 0-based start, so we must add 1
-            # to get it back
-            region_start, region_end = map(int, coord_field.split("-"))
-            region_start += 1
-            region_str = "%s:%s-%s" %(region_chrom,
-                                      str(region_start),
-                                      str(region_end))
-            # Count reads in region
-            region_to_count[region_str] += 1
+    if num_processors > 1:
+        # The GFF aligned BAM keeps the order of the sorted
+        # BAM it was made from, so it can be indexed and
+        # counted by chromosome
+        if not bam_utils.is_bam_indexed(bam_filename):
+            pysam.index(bam_filename)
+        shard_counts = \
+            bam_utils.map_reduce_bam(bam_filename,
+                                     gff_regions_kernel,
+                                     num_processors=num_processors)
+        if shard_counts is not None:
+            region_to_count.update(shard_counts)
+    else:
+        bam_file = pysam.Samfile(bam_filename, "rb")
+        count_gff_aligned_regions(bam_file, region_to_count)
+        bam_file.close()
     # For each gene, find its exons. Sum their counts
     # and length to compute RPKM
     rpkm_table = []
@@ -0,0 +1,282 @@
+##
+## Removal of rRNA reads before mapping
+##
+## Reads are matched against the k-mers of the rRNA sequences
+## (e.g. chrRibo, see init/download_seqs.py). K-mers are 2-bit
+## encoded into uint64 values (so k <= 32) and made canonical,
+## i.e. the smaller of a k-mer and its reverse complement, so
+## that reads from either strand match. The rRNA k-mers are kept
+## as a sorted array and looked up with a binary search.
+##
+import os
+import sys
+import time
+import itertools
+import multiprocessing
+
+import numpy
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.fasta_utils as fasta_utils
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.clip.clip_utils as clip_utils
+
+# Summary statistics of rRNA filtering
+RRNA_STATS_HEADER = ["num_reads",
+                     "num_rrna",
+                     "percent_rrna"]
+
+# 2-bit codes of bases, with 4 for non-ACGT bases
+BASE_CODES = numpy.empty(256, dtype=numpy.uint8)
+BASE_CODES.fill(4)
+for _code, _bases in enumerate(["Aa", "Cc", "Gg", "Tt"]):
+    for _base in _bases:
+        BASE_CODES[ord(_base)] = _code
+
+
+def get_kmers(seq_codes, k):
+    """
+    Return the canonical k-mers starting at each position of
+    a sequence of base codes, and whether each k-mer is valid
+    (has no non-ACGT bases.)
+
+    There are len(seq_codes) - k + 1 k-mers.
+    """
+    num_kmers = len(seq_codes) - k + 1
+    if num_kmers <= 0:
+        return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=bool)
+    codes = numpy.minimum(seq_codes, 3).astype(numpy.uint64)
+    rc_codes = numpy.uint64(3) - codes
+    kmers = numpy.zeros(num_kmers, dtype=numpy.uint64)
+    rc_kmers = numpy.zeros(num_kmers, dtype=numpy.uint64)
+    for j in xrange(k):
+        kmers = (kmers << numpy.uint64(2)) | codes[j:j + num_kmers]
+        # The reverse complement reads the k-mer backwards
+        rc_kmers |= rc_codes[j:j + num_kmers] << numpy.uint64(2 * j)
+    # A k-mer is valid if it has no non-ACGT bases
+    num_invalid = numpy.concatenate([[0], numpy.cumsum(seq_codes > 3)])
+    valid = (num_invalid[k:] - num_invalid[0:num_kmers]) == 0
+    return numpy.minimum(kmers, rc_kmers), valid
+
+
+def build_rrna_kmers(fasta_filenames, k=25):
+    """
+    Return the sorted, unique canonical k-mers of the
+    sequences of FASTA files.
+    """
+    if k > 32:
+        raise Exception, "Cannot encode k-mers longer than 32."
+    all_kmers = []
+    for fasta_filename in fasta_filenames:
+        fasta_file = open(fasta_filename, "r")
+        for header, seq in fasta_utils.read_fasta(fasta_file):
+            seq_codes = BASE_CODES[numpy.frombuffer(seq, dtype=numpy.uint8)]
+            kmers, valid = get_kmers(seq_codes, k)
+            all_kmers.append(kmers[valid])
+        fasta_file.close()
+    if len(all_kmers) == 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    return numpy.unique(numpy.concatenate(all_kmers))
+
+
+def get_rrna_kmers(rrna_fasta_filename, k=25):
+    """
+    Return the k-mers of an rRNA FASTA file, from a cache next
+    to it ('<fasta>.k<k>.kmers.npy') if it is up to date.
+    """
+    kmers_filename = "%s.k%d.kmers.npy" %(rrna_fasta_filename, k)
+    if os.path.isfile(kmers_filename) and \
+       (os.path.getmtime(kmers_filename) >= \
+        os.path.getmtime(rrna_fasta_filename)):
+        return numpy.load(kmers_filename)
+    print "Building rRNA %d-mers from: %s" %(k, rrna_fasta_filename)
+    rrna_kmers = build_rrna_kmers([rrna_fasta_filename], k=k)
+    try:
+        with utils.atomic_write(kmers_filename, mode="wb") as kmers_file:
+            numpy.save(kmers_file, rrna_kmers)
+    except (IOError, OSError):
+        print "WARNING: Cannot save rRNA k-mers %s" %(kmers_filename)
+    return rrna_kmers
+
+
+def count_rrna_kmers(seqs, rrna_kmers, k):
+    """
+    Return the number of k-mers of each read that are
+    rRNA k-mers.
+
+    The reads are concatenated and the k-mers at every position
+    computed at once. K-mers that span two reads are discarded.
+    """
+    num_hits = numpy.zeros(len(seqs), dtype=numpy.int64)
+    if (len(seqs) == 0) or (len(rrna_kmers) == 0):
+        return num_hits
+    seq_lens = numpy.array([len(seq) for seq in seqs], dtype=numpy.int64)
+    seq_codes = BASE_CODES[numpy.frombuffer("".join(seqs), dtype=numpy.uint8)]
+    kmers, valid = get_kmers(seq_codes, k)
+    if len(kmers) == 0:
+        return num_hits
+    # Read of each k-mer, and whether the k-mer fits in its read
+    read_nums = numpy.repeat(numpy.arange(len(seqs)), seq_lens)[0:len(kmers)]
+    read_starts = numpy.concatenate([[0], numpy.cumsum(seq_lens)[0:-1]])
+    kmer_ends = numpy.arange(len(kmers)) + k
+    valid &= (kmer_ends <= (read_starts + seq_lens)[read_nums])
+    kmers = kmers[valid]
+    inds = numpy.searchsorted(rrna_kmers, kmers)
+    inds[inds == len(rrna_kmers)] = 0
+    is_hit = (rrna_kmers[inds] == kmers)
+    num_hits += numpy.bincount(read_nums[valid][is_hit], minlength=len(seqs))
+    return num_hits
+
+
+def _filter_rrna_batch(filter_task):
+    """
+    Filter the rRNA reads out of a batch of reads, or of lockstep
+    batches of mates (a pair is rRNA if either mate is.) Used by
+    the process pool.
+
+    Returns the kept reads of each file as gzip members, and the
+    number of reads and of rRNA reads. Collapsed reads count as
+    the number of reads they stand for.
+    """
+    batches, rrna_kmers, k, min_kmer_hits, compress_level = filter_task
+    is_rrna = numpy.zeros(len(batches[0][0]), dtype=bool)
+    for batch in batches:
+        is_rrna |= (count_rrna_kmers(batch[1], rrna_kmers, k) >= min_kmer_hits)
+    kept = numpy.flatnonzero(~is_rrna)
+    kept_data = []
+    for batch in batches:
+        kept_batch = [[field[n] for n in kept] for field in batch]
+        kept_data.append(\
+            fastq_utils.compress_gzip_member(\
+                fastq_utils.format_fastq_batch(*kept_batch),
+                compress_level=compress_level))
+    weights = numpy.array([clip_utils.get_collapsed_count(header) \
+                           for header in batches[0][0]], dtype=numpy.int64)
+    return kept_data, int(weights.sum()), int(weights[is_rrna].sum())
+
+
+def get_rrna_stats_filename(fastq_filename, output_dir):
+    """
+    Return the filename of the rRNA filtering stats of a
+    FASTQ file (the first mate's file for paired-end reads.)
+    """
+    return os.path.join(output_dir,
+                        "%s.rrna_stats.txt" \
+                        %(fastq_utils.get_fastq_basename(fastq_filename)))
+
+
+def load_rrna_stats(stats_filename):
+    """
+    Load rRNA filtering stats.
+    """
+    stats_file = open(stats_filename, "r")
+    fields = stats_file.readline().strip().split("\t")
+    values = stats_file.readline().strip().split("\t")
+    stats_file.close()
+    rrna_stats = dict(zip(fields, values))
+    rrna_stats["num_reads"] = int(rrna_stats["num_reads"])
+    rrna_stats["num_rrna"] = int(rrna_stats["num_rrna"])
+    rrna_stats["percent_rrna"] = float(rrna_stats["percent_rrna"])
+    return rrna_stats
+
+
+def filter_rrna_reads(fastq_filenames, output_dir, rrna_kmers,
+                      k=25,
+                      min_kmer_hits=2,
+                      num_processors=1,
+                      batch_size=100000,
+                      compress_level=6):
+    """
+    Remove the reads that share k-mers with rRNA.
+
+    - fastq_filenames: list of one FASTQ file, or of the two
+      mate files of a paired-end library
+    - rrna_kmers: sorted rRNA k-mers (see get_rrna_kmers)
+    - min_kmer_hits: number of rRNA k-mers a read needs to
+      have to be removed
+
+    Reads are classified in batches of 'batch_size' records,
+    spread over 'num_processors' processes. The kept reads are
+    written to '<basename>.no_rrna.fastq.gz' in 'output_dir', and
+    the fraction of rRNA reads to a stats file (see
+    get_rrna_stats_filename.) Returns the list of output files.
+    """
+    utils.make_dir(output_dir)
+    output_filenames = \
+        [os.path.join(output_dir,
+                      "%s.no_rrna.fastq.gz" \
+                      %(fastq_utils.get_fastq_basename(fastq_filename))) \
+         for fastq_filename in fastq_filenames]
+    stats_filename = get_rrna_stats_filename(fastq_filenames[0], output_dir)
+    if all([os.path.isfile(output_filename) \
+            for output_filename in output_filenames + [stats_filename]]):
+        print "SKIPPING: %s already exist!" %(", ".join(output_filenames))
+        return output_filenames
+    print "Removing rRNA reads from: %s" %(", ".join(fastq_filenames))
+    t1 = time.time()
+    input_files = [fastq_utils.read_open_fastq(fastq_filename) \
+                   for fastq_filename in fastq_filenames]
+    if len(input_files) == 1:
+        batches = ((batch,) for batch in \
+                   fastq_utils.read_fastq_batches(input_files[0],
+                                                  batch_size=batch_size))
+    else:
+        batches = fastq_utils.read_paired_fastq_batches(input_files,
+                                                        batch_size=batch_size)
+    filter_tasks = ((mate_batches, rrna_kmers, k, min_kmer_hits,
+                     compress_level) for mate_batches in batches)
+    tmp_filenames = [utils.get_tmp_filename(output_filename) \
+                     for output_filename in output_filenames]
+    out_files = [open(tmp_filename, "wb") for tmp_filename in tmp_filenames]
+    pool = None
+    if num_processors > 1:
+        pool = multiprocessing.Pool(processes=num_processors)
+    num_reads = 0
+    num_rrna = 0
+    try:
+        while True:
+            # Only hand out a few batches per process at a
+            # time, to bound the number of reads in memory
+            window_tasks = list(itertools.islice(filter_tasks,
+                                                 2 * num_processors))
+            if len(window_tasks) == 0:
+                break
+            if pool is None:
+                results = map(_filter_rrna_batch, window_tasks)
+            else:
+                results = pool.map(_filter_rrna_batch, window_tasks)
+            for kept_data, batch_num_reads, batch_num_rrna in results:
+                for out_file, data in zip(out_files, kept_data):
+                    out_file.write(data)
+                num_reads += batch_num_reads
+                num_rrna += batch_num_rrna
+    except:
+        for out_file, tmp_filename in zip(out_files, tmp_filenames):
+            out_file.close()
+            os.remove(tmp_filename)
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for input_file in input_files:
+            input_file.close()
+    for out_file in out_files:
+        out_file.close()
+    # Write the stats before putting the outputs in place, so
+    # that complete outputs always come with their stats
+    percent_rrna = 0
+    if num_reads > 0:
+        percent_rrna = num_rrna / float(num_reads)
+    with utils.atomic_write(stats_filename) as stats_file:
+        stats_file.write("%s\n" %("\t".join(RRNA_STATS_HEADER)))
+        stats_file.write("%d\t%d\t%s\n" %(num_reads, num_rrna,
+                                          str(percent_rrna)))
+    for tmp_filename, output_filename in zip(tmp_filenames,
+                                             output_filenames):
+        os.rename(tmp_filename, output_filename)
+    t2 = time.time()
+    print "Removed %d of %d reads as rRNA (%.2f%%) in %.2f secs" \
+        %(num_rrna, num_reads, 100 * percent_rrna, (t2 - t1))
+    return output_filenames
@@ -11,17 +11,22 @@ def load_settings(config_filename,
                   INT_PARAMS=["readlen",
                               "overhanglen",
                               "num_processors",
-                              "paired_end_frag"],
+                              "paired_end_frag",
+                              "umi_len"],
                   # Boolean parameters
                   BOOL_PARAMS=["paired",
-                               "prefilter_miso"],
+                               "prefilter_miso",
+                               "collapse_reads",
+                               "umi_in_header",
+                               "prefilter_rrna"],
                   # Parameters to be interpreted as Python lists or
                   # data structures,
                   STR_PARAMS=["indir",
                               "outdir",
                               "stranded",
                               "mapper"],
-                  DATA_PARAMS=["sequence_files", 
+                  DATA_PARAMS=["sequence_files",
+                               "fastq_files",
                                "sample_groups"]):
     config = ConfigParser.ConfigParser()
     print "Loading settings from: %s" %(config_filename)
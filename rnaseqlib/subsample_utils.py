@@ -0,0 +1,326 @@
+##
+## Deterministic subsampling of reads
+##
+## Reads are kept by a hash of their name (without mate suffixes
+## such as /1 and /2), so that the two mates of a pair, the reads
+## of a FASTQ file and their alignments, and repeated runs on the
+## same file all keep the same reads.
+##
+## A fraction of the reads is kept by keeping the reads whose hash
+## falls below the fraction of the hash range. A fixed number of
+## reads is kept by keeping the reads with the smallest hashes.
+##
+import os
+import sys
+import time
+import zlib
+from itertools import izip
+
+import numpy
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.fastq_utils as fastq_utils
+
+# Read hashes are 32-bit
+HASH_RANGE = 2 ** 32
+
+
+def get_read_key(name):
+    """
+    Return the name a read is hashed by: its name without a
+    leading '@', a trailing mate suffix or a comment.
+    """
+    if name.startswith("@"):
+        name = name[1:]
+    return fastq_utils.get_mate_name(name)
+
+
+def get_read_hashes(names, seed=0):
+    """
+    Return the hashes of read names (or FASTQ headers.)
+
+    Names are hashed with CRC32, whose output is then mixed
+    (by the MurmurHash3 finalizer) so that similar names, like
+    consecutive read numbers, get unrelated hashes.
+    """
+    hashes = numpy.array([zlib.crc32(get_read_key(name), seed) & 0xffffffff \
+                          for name in names], dtype=numpy.uint64)
+    mask = numpy.uint64(0xffffffff)
+    hashes ^= (hashes >> numpy.uint64(16))
+    hashes = (hashes * numpy.uint64(0x85ebca6b)) & mask
+    hashes ^= (hashes >> numpy.uint64(13))
+    hashes = (hashes * numpy.uint64(0xc2b2ae35)) & mask
+    hashes ^= (hashes >> numpy.uint64(16))
+    return hashes
+
+
+def get_hash_threshold(fraction):
+    """
+    Return the hash below which reads are kept to keep
+    'fraction' of the reads.
+    """
+    if not (0 <= fraction <= 1):
+        raise Exception, "Subsampling fraction must be between 0 and 1."
+    return int(fraction * HASH_RANGE)
+
+
+def check_subsample_args(fraction, num_reads):
+    if (fraction is None) == (num_reads is None):
+        raise Exception, "Need either a fraction or a number of reads " \
+                         "to subsample."
+
+
+def get_subsample_label(fraction, num_reads, seed):
+    """
+    Return a label recording the subsampling parameters, e.g.
+    'frac0.1.seed0' or 'num10000.seed0', so that subsamples
+    made with other parameters are not reused.
+    """
+    if fraction is not None:
+        label = "frac%r" %(float(fraction))
+    else:
+        label = "num%d" %(num_reads)
+    return "%s.seed%d" %(label, seed)
+
+
+def iter_fastq_mate_batches(fastq_files, batch_size=100000):
+    """
+    Yield batches of the records of one FASTQ file, or lockstep
+    batches of the two mate files of a paired-end library, as
+    a tuple with a batch per file.
+    """
+    if len(fastq_files) == 1:
+        for batch in fastq_utils.read_fastq_batches(fastq_files[0],
+                                                    batch_size=batch_size):
+            yield (batch,)
+    elif len(fastq_files) == 2:
+        for batches in fastq_utils.read_paired_fastq_batches(fastq_files,
+                                                             batch_size=batch_size):
+            yield batches
+    else:
+        raise Exception, "Can only subsample one FASTQ file or a pair " \
+                         "of mate files."
+
+
+def select_batch_records(batches, inds):
+    """
+    Return records 'inds' of the batches of each file.
+    """
+    selected = []
+    for batch in batches:
+        selected.append(tuple([[field[n] for n in inds] for field in batch]))
+    return tuple(selected)
+
+
+def subsample_fastq(fastq_filenames, output_dir,
+                    fraction=None,
+                    num_reads=None,
+                    seed=0,
+                    batch_size=100000,
+                    compress_level=6):
+    """
+    Subsample the reads of a FASTQ file, or of the two mate files
+    of a paired-end library, in one streaming pass.
+
+    - fastq_filenames: list of one FASTQ file, or of two mate files
+    - fraction: fraction of reads (or pairs) to keep
+    - num_reads: number of reads (or pairs) to keep instead of a
+      fraction. The kept records are held in memory until the end
+      of the pass.
+    - seed: seed of the read hashes. Different seeds give
+      independent subsamples.
+
+    Records are written in their original order to
+    '<basename>.subsample.<label>.fastq.gz' in 'output_dir',
+    where the label records the parameters (see
+    get_subsample_label). Returns the list of output files.
+    """
+    check_subsample_args(fraction, num_reads)
+    utils.make_dir(output_dir)
+    subsample_label = get_subsample_label(fraction, num_reads, seed)
+    output_filenames = \
+        [os.path.join(output_dir,
+                      "%s.subsample.%s.fastq.gz" \
+                      %(fastq_utils.get_fastq_basename(fastq_filename),
+                        subsample_label)) \
+         for fastq_filename in fastq_filenames]
+    if all([os.path.isfile(output_filename) \
+            for output_filename in output_filenames]):
+        print "SKIPPING: %s already exist!" %(", ".join(output_filenames))
+        return output_filenames
+    print "Subsampling reads from: %s" %(", ".join(fastq_filenames))
+    t1 = time.time()
+    input_files = [fastq_utils.read_open_fastq(fastq_filename) \
+                   for fastq_filename in fastq_filenames]
+    tmp_filenames = [utils.get_tmp_filename(output_filename) \
+                     for output_filename in output_filenames]
+    out_files = [open(tmp_filename, "wb") for tmp_filename in tmp_filenames]
+    num_seen = 0
+    num_kept = 0
+    # With a number of reads to keep: the records with the smallest
+    # hashes so far, as (hashes, record numbers, records of each file)
+    kept_hashes = numpy.zeros(0, dtype=numpy.uint64)
+    kept_nums = numpy.zeros(0, dtype=numpy.int64)
+    kept_records = [[] for fastq_filename in fastq_filenames]
+    try:
+        for batches in iter_fastq_mate_batches(input_files,
+                                               batch_size=batch_size):
+            hashes = get_read_hashes(batches[0][0], seed=seed)
+            if fraction is not None:
+                inds = numpy.flatnonzero(hashes < get_hash_threshold(fraction))
+                for out_file, batch in izip(out_files,
+                                            select_batch_records(batches, inds)):
+                    out_file.write(\
+                        fastq_utils.compress_gzip_member(\
+                            fastq_utils.format_fastq_batch(*batch),
+                            compress_level=compress_level))
+                num_kept += len(inds)
+            else:
+                # Only records below the current cut can be kept
+                inds = numpy.arange(len(hashes))
+                if len(kept_hashes) >= num_reads:
+                    inds = numpy.flatnonzero(hashes < kept_hashes.max())
+                kept_hashes = numpy.append(kept_hashes, hashes[inds])
+                kept_nums = numpy.append(kept_nums, num_seen + inds)
+                for records, batch in izip(kept_records,
+                                           select_batch_records(batches, inds)):
+                    records.extend(izip(*batch))
+                # Cut back to the smallest hashes once twice as many
+                # records as needed are held
+                if len(kept_hashes) > 2 * num_reads:
+                    kept_hashes, kept_nums, kept_records = \
+                        cut_kept_records(kept_hashes, kept_nums, kept_records,
+                                         num_reads)
+            num_seen += len(hashes)
+        if num_reads is not None:
+            kept_hashes, kept_nums, kept_records = \
+                cut_kept_records(kept_hashes, kept_nums, kept_records,
+                                 num_reads)
+            # Write the kept records in their original order
+            order = numpy.argsort(kept_nums, kind="mergesort")
+            for out_file, records in izip(out_files, kept_records):
+                records = [records[n] for n in order]
+                for chunk_start in xrange(0, len(records), batch_size):
+                    chunk = zip(*records[chunk_start:chunk_start + batch_size])
+                    out_file.write(\
+                        fastq_utils.compress_gzip_member(\
+                            fastq_utils.format_fastq_batch(*chunk),
+                            compress_level=compress_level))
+            num_kept = len(kept_nums)
+    except:
+        for out_file, tmp_filename in izip(out_files, tmp_filenames):
+            out_file.close()
+            os.remove(tmp_filename)
+        raise
+    finally:
+        for input_file in input_files:
+            input_file.close()
+    for out_file, tmp_filename, output_filename in izip(out_files,
+                                                        tmp_filenames,
+                                                        output_filenames):
+        out_file.close()
+        os.rename(tmp_filename, output_filename)
+    t2 = time.time()
+    print "Kept %d of %d reads in %.2f secs" %(num_kept, num_seen, (t2 - t1))
+    return output_filenames
+
+
+def cut_kept_records(kept_hashes, kept_nums, kept_records, num_reads):
+    """
+    Keep only the 'num_reads' records with the smallest hashes
+    (ties broken by record number.)
+    """
+    if len(kept_hashes) <= num_reads:
+        return kept_hashes, kept_nums, kept_records
+    inds = numpy.lexsort([kept_nums, kept_hashes])[0:num_reads]
+    return kept_hashes[inds], kept_nums[inds], \
+           [[records[n] for n in inds] for records in kept_records]
+
+
+def subsample_bam(bam_filename, output_filename,
+                  fraction=None,
+                  num_reads=None,
+                  seed=0,
+                  batch_size=100000):
+    """
+    Subsample the alignments of a BAM file in one streaming pass,
+    keeping all the alignments (and mates) of the kept reads.
+
+    - fraction: fraction of reads to keep
+    - num_reads: approximate number of alignments to keep instead
+      of a fraction. It is turned into a fraction using the number
+      of alignments in the BAM index, so the BAM must be indexed.
+    - seed: seed of the read hashes. With the same seed, the reads
+      kept are the ones kept from the FASTQ files (see
+      subsample_fastq) when a fraction is given.
+
+    The parameters are recorded in '<output_filename>.params'; an
+    existing output is only reused if it was made with the same
+    parameters.
+    """
+    check_subsample_args(fraction, num_reads)
+    subsample_label = get_subsample_label(fraction, num_reads, seed)
+    params_filename = "%s.params" %(output_filename)
+    if os.path.isfile(output_filename) and os.path.isfile(params_filename):
+        with open(params_filename) as params_file:
+            if params_file.read().strip() == subsample_label:
+                print "SKIPPING: %s already exists!" %(output_filename)
+                return output_filename
+        print "Subsample %s was made with other parameters, " \
+              "remaking it." %(output_filename)
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    if num_reads is not None:
+        if not os.path.isfile("%s.bai" %(bam_filename)):
+            bam_file.close()
+            raise Exception, "Cannot subsample %d reads from %s since " \
+                             "it is not indexed." %(num_reads, bam_filename)
+        num_alignments = bam_file.mapped + bam_file.unmapped
+        fraction = min(1., num_reads / float(max(num_alignments, 1)))
+    threshold = get_hash_threshold(fraction)
+    print "Subsampling %.4f of reads from: %s" %(fraction, bam_filename)
+    t1 = time.time()
+    tmp_filename = utils.get_tmp_filename(output_filename)
+    out_bam = pysam.Samfile(tmp_filename, "wb", template=bam_file)
+    num_seen = 0
+    num_kept = 0
+    try:
+        reads = []
+        for read in bam_file.fetch(until_eof=True):
+            reads.append(read)
+            if len(reads) == batch_size:
+                num_kept += write_kept_reads(out_bam, reads, threshold, seed)
+                num_seen += len(reads)
+                reads = []
+        num_kept += write_kept_reads(out_bam, reads, threshold, seed)
+        num_seen += len(reads)
+    except:
+        out_bam.close()
+        os.remove(tmp_filename)
+        raise
+    finally:
+        bam_file.close()
+    out_bam.close()
+    os.rename(tmp_filename, output_filename)
+    with utils.atomic_write(params_filename) as params_file:
+        params_file.write("%s\n" %(subsample_label))
+    t2 = time.time()
+    print "Kept %d of %d alignments in %.2f secs" %(num_kept, num_seen,
+                                                    (t2 - t1))
+    return output_filename
+
+
+def write_kept_reads(out_bam, reads, threshold, seed):
+    """
+    Write the reads of a batch whose hash falls below the
+    threshold. Returns the number of reads written.
+    """
+    if len(reads) == 0:
+        return 0
+    hashes = get_read_hashes([read.qname for read in reads], seed=seed)
+    kept = numpy.flatnonzero(hashes < threshold)
+    for n in kept:
+        out_bam.write(reads[n])
+    return len(kept)
@@ -8,6 +8,7 @@ import os
 import sys
 import time
 import csv
+import subprocess
 
 import itertools
 import operator
@@ -16,9 +17,12 @@ import pandas
 
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.bgzf_utils as bgzf_utils
 import rnaseqlib.init as init
 import rnaseqlib.genes.exons as exons
 import rnaseqlib.genes.GeneModel as GeneModel
+import rnaseqlib.genes.TranscriptStore as TranscriptStore
+import rnaseqlib.genes.GeneXref as GeneXref
 
 from rnaseqlib.paths import *
 from rnaseqlib.init.genome_urls import *
@@ -34,6 +38,55 @@ import numpy
 from numpy import *
 
 
+# UCSC gene tables converted to GFF3
+GFF3_TABLES = ["knownGene.txt",
+               "ensGene.txt",
+               "refGene.txt"]
+
+# Gene tables parsed by process_ucsc_tables, shared with
+# the processes of its task graph (which inherit them
+# when forked)
+shared_gene_tables = {}
+
+# Columns of ensGene.txt kept in memory by GeneTable
+ENSGENE_TABLE_COLS = ["name",
+                      "chrom",
+                      "strand",
+                      "txStart",
+                      "txEnd",
+                      "cdsStart",
+                      "cdsEnd",
+                      "name2"]
+
+# Gene tables (by GeneTable source) and their table files
+GENE_TABLE_FILES = {"ensGene": "ensGene.txt",
+                    "knownGene": "knownGene.txt",
+                    "refSeq": "refGene.txt"}
+
+# Gene tables processed by process_ucsc_tables
+GENE_TABLE_NAMES = ["ensGene",
+                    "knownGene",
+                    "refSeq"]
+
+# Columns of knownGene.txt kept in memory by GeneTable
+KNOWNGENE_TABLE_COLS = ["name",
+                        "chrom",
+                        "strand",
+                        "txStart",
+                        "txEnd",
+                        "cdsStart",
+                        "cdsEnd"]
+
+# Columns of kgXref.txt added to the gene tables
+KGXREF_TABLE_COLS = ["kgID",
+                     "mRNA",
+                     "spID",
+                     "spDisplayID",
+                     "geneSymbol",
+                     "refseq",
+                     "protAcc",
+                     "description"]
+
 # Labels of UCSC tables to download
 UCSC_TABLE_LABELS = ["knownGene.txt.gz",
                      "kgXref.txt.gz",
@@ -54,7 +107,8 @@ class GeneTable:
     Parse gene table.
     """
     def __init__(self, table_dir, source,
-                 tables_only=False):
+                 tables_only=False,
+                 output_combined=False):
         self.table_dir = table_dir
         self.exons_dir = os.path.join(self.table_dir, "exons")
         self.const_exons_dir = os.path.join(self.exons_dir,
@@ -64,17 +118,27 @@ class GeneTable:
         self.source = source
         self.delimiter = "\t"
         self.table = None
+        # Header of the table
+        self.table_header = None
+        # Columnar store of the table's transcripts
+        self.transcript_store = None
+        # knownGene transcripts to gene (cluster) mapping
+        self.known_isoforms = None
         self.genes = {}
         self.genes_list = []
         self.na_val = "NA"
         # Mapping from transcripts to gene names/symbols
         self.trans_to_names = defaultdict(lambda: self.na_val)
+        # Gene IDs in order of first appearance in the table
+        self.gene_index = pandas.Index([])
         # Mapping from genes to gene names/symbols
-        self.genes_to_names = defaultdict(lambda: self.na_val)
+        self.genes_to_names = pandas.Series([], dtype=object)
         # Mapping from genes to descriptions
-        self.genes_to_desc = defaultdict(lambda: self.na_val)        
-        # Table indexed by gene
+        self.genes_to_desc = pandas.Series([], dtype=object)
+        # Table rows grouped by gene: the rows of gene number g
+        # are table_by_gene[gene_offsets[g]:gene_offsets[g + 1]]
         self.table_by_gene = None
+        self.gene_offsets = None
         # UCSC known to Ensembl
         self.known_to_ensembl = defaultdict(lambda: self.na_val)
         # kgXref table
@@ -82,7 +146,8 @@ class GeneTable:
         # Initialize output directories
         self.init_dirs()
         # Load tables
-        self.load_tables(tables_only=tables_only)
+        self.load_tables(tables_only=tables_only,
+                         output_combined=output_combined)
         
 
     def init_dirs(self):
@@ -126,65 +191,196 @@ class GeneTable:
             sys.exit(1)
         self.kgXref_table = pandas.read_table(kgXref_filename,
                                               sep="\t",
-                                              names=self.kgXref_header)
+                                              names=self.kgXref_header,
+                                              dtype=dict((col, str) \
+                                                         for col in self.kgXref_header))
             
 
-    def load_tables(self, tables_only=False):
+    def load_tables(self, tables_only=False,
+                    output_combined=False):
         """
         Load table.
         """
         # Load kgXref for all tables
         self.load_kgXref_table()
         if self.source == "ensGene":
-            self.load_ensGene_table(tables_only=tables_only)
+            self.load_ensGene_table(tables_only=tables_only,
+                                    output_combined=output_combined)
         elif self.source == "knownGene":
             self.load_knownGene_table(tables_only=tables_only)
         elif self.source == "refSeq":
             self.load_refSeq_table(tables_only=tables_only)
 
         
+    def load_known_isoforms(self):
+        """
+        Load the knownIsoforms table, which groups UCSC
+        transcripts into genes (clusters).
+
+        Returns a Series mapping transcripts to their cluster,
+        or None if the table is not available.
+        """
+        known_isoforms_filename = os.path.join(self.table_dir,
+                                               "knownIsoforms.txt")
+        if not os.path.isfile(known_isoforms_filename):
+            print "WARNING: Cannot find knownIsoforms table %s" \
+                %(known_isoforms_filename)
+            print "  - Every knownGene transcript will be its own gene."
+            return None
+        known_isoforms = pandas.read_table(known_isoforms_filename,
+                                           sep=self.delimiter,
+                                           names=["clusterId",
+                                                  "transcript"],
+                                           dtype=str)
+        known_isoforms = known_isoforms.drop_duplicates(subset=["transcript"])
+        return pandas.Series(known_isoforms["clusterId"].values,
+                             index=known_isoforms["transcript"].values)
+
+
     def load_knownGene_table(self, tables_only=False):
-        raise Exception, "Not implemented."
+        """
+        Load knownGene table. Expects a 'knownGene.txt'
+
+        knownGene.txt format:
+
+          `name` varchar(255) NOT NULL,
+          `chrom` varchar(255) NOT NULL,
+          `strand` char(1) NOT NULL,
+          `txStart` int(10) unsigned NOT NULL,
+          `txEnd` int(10) unsigned NOT NULL,
+          `cdsStart` int(10) unsigned NOT NULL,
+          `cdsEnd` int(10) unsigned NOT NULL,
+          `exonCount` int(10) unsigned NOT NULL,
+          `exonStarts` longblob NOT NULL,
+          `exonEnds` longblob NOT NULL,
+          `proteinID` varchar(40) NOT NULL,
+          `alignID` varchar(255) NOT NULL,
+
+        Transcripts are grouped into genes by their knownIsoforms
+        cluster. Gene symbols and descriptions come from kgXref.
+
+        if tables_only is True, do not parse table into
+        genes but only load tables.
+        """
+        self.table_header = TranscriptStore.KNOWNGENE_FIELDS
+        knownGene_filename = self.get_table_filename()
+        if not os.path.isfile(knownGene_filename):
+            print "Error: Cannot find knownGene table %s" \
+                %(knownGene_filename)
+            sys.exit(1)
+        self.table = pandas.read_table(knownGene_filename,
+                                       sep=self.delimiter,
+                                       names=self.table_header,
+                                       usecols=KNOWNGENE_TABLE_COLS,
+                                       dtype={"name": str,
+                                              "chrom": str,
+                                              "strand": str})
+        trans_ids = self.table["name"].values
+        self.known_isoforms = self.load_known_isoforms()
+        gene_ids = trans_ids.copy()
+        if self.known_isoforms is not None:
+            gene_ids = self.known_isoforms.reindex(trans_ids).values
+            no_gene = pandas.isnull(gene_ids)
+            gene_ids[no_gene] = trans_ids[no_gene]
+        self.table["gene_id"] = gene_ids
+        # Bring information from kgXref
+        self.add_kgXref_info("kgID", trans_ids)
+        self.gene_symbol_field = "geneSymbol"
+        self.table_by_trans = self.table.set_index("name")
+        self.trans_to_genes = self.table_by_trans
+        self.index_table_by_gene(gene_field="gene_id")
+        # Parse table into actual gene objects if asked
+        if not tables_only:
+            self.genes = self.get_genes()
 
 
     def load_refSeq_table(self, tables_only=False):
-        raise Exception, "Not implemented."
+        """
+        Load RefSeq table. Expects a 'refGene.txt', which
+        has the same format as ensGene.txt. Genes are keyed
+        by their symbol (the 'name2' column.)
+
+        Descriptions come from kgXref, by RefSeq ID.
+
+        if tables_only is True, do not parse table into
+        genes but only load tables.
+        """
+        self.table_header = ["bin"] + TranscriptStore.GENEPRED_EXT_FIELDS
+        refGene_filename = self.get_table_filename()
+        if not os.path.isfile(refGene_filename):
+            print "Error: Cannot find refGene table %s" \
+                %(refGene_filename)
+            sys.exit(1)
+        self.table = pandas.read_table(refGene_filename,
+                                       sep=self.delimiter,
+                                       names=self.table_header,
+                                       usecols=ENSGENE_TABLE_COLS,
+                                       dtype={"name": str,
+                                              "chrom": str,
+                                              "strand": str,
+                                              "name2": str})
+        # Bring information from kgXref
+        self.add_kgXref_info("refseq", self.table["name"].values)
+        self.gene_symbol_field = "name2"
+        self.table_by_trans = self.table.set_index("name")
+        self.trans_to_genes = self.table_by_trans
+        self.index_table_by_gene(gene_field="name2")
+        # Parse table into actual gene objects if asked
+        if not tables_only:
+            self.genes = self.get_genes()
+
+
+    def add_kgXref_info(self, key_col, keys):
+        """
+        Add the kgXref columns to the table, taking for
+        each key the first kgXref entry whose 'key_col'
+        matches it.
+        """
+        ## Note: it is critical to remove NA values from kgXref
+        ## to avoid excess memory consumption during merge
+        kgXref_table = self.kgXref_table.dropna(subset=[key_col])
+        kgXref_by_key = \
+            kgXref_table.drop_duplicates(subset=[key_col]).set_index(key_col,
+                                                                     drop=False)
+        kgXref_info = kgXref_by_key.reindex(keys)
+        for col in KGXREF_TABLE_COLS:
+            self.table[col] = kgXref_info[col].values
+
+
+    def get_table_filename(self):
+        """
+        Return the filename of the table.
+        """
+        return os.path.join(self.table_dir,
+                            GENE_TABLE_FILES[self.source])
 
     
+    def get_gene_xref(self):
+        """
+        Return the gene ID cross-reference index of the
+        table's directory.
+        """
+        return GeneXref.get_gene_xref(self.table_dir,
+                                      na_val=self.na_val)
+
+
     def get_ensembl_to_refseq(self):
         """
         Return mapping from Ensembl gene IDs
         to RefSeq.
         """
-        # Load the combined table with kgXref
-        combined_filename = os.path.join(self.table_dir,
-                                         "ensGene.kgXref.combined.txt")
-        if not os.path.isfile(combined_filename):
-            print "Error: cannot get Ensembl to RefSeq ID mapping since " \
-                  "%s does not exist." %(combined_filename)
-            return None
+        gene_xref = self.get_gene_xref()
         # Ensembl -> RefSeq mapping
-        ensembl_to_refseq = defaultdict(list)
+        ensembl_to_refseq = gene_xref.get_map("ensembl_gene",
+                                              "refseq").to_dict()
         # RefSeq -> Ensembl mapping
-        refseq_to_ensembl = defaultdict(list)
-        ensGene_table = csv.DictReader(open(combined_filename),
-                                       delimiter="\t")
-        for entry in ensGene_table:
-            ensembl_id = entry["name2"]
-            refseq_id = entry["refseq"]
-            # If one of the ids is not available, skip the entry
-            if (refseq_id == self.na_val) or (ensembl_id == self.na_val):
-                continue
-            # Add the entry mapping Ensembl -> Refseq and
-            # RefSeq -> Ensembl only if it doesn't already exist
-            if refseq_id not in ensembl_to_refseq[ensembl_id]:
-                ensembl_to_refseq[ensembl_id].append(refseq_id)
-            if ensembl_id not in refseq_to_ensembl[refseq_id]:
-                refseq_to_ensembl[refseq_id].append(ensembl_id)
+        refseq_to_ensembl = gene_xref.get_map("refseq",
+                                              "ensembl_gene").to_dict()
         return ensembl_to_refseq, refseq_to_ensembl
 
             
-    def load_ensGene_table(self, tables_only=False):
+    def load_ensGene_table(self, tables_only=False,
+                           output_combined=False):
         """
         Load ensGene table. Expects an 'ensGene.txt'
 
@@ -209,6 +405,12 @@ class GeneTable:
 
         if tables_only is True, do not parse table into
         genes but only load tables.
+
+        Only the columns needed in memory are loaded; the
+        annotation tables are joined onto it by transcript ID
+        lookups, taking the first match of each transcript.
+        If output_combined is True, also output the combined
+        (fully joined) ensGene tables.
         """
         self.ensGene_header = ["bin",
                                "name",
@@ -226,6 +428,7 @@ class GeneTable:
                                "cdsStartStat",
                                "cdsEndStat",
                                "exonFrames"]
+        self.table_header = self.ensGene_header
         self.knownToEnsembl_header = ["knownGene_name",
                                       "name"]
         ensGene_filename = os.path.join(self.table_dir,
@@ -240,15 +443,21 @@ class GeneTable:
             print "Error: Cannot find knownToEnsembl table %s" \
                 %(known_to_ensembl_filename)
             sys.exit(1)
-        # Load the main ensGene table
+        # Load the main ensGene table. Exons are kept in
+        # the transcript store.
         main_table = pandas.read_table(ensGene_filename,
                                        sep=self.delimiter,
-                                       names=self.ensGene_header)
+                                       names=self.ensGene_header,
+                                       usecols=ENSGENE_TABLE_COLS,
+                                       dtype={"name": str,
+                                              "chrom": str,
+                                              "strand": str,
+                                              "name2": str})
+        # Store the low cardinality columns as categoricals
+        for col in ["chrom", "strand", "name2"]:
+            main_table[col] = main_table[col].astype("category")
         self.table = main_table
-#                                       converters={"exonStarts":
-#                                                   self.parse_string_int_list,
-#                                                   "exonEnds":
-#                                                   self.parse_string_int_list})
+        trans_ids = main_table["name"]
         self.ensemblToGeneName_header = ["name",
                                          "value"]
         ensGene_name_filename = os.path.join(self.table_dir,
@@ -266,72 +475,151 @@ class GeneTable:
         if self.ensGene_to_name_avail:
             ensGene_to_names = pandas.read_table(ensGene_name_filename,
                                                  sep=self.delimiter,
-                                                 names=self.ensemblToGeneName_header)
-            # Merge names into table
-            self.table = pandas.merge(main_table, ensGene_to_names,
-                                      how="left")
+                                                 names=self.ensemblToGeneName_header,
+                                                 dtype=str)
+            # Add names to table
+            self.table["value"] = \
+                lookup_first(ensGene_to_names, "name", "value", trans_ids)
             self.gene_symbol_field = "value"
         known_to_ensembl = pandas.read_table(known_to_ensembl_filename,
                                              sep=self.delimiter,
-                                             names=self.knownToEnsembl_header)
+                                             names=self.knownToEnsembl_header,
+                                             dtype=str)
         # Add mapping from Ensembl to gene names
         self.ensembl_to_known = known_to_ensembl.set_index("name")
-        self.raw_table = self.table
         # Add mapping from Ensembl transcripts to UCSC transcripts
-        self.table = pandas.merge(self.raw_table, known_to_ensembl,
-                                  # try left index
-                                  how="left")
-#                                  how="outer")
-        # Output combined table
-        self.output_ensGene_combined(self.table,
-                                     "ensGene.combined")
+        known_names = lookup_first(known_to_ensembl, "name",
+                                   "knownGene_name", trans_ids)
+        self.table["knownGene_name"] = known_names
         ## Note: it is critical to remove NA values from kgXref
         ## to avoid excess memory consumption during merge (thanks to y-p)
         self.kgXref_table = self.kgXref_table.dropna(subset=["kgID"])
-        # Bring information from kgXref
-        # Note that ensGene table keys are used only in the join,
-        # to avoid introducing into the table entries that have
-        # kgXref info and a UCSC transcript name but *do not*
+        # Bring information from kgXref. Only ensGene table keys
+        # are looked up, to avoid introducing into the table entries
+        # that have kgXref info and a UCSC transcript name but *do not*
         # have an Ensembl transcript ID
-        self.table = pandas.merge(self.table, self.kgXref_table,
-                                  # use ensGene table keys 
-                                  how="left",
-                                  left_index=True,
-                                  left_on=["knownGene_name"],
-                                  right_on=["kgID"])
-        # Output combined table with kgXref
-        self.output_ensGene_combined(self.table,
-                                     "ensGene.kgXref.combined")
+        kgXref_by_known = \
+            self.kgXref_table.drop_duplicates(subset=["kgID"]).set_index("kgID",
+                                                                  drop=False)
+        kgXref_info = kgXref_by_known.reindex(known_names)
+        for col in KGXREF_TABLE_COLS:
+            self.table[col] = kgXref_info[col].values
+        # Output combined tables if asked
+        if output_combined:
+            self.output_ensGene_combined_tables(ensGene_filename,
+                                                ensGene_name_filename,
+                                                known_to_ensembl)
         self.table_by_trans = self.table.set_index("name")
         # Get mapping from transcripts to genes
-        self.trans_to_genes = self.table.set_index("name")
+        self.trans_to_genes = self.table_by_trans
         ##
         ## Index table by gene and load a list of genes
         ## Also compute mapping from gene to symbol
         ## and gene to description
         ##
-        self.table_by_gene = defaultdict(list)
-        seen_genes = {}
-        for idx, series in self.table.iterrows():
-            gene_id = series["name2"]
-            gene_info = series.to_dict()
-            trans = gene_info["name"]
-            self.table_by_gene[gene_id].append(gene_info)
-            if gene_id in seen_genes:
-                continue
-            else:
-                self.genes_list.append(gene_id)
-                seen_genes[gene_id] = True
-                # Record mapping from gene to name via transcript
-                self.genes_to_names[gene_id] = gene_info[self.gene_symbol_field]
-                # Get Ensembl transcript's UCSC name and from that get
-                # the gene description
-                self.genes_to_desc[gene_id] = gene_info["description"]
+        self.index_table_by_gene()
         # Parse table into actual gene objects if asked
         if not tables_only:
             self.genes = self.get_genes()
 
         
+    def index_table_by_gene(self, gene_field="name2"):
+        """
+        Index the table by gene.
+
+        Genes are numbered in order of first appearance and each
+        row is assigned its gene's number, so that the rows can be
+        grouped with one stable sort rather than row by row.
+        """
+        t1 = time.time()
+        # First entry of each gene
+        first_entries = self.table.drop_duplicates(subset=[gene_field])
+        self.genes_list = list(first_entries[gene_field].values)
+        self.gene_index = pandas.Index(self.genes_list)
+        gene_codes = self.gene_index.get_indexer(self.table[gene_field])
+        rows_order = numpy.argsort(gene_codes, kind="mergesort")
+        self.table_by_gene = self.table.iloc[rows_order]
+        self.gene_offsets = \
+            TranscriptStore.get_offsets(numpy.bincount(gene_codes,
+                                                       minlength=len(self.gene_index)))
+        # Record mapping from gene to name via its first transcript
+        self.genes_to_names = \
+            pandas.Series(first_entries[self.gene_symbol_field].values,
+                          index=self.gene_index).fillna(self.na_val)
+        # Get Ensembl transcript's UCSC name and from that get
+        # the gene description
+        self.genes_to_desc = \
+            pandas.Series(first_entries["description"].values,
+                          index=self.gene_index).fillna(self.na_val)
+        t2 = time.time()
+        print "Indexed %d genes in %.2f secs" %(len(self.gene_index),
+                                               (t2 - t1))
+
+
+    def get_gene_entries(self, gene_id):
+        """
+        Return the table rows of a gene as a DataFrame.
+        """
+        gene_num = self.gene_index.get_loc(gene_id)
+        return self.table_by_gene.iloc[self.gene_offsets[gene_num]:\
+                                       self.gene_offsets[gene_num + 1]]
+
+
+    def get_genes_names(self, gene_ids):
+        """
+        Return an array of the names/symbols of a list of genes.
+        Genes without a name get the NA value.
+        """
+        return self.genes_to_names.reindex(gene_ids).fillna(self.na_val).values
+
+
+    def get_genes_descs(self, gene_ids):
+        """
+        Return an array of the descriptions of a list of genes.
+        Genes without a description get the NA value.
+        """
+        return self.genes_to_desc.reindex(gene_ids).fillna(self.na_val).values
+        
+
+    def output_ensGene_combined_tables(self, ensGene_filename,
+                                       ensGene_name_filename,
+                                       known_to_ensembl):
+        """
+        Output the combined ensGene tables: the full ensGene table
+        joined with ensemblToGeneName and knownToEnsembl, and that
+        joined with kgXref.
+
+        Unlike the table kept in memory, these have all the ensGene
+        columns and every match of each join.
+        """
+        combined_filenames = \
+            [os.path.join(self.table_dir, "%s.txt" %(basename)) \
+             for basename in ["ensGene.combined", "ensGene.kgXref.combined"]]
+        if all([os.path.isfile(fname) for fname in combined_filenames]):
+            print "Found combined ensGene tables: skipping..."
+            return
+        table = pandas.read_table(ensGene_filename,
+                                  sep=self.delimiter,
+                                  names=self.ensGene_header)
+        if self.ensGene_to_name_avail:
+            ensGene_to_names = pandas.read_table(ensGene_name_filename,
+                                                 sep=self.delimiter,
+                                                 names=self.ensemblToGeneName_header)
+            table = pandas.merge(table, ensGene_to_names,
+                                 how="left")
+        table = pandas.merge(table, known_to_ensembl,
+                             how="left")
+        self.output_ensGene_combined(table,
+                                     "ensGene.combined")
+        table = pandas.merge(table, self.kgXref_table,
+                             # use ensGene table keys
+                             how="left",
+                             left_on=["knownGene_name"],
+                             right_on=["kgID"])
+        self.output_ensGene_combined(table,
+                                     "ensGene.kgXref.combined")
+            
+
     def output_ensGene_combined(self, table, basename):
         """
         Output combined ensGene table.
@@ -343,10 +631,11 @@ class GeneTable:
         if os.path.isfile(combined_filename):
             print "Found combined file: skipping..."
             return
-        table.to_csv(combined_filename,
-                     sep="\t",
-                     na_rep=self.na_val,
-                     index=False)
+        with utils.atomic_write(combined_filename) as combined_file:
+            table.to_csv(combined_file,
+                         sep="\t",
+                         na_rep=self.na_val,
+                         index=False)
             
 
     def load_introns(self):
@@ -376,8 +665,8 @@ class GeneTable:
         Return a generator.
         """
         genes = None
-        if self.source == "ensGene":
-            genes = self.get_ensGene_by_genes()
+        if self.source in GENE_TABLE_FILES:
+            genes = self.get_genes_view()
         else:
             raise Exception, "Not implemented."
         return genes
@@ -386,63 +675,69 @@ class GeneTable:
     def load_genes_by_id(self):
         genes_by_id = {}
         genes = self.get_genes()
-        for gene in genes:
+        for gene in genes.itervalues():
             genes_by_id[gene.label] = gene
         return genes_by_id
-            
 
-    def get_ensGene_by_genes(self):
-        print "Loading Ensembl table into genes..."
-        # Main ensGene table
-        ensGene_filename = os.path.join(self.table_dir,
-                                        "ensGene.txt")
-        if not os.path.isfile(ensGene_filename):
-            raise Exception, "Cannot find ensGene table %s" \
-                %(ensGene_filename)
+
+    def get_transcript_store(self):
+        """
+        Return the columnar transcript store of the table,
+        parsing the table only if it has no up-to-date serialized
+        store.
+        """
+        if self.transcript_store is not None:
+            return self.transcript_store
+        table_filename = self.get_table_filename()
+        if not os.path.isfile(table_filename):
+            raise Exception, "Cannot find %s table %s" \
+                %(self.source, table_filename)
+        store_args = {}
+        if self.known_isoforms is not None:
+            # knownGene has no gene column: group transcripts
+            # into genes by their knownIsoforms cluster
+            store_args["trans_to_genes"] = self.known_isoforms
+            store_args["dep_filenames"] = \
+                [os.path.join(self.table_dir, "knownIsoforms.txt")]
+        self.transcript_store = \
+            TranscriptStore.get_transcript_store(table_filename,
+                                                 self.table_header,
+                                                 na_val=self.na_val,
+                                                 **store_args)
+        return self.transcript_store
+
+
+    def get_ensGene_store(self):
+        """
+        Return the columnar transcript store of the ensGene table.
+        """
+        return self.get_transcript_store()
+
+
+    def get_genes_view(self):
+        """
+        Return a dictionary-like view of the table's genes,
+        keyed by gene ID. Gene objects are built from the
+        transcript store when accessed.
+        """
+        print "Loading %s table into genes..." %(self.source)
         t1 = time.time()
-        table = dictread_groupby_col(open(ensGene_filename),
-                                     "name2",
-                                     delimiter="\t",
-                                     fieldnames=self.ensGene_header)
-        for gene_id, gene_entries in table.iteritems():
-            gene_symbol = self.na_val
-            all_transcripts = []
-            entries_copy = []
-            for entry in gene_entries:
-                entries_copy.append(entry)
-                chrom = entry["chrom"]
-                strand = entry["strand"]
-                # Convert start coordinates into 1-based coordinates
-                exon_starts = \
-                    (int(start) + 1 \
-                     for start in entry["exonStarts"].rstrip(",").split(","))
-                exon_ends = \
-                    (int(end) \
-                     for end in entry["exonEnds"].rstrip(",").split(","))
-                exon_coords = zip(exon_starts, exon_ends)
-                # Convert cds coordinates into 1-based as well
-                cds_start = int(entry["cdsStart"]) + 1
-                cds_end = int(entry["cdsEnd"])
-                transcript_id = entry["name"]
-                parts = [GeneModel.Part(exon[0], exon[1], chrom, strand,
-                                        parent=transcript_id) \
-                         for exon in exon_coords]
-                transcript = GeneModel.Transcript(parts, chrom, strand,
-                                                  label=transcript_id,
-                                                  cds_start=cds_start,
-                                                  cds_end=cds_end,
-                                                  parent=gene_id)
-                gene_symbol = self.trans_to_names[transcript_id]
-                all_transcripts.append(transcript)
-            gene_model = GeneModel.Gene(all_transcripts, chrom, strand,
-                                        label=gene_id,
-                                        gene_symbol=gene_symbol)
-            self.genes[gene_id] = gene_model
+        store = self.get_transcript_store()
+        self.genes = TranscriptStore.GenesView(store,
+                                               trans_to_names=self.trans_to_names)
         t2 = time.time()
         print "Loading took %.2f secs" %(t2 - t1)
         return self.genes
 
 
+    def get_ensGene_by_genes(self):
+        """
+        Return a dictionary-like view of the ensGene genes,
+        keyed by gene ID.
+        """
+        return self.get_genes_view()
+
+
     def load_ensGene_name_table(self, delimiter="\t"):
         """
         Load mapping from genes to names.
@@ -459,15 +754,65 @@ class GeneTable:
         return self.trans_to_names
 
         
+    def has_output(self, output_filename, indexed=False):
+        """
+        Return True if an annotation output (and its indexed
+        copy, if 'indexed' is True) exists.
+        """
+        if not os.path.isfile(output_filename):
+            return False
+        if indexed and \
+           (not os.path.isfile("%s.gz.tbi" %(output_filename))):
+            return False
+        return True
+
+
+    def output_lines(self, output_filename, lines,
+                     chroms, starts, ends,
+                     preset="bed",
+                     header="",
+                     indexed=False):
+        """
+        Output the lines of an annotation output.
+
+        - lines: the lines of the records (ending in newlines)
+        - chroms, starts, ends: coordinates of the records as
+          0-based, end-exclusive intervals
+        - preset: 'bed' or 'gff' (see bgzf_utils.TABIX_PRESETS)
+        - header: text to write before the records
+        - indexed: if True, also output a copy sorted by
+          coordinate, BGZF compressed and tabix indexed
+          ('output_filename'.gz and 'output_filename'.gz.tbi)
+        """
+        if indexed:
+            bgzf_utils.output_indexed_lines("%s.gz" %(output_filename),
+                                            lines,
+                                            chroms,
+                                            starts,
+                                            ends,
+                                            preset=preset,
+                                            header=header)
+        with utils.atomic_write(output_filename) as out_file:
+            out_file.write(header)
+            utils.write_lines(out_file, lines)
+        return output_filename
+
+
     def output_exons_as_gff(self,
                             base_diff=6,
                             const_only=False,
-                            cds_only=False):
+                            cds_only=False,
+                            num_processors=1,
+                            indexed=False):
         """
         Output constitutive exons for all genes as GFF.
 
         - const_only: if True, output only constitutive exons
         - cds_only: if True, output CDS only exons 
+        - num_processors: number of processes to compute
+          constitutive exons with
+        - indexed: if True, also output a tabix indexed copy
+          of the GFF (see output_lines)
         """
         exons_type = "exons"
         exons_outdir = self.exons_dir
@@ -483,7 +828,7 @@ class GeneTable:
         print "  - Exons type: %s" %(exons_type)
         print "  - Output file: %s" %(gff_output_filename)
         print "  - CDS only: %s" %(cds_only)
-        if os.path.isfile(gff_output_filename):
+        if self.has_output(gff_output_filename, indexed=indexed):
             print "%s exists. Skipping.." %(gff_output_filename)
             return
         # Output a map from genes to constitutive exons
@@ -491,15 +836,27 @@ class GeneTable:
         genes_to_exons_fname = os.path.join(exons_outdir,
                                             exons_basename.replace(".gff",
                                                                    ".to_genes.txt"))
-        gff_out = gff_utils.Writer(open(gff_output_filename, "w"))
         rec_type = "exon"
         genes_to_exons = []
         genes_to_exons_header = ["gene_id", "exons"]
-        for gene_id, gene in self.genes.iteritems():
+        genes = self.genes.itervalues()
+        if const_only:
+            # Compute constitutive exons for all genes up front
+            t1 = time.time()
+            genes = GeneModel.compute_genes_const_exons(genes,
+                                                        base_diff=base_diff,
+                                                        cds_only=cds_only,
+                                                        num_processors=num_processors)
+            t2 = time.time()
+            print "Computed constitutive exons in %.2f secs" %(t2 - t1)
+        # Columns of the GFF records
+        chroms, starts, ends, strands = [], [], [], []
+        gene_ids, exon_ids, parents = [], [], []
+        for gene in genes:
+            gene_id = gene.label
             if const_only:
                 # Get only constitutive exons
-                exons = gene.compute_const_exons(base_diff=base_diff,
-                                                 cds_only=cds_only)
+                exons = gene.const_exons
             elif cds_only:
                 # Get all CDS exons
                 exons = gene.cds_parts
@@ -514,87 +871,121 @@ class GeneTable:
             entry = {"gene_id": gene_id,
                      "exons": exon_labels}
             genes_to_exons.append(entry)
-            # Output constitutive exons to GFF file
-            GeneModel.output_parts_as_gff(gff_out,
-                                          exons,
-                                          gene.chrom,
-                                          gene.strand,
-                                          source=self.source,
-                                          rec_type=rec_type,
-                                          gene_id=gene_id)
+            num_exons = len(exons)
+            chroms.extend([gene.chrom] * num_exons)
+            strands.extend([gene.strand] * num_exons)
+            gene_ids.extend([gene_id] * num_exons)
+            for exon in exons:
+                starts.append(exon.start)
+                ends.append(exon.end)
+                exon_ids.append("%s.%s" %(rec_type, exon.label))
+                parents.append(exon.parent)
         genes_to_exons = pandas.DataFrame(genes_to_exons)
-        genes_to_exons.to_csv(genes_to_exons_fname,
-                              cols=genes_to_exons_header,
-                              index=False,
-                              sep="\t")
-
-
-    def output_exons_as_bed(self):
+        with utils.atomic_write(genes_to_exons_fname) as genes_to_exons_file:
+            genes_to_exons.to_csv(genes_to_exons_file,
+                                  cols=genes_to_exons_header,
+                                  index=False,
+                                  sep="\t")
+        # Output exons to GFF file last, since its presence
+        # marks both outputs as done
+        gff_lines = GeneModel.format_gff_lines(chroms, starts, ends, strands,
+                                               [("gene_id", gene_ids),
+                                                ("ID", exon_ids),
+                                                ("Parent", parents)],
+                                               source=self.source,
+                                               rec_type=rec_type)
+        self.output_lines(gff_output_filename,
+                          gff_lines,
+                          chroms,
+                          array(starts, dtype=int64) - 1,
+                          ends,
+                          preset="gff",
+                          header="##gff-version 3\n",
+                          indexed=indexed)
+
+
+    def output_exons_as_bed(self, indexed=False):
         """
         Output the table's exons as BED.
-        
-        Only implemented for ensGene.txt; probably not
-        necessary to work out for other tables since this is
-        only used for aggregate statistics.
+
+        - indexed: if True, also output a tabix indexed copy
+          of the BED (see output_lines)
         """
-        if self.source != "ensGene":
-            return
         output_filename = os.path.join(self.exons_dir,
                                        "%s.exons.bed" %(self.source))
         print "Outputting exons..."
-        if os.path.isfile(output_filename):
+        if self.has_output(output_filename, indexed=indexed):
             print "  - Found %s. Skipping..." %(output_filename)
             return output_filename
-        exons_file = open(output_filename, "w")
-        for idx, series in self.raw_table.iterrows():
-            gene_info = series.to_dict()
-            gene_id = gene_info["name2"]
-            chrom = gene_info["chrom"]
-            strand = gene_info["strand"]
-            exonStarts = gene_info["exonStarts"]
-            exonEnds = gene_info["exonEnds"]
-            # Keep 0-based start of ensGene table since
-            # this will be outputted as a BED
-            exon_starts = (int(start) for start in exonStarts.rstrip(",").split(","))
-            exon_ends = (int(end) for end in exonEnds.rstrip(",").split(","))
-            exon_coords = zip(exon_starts, exon_ends)
-            # Output as BED: encode gene ID
-            bedtools_utils.output_intervals_as_bed(exons_file,
-                                                   chrom, exon_coords, strand,
-                                                   name=gene_id)
-        exons_file.close()
-        return output_filename
-
-
-    def output_merged_exons(self):
+        # Keep 0-based start of ensGene table since
+        # this will be outputted as a BED
+        store = self.get_transcript_store()
+        exon_trans = store.get_exon_transcripts()
+        chroms = store.chrom_names[store.chroms[exon_trans]]
+        # Output as BED: encode gene ID
+        bed_lines = bedtools_utils.format_bed_lines(chroms,
+                                                    store.exon_starts,
+                                                    store.exon_ends,
+                                                    store.gene_ids[exon_trans],
+                                                    store.strands[exon_trans])
+        return self.output_lines(output_filename,
+                                 bed_lines,
+                                 chroms,
+                                 store.exon_starts,
+                                 store.exon_ends,
+                                 indexed=indexed)
+
+
+    def output_merged_exons(self, indexed=False):
         """
         Output the table's merged exons as a (sorted) BED file.
 
-        Used to determine the exonic content of a sample. Relies on
-        sortBed and mergeBed to do the heavy lifting.
+        Used to determine the exonic content of a sample. Exons
+        that overlap on the same strand are merged and their
+        gene IDs joined by semicolons (the output of
+        sortBed | mergeBed -nms -s.)
 
-        Only implemented for ensGene.txt; probably not
-        necessary to work out for other tables since this is
-        only used for aggregate statistics.
+        - indexed: if True, also output a tabix indexed copy
+          of the BED (see output_lines)
         """
-        if self.source != "ensGene":
-            return
         print "Outputting merged exons..."
-        exons_filename = os.path.join(self.exons_dir,
-                                      "ensGene.exons.bed")
-        if not os.path.isfile(exons_filename):
-            print "Error: Could not find exons filename %s" %(exons_filename)
-            print "Did a previous step fail?"
-            sys.exit(1)
         output_filename = os.path.join(self.exons_dir,
-                                       "ensGene.merged_exons.bed")
-        # Merge the exons and output them as a new BED file
-        bedtools_utils.merge_bed(exons_filename, output_filename)
+                                       "%s.merged_exons.bed" %(self.source))
+        if self.has_output(output_filename, indexed=indexed):
+            print "  - Found %s. Skipping..." %(output_filename)
+            return output_filename
+        store = self.get_transcript_store()
+        exon_trans = store.get_exon_transcripts()
+        chroms = store.chrom_names[store.chroms[exon_trans]]
+        strands = store.strands[exon_trans]
+        order, merged_offsets, merged_starts, merged_ends = \
+            bedtools_utils.merge_intervals(chroms,
+                                           store.exon_starts,
+                                           store.exon_ends,
+                                           strands=strands)
+        merged_names = \
+            bedtools_utils.join_merged_names(store.gene_ids[exon_trans],
+                                             order,
+                                             merged_offsets)
+        merged_firsts = order[merged_offsets[:-1]]
+        bed_lines = bedtools_utils.format_bed_lines(chroms[merged_firsts],
+                                                    merged_starts,
+                                                    merged_ends,
+                                                    merged_names,
+                                                    strands[merged_firsts],
+                                                    score=None)
+        return self.output_lines(output_filename,
+                                 bed_lines,
+                                 chroms[merged_firsts],
+                                 merged_starts,
+                                 merged_ends,
+                                 indexed=indexed)
 
 
     def load_merged_exons_by_gene(self):
         """
-        Load ensGene exons from a BED file, indexed by gene.
+        Load the table's merged exons from a BED file,
+        indexed by gene.
         """
         self.merged_exons_header = ["chrom",
                                     "start",
@@ -602,7 +993,7 @@ class GeneTable:
                                     "name",
                                     "strand"]
         merged_exons_filename = os.path.join(self.exons_dir,
-                                             "ensGene.merged_exons.bed")
+                                             "%s.merged_exons.bed" %(self.source))
         merged_exons_file = open(merged_exons_filename)
         ensGene_bed = csv.DictReader(merged_exons_file,
                                      fieldnames=self.merged_exons_header,
@@ -616,54 +1007,78 @@ class GeneTable:
         return merged_exons_by_gene
 
 
-    def output_introns(self, min_intron_size=50):
+    def output_introns(self, min_intron_size=50,
+                       merge_introns=True,
+                       indexed=False):
         """
-        Given the merged exons, compute the intronic coordinates.
-        
-        Only implemented for ensGene.txt; probably not
-        necessary to work out for other tables since this is
-        only used for aggregate statistics.
-
-        Exclude intronic content that is less than 'min_intron_size'.
+        Output the introns of the table's transcripts as BED,
+        named by gene ID.
+
+        - min_intron_size: exclude introns (and intronic pieces)
+          shorter than this
+        - merge_introns: if True, merge the introns of each gene
+          and remove the parts that are exonic in any of the
+          gene's transcripts, so that every intronic base of a
+          gene is output once. Otherwise output the introns of
+          every transcript.
+        - indexed: if True, also output a tabix indexed copy
+          of the BED (see output_lines)
         """
-        if self.source != "ensGene":
-            return
         output_filename = os.path.join(self.introns_dir,
-                                       "ensGene.introns.bed")
+                                       "%s.introns.bed" %(self.source))
         print "Outputting introns..."
-        if os.path.isfile(output_filename):
+        if self.has_output(output_filename, indexed=indexed):
             print "  - Found %s. Skipping..." %(output_filename)
             return
         print " - Output file: %s" %(output_filename)
-        introns_file = open(output_filename, "w")
-        # Load ensGene exons
-        merged_exons_by_gene = self.load_merged_exons_by_gene()
-        for gene_id, merged_exons in merged_exons_by_gene.iteritems():
-            chrom = merged_exons[0]["chrom"]
-            strand = merged_exons[0]["strand"]
-            # For each gene, get its list of introns and serialize them
-            exon_coords = [(int(exon["start"]), int(exon["end"])) \
-                           for exon in merged_exons]
-            intron_coords = []
-            for first_exon, second_exon in zip(exon_coords, exon_coords[1::1]):
-                # Intron start coordinate is the coordinate right after
-                # the end of the first exon, intron end coordinate is the
-                # coordinate just before the beginning of the second exon
-                intron_start = first_exon[1] + 1
-                intron_end = second_exon[0] - 1
-                if intron_start >= intron_end:
-                    continue
-                # Filter on intron size (in 0-based coordinates)
-                intron_size = intron_end - intron_start
-                if intron_size < min_intron_size:
-                    continue
-                intron_coords.append((intron_start, intron_end))
-            bedtools_utils.output_intervals_as_bed(introns_file,
-                                                   chrom,
-                                                   intron_coords,
-                                                   strand,
-                                                   name=gene_id)
-        introns_file.close()
+        store = self.get_transcript_store()
+        # Group transcripts by gene, chromosome and strand, since
+        # some genes (e.g. in pseudoautosomal regions) are placed
+        # on more than one chromosome
+        trans_loci = (store.get_transcript_genes() * len(store.chrom_names) + \
+                      store.chroms) * 2 + (store.strands == "-")
+        locus_codes, locus_firsts, trans_loci = \
+            numpy.unique(trans_loci,
+                         return_index=True,
+                         return_inverse=True)
+        intron_trans, intron_starts, intron_ends = store.get_intron_coords()
+        long_introns = (intron_ends - intron_starts) >= min_intron_size
+        intron_trans = intron_trans[long_introns]
+        intron_starts = intron_starts[long_introns]
+        intron_ends = intron_ends[long_introns]
+        intron_loci = trans_loci[intron_trans]
+        if merge_introns:
+            # Merge the introns of each gene, then remove the
+            # exons of the gene's other transcripts
+            order, merged_offsets, merged_starts, merged_ends = \
+                bedtools_utils.merge_intervals(intron_loci,
+                                               intron_starts,
+                                               intron_ends)
+            exon_loci = trans_loci[store.get_exon_transcripts()]
+            intron_loci, intron_starts, intron_ends = \
+                bedtools_utils.subtract_intervals(intron_loci[order[merged_offsets[:-1]]],
+                                                  merged_starts,
+                                                  merged_ends,
+                                                  exon_loci,
+                                                  store.exon_starts,
+                                                  store.exon_ends)
+            long_introns = (intron_ends - intron_starts) >= min_intron_size
+            intron_loci = intron_loci[long_introns]
+            intron_starts = intron_starts[long_introns]
+            intron_ends = intron_ends[long_introns]
+        intron_firsts = locus_firsts[intron_loci]
+        chroms = store.chrom_names[store.chroms[intron_firsts]]
+        bed_lines = bedtools_utils.format_bed_lines(chroms,
+                                                    intron_starts,
+                                                    intron_ends,
+                                                    store.gene_ids[intron_firsts],
+                                                    store.strands[intron_firsts])
+        return self.output_lines(output_filename,
+                                 bed_lines,
+                                 chroms,
+                                 intron_starts,
+                                 intron_ends,
+                                 indexed=indexed)
                                                    
 
     def parse_string_int_list(self, int_list_as_str,
@@ -784,48 +1199,87 @@ def get_ucsc_tables_urls(genome):
     
 
 def download_ucsc_tables(genome,
-                         output_dir):
+                         output_dir,
+                         num_processors=1):
     """
     Download all relevant UCSC tables for a given genome.
+
+    - num_processors: number of tables to download at once
     """
     tables_outdir = os.path.join(output_dir, "ucsc")
     utils.make_dir(tables_outdir)
     print "Download UCSC tables..."
     print "  - Output dir: %s" %(tables_outdir)
     ucsc_tables = get_ucsc_tables_urls(genome)
-    for table_label, table_url in ucsc_tables:
-        print "Downloading %s" %(table_label)
-        # If the table exists in uncompressed form, don't download it
-        table_filename = os.path.join(tables_outdir, table_label)
-        unzipped_table_fname = table_filename[0:-3]
-        if os.path.isfile(unzipped_table_fname):
-            print "Got %s already. Skipping download.." \
-                %(unzipped_table_fname)
-            continue
-        # Download table
-        download_status = download_utils.download_url(table_url,
-                                                      tables_outdir)
-        if download_status is None:
-            print "Failed to get %s, skipping.." %(table_label)
-            continue
-        # Uncompress table
-        utils.gunzip_file(table_filename, tables_outdir)
+    download_tasks = [("download_%s" %(table_label),
+                       download_ucsc_table,
+                       (table_label, table_url, tables_outdir),
+                       []) \
+                      for table_label, table_url in ucsc_tables]
+    utils.run_task_graph(download_tasks,
+                         num_processors=num_processors)
+
+
+def download_ucsc_table(table_label, table_url, tables_outdir):
+    """
+    Download and uncompress a UCSC table.
+    """
+    print "Downloading %s" %(table_label)
+    # If the table exists in uncompressed form, don't download it
+    table_filename = os.path.join(tables_outdir, table_label)
+    unzipped_table_fname = table_filename[0:-3]
+    if os.path.isfile(unzipped_table_fname):
+        print "Got %s already. Skipping download.." \
+            %(unzipped_table_fname)
+        return unzipped_table_fname
+    # Download table
+    download_status = download_utils.download_url(table_url,
+                                                  tables_outdir)
+    if download_status is None:
+        print "Failed to get %s, skipping.." %(table_label)
+        return None
+    # Uncompress table
+    return utils.gunzip_file(table_filename, tables_outdir)
         
 
-def process_ucsc_tables(genome, output_dir):
+def process_ucsc_tables(genome, output_dir,
+                        num_processors=1,
+                        index_outputs=False,
+                        output_combined=False):
     """
     Process UCSC tables and reformat them as needed.
+
+    The processing steps are run as a graph of tasks on
+    'num_processors' processes: each gene table is parsed once,
+    here, and the outputs that depend only on it are built in
+    parallel.
+
+    If 'index_outputs' is True, the exon and intron outputs
+    also get BGZF compressed, tabix indexed copies.
+
+    If 'output_combined' is True, also output the combined
+    (fully joined) ensGene tables. Nothing in the pipeline reads
+    them, and joining them takes much more memory than loading
+    the tables, so they are only made when asked for.
     """
     tables_outdir = os.path.join(output_dir, "ucsc")
+    tasks = []
     # Convert the UCSC knownGene format to GTF
-    convert_knowngene_to_gtf(tables_outdir)
+    tasks.append(("knownGene_to_gtf",
+                  convert_knowngene_to_gtf,
+                  (tables_outdir,),
+                  []))
     # Convert the various Ensembl tables to GFF3 format
-    convert_tables_to_gff(tables_outdir)
+    for table in GFF3_TABLES:
+        tasks.append(("%s_to_gff3" %(table),
+                      convert_table_to_gff,
+                      (tables_outdir, table),
+                      []))
     ##
     ## Process misc. tables
     ##
     # tRNA table
-    process_tRNA_table(tables_outdir)
+    tasks.append(("tRNAs", process_tRNA_table, (tables_outdir,), []))
     # snoRNA table
     # ...
     # mitoRNA table
@@ -833,24 +1287,80 @@ def process_ucsc_tables(genome, output_dir):
     ##
     ## Process gene tables
     ##
-    table_names = ["ensGene"]#, "refGene"]
+    # Build the gene ID cross-reference index
+    tasks.append(("gene_xref",
+                  output_gene_xref,
+                  (tables_outdir,),
+                  []))
+    table_names = []
+    for table_name in GENE_TABLE_NAMES:
+        table_filename = os.path.join(tables_outdir,
+                                      GENE_TABLE_FILES[table_name])
+        if not os.path.isfile(table_filename):
+            print "WARNING: Cannot find %s table %s. Skipping..." \
+                %(table_name, table_filename)
+            continue
+        table_names.append(table_name)
+        # Parse the table once; the task processes inherit it
+        shared_gene_tables[table_name] = \
+            GeneTable(tables_outdir, table_name,
+                      output_combined=output_combined)
+        def table_task(label, method_name, dependencies=[], **kwargs):
+            kwargs["indexed"] = index_outputs
+            return ("%s.%s" %(table_name, label),
+                    run_gene_table_task,
+                    (table_name, method_name, kwargs),
+                    ["%s.%s" %(table_name, dep) for dep in dependencies])
+        tasks.extend([
+            # Output the table's exons as GFF
+            table_task("exons_gff", "output_exons_as_gff"),
+            # Output the table's CDS-only exons as GFF
+            table_task("cds_exons_gff", "output_exons_as_gff",
+                       cds_only=True),
+            # Output the table's exons as BED
+            table_task("exons_bed", "output_exons_as_bed"),
+            # Output the table's merged exons
+            table_task("merged_exons", "output_merged_exons"),
+            # Output introns
+            table_task("introns", "output_introns")])
+    t1 = time.time()
+    utils.run_task_graph(tasks, num_processors=num_processors)
+    # Constitutive exons are computed over all the processes
+    # themselves, so compute them once the other tasks are done
     for table_name in table_names:
-        table = GeneTable(tables_outdir, table_name)
-        # Output the table's exons as GFF
-        table.output_exons_as_gff()
-        # Output the table's CDS-only exons as GFF
-        table.output_exons_as_gff(cds_only=True)        
-        # Output the table's exons as BED
-        table.output_exons_as_bed()
-        # Output the table's merged exons
-        table.output_merged_exons()
+        table = shared_gene_tables[table_name]
         # Output the table's constitutive exons
-        table.output_exons_as_gff(const_only=True)
+        table.output_exons_as_gff(const_only=True,
+                                  num_processors=num_processors,
+                                  indexed=index_outputs)
         # Output the table's CDS-only constitutive exons
         table.output_exons_as_gff(const_only=True,
-                                  cds_only=True)
-        # Output introns
-        table.output_introns()
+                                  cds_only=True,
+                                  num_processors=num_processors,
+                                  indexed=index_outputs)
+        del shared_gene_tables[table_name]
+    t2 = time.time()
+    print "Processing tables took %.2f minutes." %((t2 - t1) / 60.)
+
+
+def output_gene_xref(tables_outdir):
+    """
+    Build and serialize the gene ID cross-reference index
+    of the tables.
+    """
+    xref_filename = os.path.join(tables_outdir, "ensGene.xref.npz")
+    GeneXref.get_gene_xref(tables_outdir,
+                           xref_filename=xref_filename)
+    return xref_filename
+
+
+def run_gene_table_task(table_name, method_name, method_kwargs):
+    """
+    Call a method of a gene table parsed by process_ucsc_tables.
+    Used as a task of its task graph.
+    """
+    table = shared_gene_tables[table_name]
+    return getattr(table, method_name)(**method_kwargs)
 
 
 def process_tRNA_table(tables_outdir,
@@ -909,7 +1419,7 @@ def process_tRNA_table(tables_outdir,
     tRNA_table = csv.DictReader(open(tRNA_filename, "r"),
                                 delimiter=delimiter,
                                 fieldnames=tRNA_header)
-    tRNA_bed = open(tRNA_bed_filename, "w")
+    tRNA_bed = open(utils.get_tmp_filename(tRNA_bed_filename), "w")
     for entry in tRNA_table:
         bed_fields = [entry["chrom"],
                       entry["chromStart"],
@@ -920,6 +1430,7 @@ def process_tRNA_table(tables_outdir,
         bed_line = "%s\n" %("\t".join(bed_fields))
         tRNA_bed.write(bed_line)
     tRNA_bed.close()
+    os.rename(utils.get_tmp_filename(tRNA_bed_filename), tRNA_bed_filename)
     
 
 def convert_tables_to_gff(tables_outdir):
@@ -928,29 +1439,32 @@ def convert_tables_to_gff(tables_outdir):
     foo.
     """
     print "Converting tables to GFF3 format.."
-    # Use Biotoolbox script for UCSC to GFF3 conversion
-    ucsc2gff = "ucsc_table2gff3.pl"
     # Convert knownGene, Ensembl and RefSeq to GFF3
-    tables_to_convert = ["knownGene.txt",
-                         "ensGene.txt",
-                         "refGene.txt"]
     t1 = time.time()
-    for table in tables_to_convert:
-        print "  - Converting %s to GFF" %(table)
-        table_filename = os.path.join(tables_outdir,
-                                      table)
-        output_filename = os.path.join(tables_outdir,
-                                       "%s.gff3" %(table.replace(".txt", "")))
-        if os.path.isfile(output_filename):
-            print "  - Found %s. Skipping conversion..." \
-                %(output_filename)
-            continue
-        os.chdir(tables_outdir)
-        table_to_gff_cmd = "%s --table %s " %(ucsc2gff,
-                                              table)
-        os.system(table_to_gff_cmd)
+    for table in GFF3_TABLES:
+        convert_table_to_gff(tables_outdir, table)
     t2 = time.time()
     print "Conversion took %.2f minutes." %((t2 - t1)/60.)
+
+
+def convert_table_to_gff(tables_outdir, table):
+    """
+    Convert a UCSC table to GFF3.
+    """
+    print "  - Converting %s to GFF" %(table)
+    output_filename = os.path.join(tables_outdir,
+                                   "%s.gff3" %(table.replace(".txt", "")))
+    if os.path.isfile(output_filename):
+        print "  - Found %s. Skipping conversion..." \
+            %(output_filename)
+        return output_filename
+    # Use Biotoolbox script for UCSC to GFF3 conversion. It
+    # writes its output to the directory it is run in.
+    ucsc2gff = "ucsc_table2gff3.pl"
+    table_to_gff_cmd = "%s --table %s " %(ucsc2gff,
+                                          table)
+    subprocess.call(table_to_gff_cmd, shell=True, cwd=tables_outdir)
+    return output_filename
     
     
 def convert_knowngene_to_gtf(tables_outdir):
@@ -968,23 +1482,31 @@ def convert_knowngene_to_gtf(tables_outdir):
     if not os.path.isfile(knowngene_filename):
         print "Error: Cannot find %s" %(knowngene_filename)
         sys.exit(1)
-    convert_cmd = "cat %s | cut -f1-10 | genePredToGtf file stdin %s -source=knownGene" \
-        %(knowngene_filename,
-          knowngene_gtf_filename)
+    convert_cmd = "cat %s | cut -f1-10 | genePredToGtf file stdin stdout -source=knownGene" \
+        %(knowngene_filename)
     if not os.path.isfile(knowngene_gtf_filename):
-        os.system(convert_cmd)
+        utils.run_cmd_to_file(convert_cmd, knowngene_gtf_filename)
     gtf2gff_cmd = "gtf2gff3.pl"
-    convert_gff_cmd = "%s %s > %s" %(gtf2gff_cmd,
-                                     knowngene_gtf_filename,
-                                     knowngene_gff_filename)
+    convert_gff_cmd = "%s %s" %(gtf2gff_cmd,
+                                knowngene_gtf_filename)
     if not os.path.isfile(knowngene_gff_filename):
-        os.system(convert_gff_cmd)
+        utils.run_cmd_to_file(convert_gff_cmd, knowngene_gff_filename)
     return knowngene_gtf_filename, knowngene_gff_filename
 
 
 ##
 ## Random table utilities
 ##
+def lookup_first(table, key_col, value_col, keys):
+    """
+    Return an array of the values in 'value_col' of the first
+    rows of 'table' whose 'key_col' matches each of the keys
+    (NaN for keys with no match.)
+    """
+    values = table.drop_duplicates(subset=[key_col]).set_index(key_col)
+    return values[value_col].reindex(keys).values
+
+
 def dictread_groupby_col(file_in, col,
                          delimiter="\t",
                          fieldnames=None):
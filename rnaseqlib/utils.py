@@ -10,6 +10,9 @@ from urlparse import urlsplit
 
 import itertools
 import logging
+import contextlib
+import subprocess
+import multiprocessing
 
 def get_logger(logger_name, log_outdir,
                level=logging.INFO,
@@ -70,14 +73,184 @@ def gunzip_file(filename, output_dir,
     if unless_exists and os.path.isfile(unzipped_filename):
         print "  - File exists, skipping.."
         return unzipped_filename
-    os.chdir(output_dir)
-    gunzip = "gunzip "
+    gunzip = "gunzip -c "
     if force:
         gunzip += "--force"
-    os.system("%s %s > %s" %(gunzip,
-                             filename,
-                             unzipped_filename))
+    status = run_cmd_to_file("%s %s" %(gunzip, filename),
+                             unzipped_filename,
+                             cwd=output_dir)
+    if status != 0:
+        print "WARNING: Failed to unzip %s" %(filename)
+        return None
+    # Like gunzip, do not keep the compressed file
+    os.remove(os.path.join(output_dir, filename))
     return unzipped_filename
+
+
+##
+## Utilities for writing outputs atomically
+##
+## Outputs are written to a temporary file next to them and renamed
+## once complete, so that an interrupted or failed step never leaves
+## a partial output behind (steps skip outputs that already exist.)
+##
+def get_tmp_filename(filename):
+    """
+    Return a temporary filename to write 'filename' to.
+    """
+    return "%s.tmp.%d" %(filename, os.getpid())
+
+
+def get_file_stat(filename):
+    """
+    Return the size and modification time of a file, to check
+    that an index or cache made from it is up to date.
+    """
+    file_stat = os.stat(filename)
+    return [float(file_stat.st_size), float(file_stat.st_mtime)]
+
+
+@contextlib.contextmanager
+def atomic_write(filename, mode="w"):
+    """
+    Return a handle for writing 'filename' atomically. Use as:
+
+      with atomic_write(filename) as out_file:
+          ...
+    """
+    tmp_filename = get_tmp_filename(filename)
+    out_file = open(tmp_filename, mode)
+    try:
+        yield out_file
+    except:
+        out_file.close()
+        os.remove(tmp_filename)
+        raise
+    out_file.close()
+    os.rename(tmp_filename, filename)
+
+
+def write_lines(out_file, lines, chunk_size=10000):
+    """
+    Write a list of lines (ending in newlines) to a file
+    in chunks of 'chunk_size' lines.
+    """
+    for chunk_start in xrange(0, len(lines), chunk_size):
+        out_file.write("".join(lines[chunk_start:chunk_start + chunk_size]))
+
+
+def run_cmd_to_file(cmd, output_filename,
+                    cwd=None):
+    """
+    Run a shell command, writing its standard output to
+    'output_filename' atomically. The output is kept only
+    if the command succeeds.
+
+    - cwd: directory to run the command in (relative
+      output filenames are relative to it as well.)
+
+    Returns the command's exit status.
+    """
+    if cwd is not None:
+        output_filename = os.path.join(cwd, output_filename)
+    print "Executing: %s > %s" %(cmd, output_filename)
+    tmp_filename = get_tmp_filename(output_filename)
+    tmp_file = open(tmp_filename, "w")
+    try:
+        status = subprocess.call(cmd, shell=True, cwd=cwd,
+                                 stdout=tmp_file)
+    finally:
+        tmp_file.close()
+    if status != 0:
+        print "WARNING: Command failed (status %d): %s" %(status, cmd)
+        os.remove(tmp_filename)
+        return status
+    os.rename(tmp_filename, output_filename)
+    return status
+
+
+##
+## Utilities for running a graph of tasks on a pool of processes
+##
+def run_task(task_name, func, args):
+    """
+    Run a task of a task graph. Used by the process pool.
+    """
+    t1 = time.time()
+    try:
+        result = func(*args)
+    except SystemExit, exit_status:
+        # Do not let a task bring down a pool process
+        raise Exception, "Task %s exited (%s)" %(task_name, exit_status)
+    t2 = time.time()
+    print "Task %s done in %.2f minutes." %(task_name, (t2 - t1) / 60.)
+    return result
+
+
+def run_task_graph(tasks, num_processors=1,
+                   poll_interval=0.5):
+    """
+    Run a graph of tasks, starting each task once the
+    tasks it depends on are done.
+
+    - tasks: list of (task_name, func, args, dependencies) where
+      func is a module-level function (so that it can be sent to
+      worker processes) called as func(*args), and dependencies
+      is a list of task names.
+    - num_processors: number of processes to run tasks on. If 1,
+      tasks are run one at a time in this process.
+
+    Processes are forked when the graph is run, so tasks can use
+    data loaded into module globals beforehand without pickling.
+    Returns a dictionary of the tasks' results by task name.
+    """
+    task_names = set([task[0] for task in tasks])
+    for task_name, func, args, dependencies in tasks:
+        for dependency in dependencies:
+            if dependency not in task_names:
+                raise Exception, "Task %s depends on unknown task %s" \
+                    %(task_name, dependency)
+    results = {}
+    pending = list(tasks)
+    def get_ready_tasks():
+        return [task for task in pending \
+                if all([dependency in results for dependency in task[3]])]
+    if num_processors <= 1:
+        while len(pending) > 0:
+            ready_tasks = get_ready_tasks()
+            if len(ready_tasks) == 0:
+                raise Exception, "Circular task dependencies."
+            for task in ready_tasks:
+                task_name, func, args, dependencies = task
+                results[task_name] = run_task(task_name, func, args)
+                pending.remove(task)
+        return results
+    pool = multiprocessing.Pool(processes=num_processors)
+    running = {}
+    try:
+        while (len(pending) > 0) or (len(running) > 0):
+            # Launch tasks whose dependencies are done
+            for task in get_ready_tasks():
+                task_name, func, args, dependencies = task
+                running[task_name] = pool.apply_async(run_task,
+                                                      (task_name, func, args))
+                pending.remove(task)
+            if len(running) == 0:
+                raise Exception, "Circular task dependencies."
+            finished = [task_name for task_name, result in running.iteritems() \
+                        if result.ready()]
+            if len(finished) == 0:
+                time.sleep(poll_interval)
+                continue
+            for task_name in finished:
+                results[task_name] = running.pop(task_name).get()
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+    return results
     
     
 def pathify(filename):
@@ -12,26 +12,35 @@ import rnaseqlib.Pipeline as rna_pipeline
 import rnaseqlib.RNABase as rna_base
 
 def run_pipeline(settings_filename,
-                 output_dir):
+                 output_dir,
+                 incremental=False,
+                 preview=None):
     """
     Run pipeline on all samples given settings file.
+
+    If incremental is True, run only on samples that are new
+    or changed since the last run. If preview is given, run
+    on a subsample of the reads (see Pipeline.)
     """
     # Create pipeline instance
     pipeline = rna_pipeline.Pipeline(settings_filename,
-                                     output_dir)
+                                     output_dir,
+                                     preview=preview)
     # Run pipeline
-    pipeline.run()
+    pipeline.run(incremental=incremental)
 
     
 def run_on_sample(sample_label,
                   settings_filename,
-                  output_dir):
+                  output_dir,
+                  preview=None):
     """
     Run pipeline on one particular sample.
     """
     pipeline = rna_pipeline.Pipeline(settings_filename,
                                      output_dir,
-                                     curr_sample=sample_label)
+                                     curr_sample=sample_label,
+                                     preview=preview)
     pipeline.run_on_sample(sample_label)
 
 
@@ -46,8 +55,6 @@ def check_requirements():
                          # Bedtools
                          "intersectBed",
                          "subtractBed",
-                         "sortBed",
-                         "mergeBed",
                          "tagBam",
                          # Related utils
                          "gtf2gff3.pl",
@@ -89,14 +96,17 @@ def genePredToGtf_msg():
 
 
 def initialize_pipeline(genome,
-                        output_dir):
+                        output_dir,
+                        num_processors=1,
+                        output_combined=False):
     """
     Initialize the pipeline.
     """
     # Check for required programs
     check_requirements()
     base_obj = rna_base.RNABase(genome, output_dir)
-    base_obj.initialize()
+    base_obj.initialize(num_processors=num_processors,
+                        output_combined=output_combined)
 
 
 def greeting(parser=None):
@@ -112,6 +122,17 @@ def main():
     parser.add_option("--run", dest="run", action="store_true",
                       default=False,
                       help="Run pipeline.")
+    parser.add_option("--incremental", dest="incremental", action="store_true",
+                      default=False,
+                      help="With --run, run only on samples that are new or changed "
+                      "since the last run and add them to the compiled outputs.")
+    parser.add_option("--preview", dest="preview", nargs=1,
+                      type="float", default=None,
+                      help="Run in preview mode on a subsample of the reads. "
+                      "Takes as input a fraction of the reads (if less than 1) "
+                      "or a number of reads (greater than 1). Outputs go in a "
+                      "\'preview/<subsample>\' "
+                      "subdirectory of the output directory.")
     parser.add_option("--run-on-sample", dest="run_on_sample", nargs=1, default=None,
                       help="Run on a particular sample. Takes as input the sample label.")
     parser.add_option("--settings", dest="settings", nargs=1,
@@ -123,6 +144,13 @@ def main():
     parser.add_option("--output-dir", dest="output_dir", nargs=1,
                       default=None,
                       help="Output directory.")
+    parser.add_option("--num-processors", dest="num_processors", nargs=1,
+                      type="int", default=1,
+                      help="Number of processors to use with --init.")
+    parser.add_option("--output-combined-tables", dest="output_combined",
+                      action="store_true", default=False,
+                      help="With --init, also output the combined (fully joined) "
+                      "ensGene tables.")
     (options, args) = parser.parse_args()
 
     greeting()
@@ -145,7 +173,9 @@ def main():
             sys.exit(1)
         settings_filename = utils.pathify(options.settings)
         run_pipeline(settings_filename,
-                     output_dir)
+                     output_dir,
+                     incremental=options.incremental,
+                     preview=options.preview)
 
     if options.run_on_sample is not None:
         if options.settings == None:
@@ -156,12 +186,15 @@ def main():
         settings_filename = utils.pathify(options.settings)
         sample_label = options.run_on_sample
         run_on_sample(sample_label, settings_filename,
-                      output_dir)
+                      output_dir,
+                      preview=options.preview)
 
     if options.initialize is not None:
         genome = options.initialize
         initialize_pipeline(genome,
-                            output_dir)
+                            output_dir,
+                            num_processors=options.num_processors,
+                            output_combined=options.output_combined)
     
 
 if __name__ == '__main__':